@@ -0,0 +1,215 @@
+"""
+Аналитика по оплатам на NumPy.
+
+Числовые колонки и даты payments, contracts и contract_stages читаются
+через COPY ... TO STDOUT (FORMAT binary) прямо в массивы: запрос отдаёт
+только колонки фиксированной ширины без NULL, поэтому каждая строка COPY
+имеет один и тот же размер и весь поток разбирается одним np.frombuffer
+со структурным dtype, без Python-объекта на строку.
+
+numpy — необязательная зависимость: без неё модуль импортируется,
+но AVAILABLE = False.
+"""
+import io
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AVAILABLE = np is not None
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# даты в бинарном COPY — дни от 2000-01-01; NULL заменяем на 'infinity'
+PG_EPOCH_DAYS = 10957  # 2000-01-01 - 1970-01-01
+PG_DATE_INFINITY = 2 ** 31 - 1
+WIRE_TYPES = {"int4": ">i4", "float8": ">f8", "date": ">i4"}
+
+PAYMENTS_SQL = """
+    SELECT contract_code, payment_date, payment_amount::float8
+    FROM payments
+"""
+CONTRACTS_SQL = """
+    SELECT contract_code, customer_code, conclusion_date, COALESCE(total_amount, 0)::float8
+    FROM contracts
+"""
+STAGES_SQL = """
+    SELECT contract_code, COALESCE(stage_execution_date, 'infinity'::date), stage_amount::float8
+    FROM contract_stages
+"""
+
+PERCENTILES = (10, 25, 50, 75, 90, 95, 99)
+# (от, до включительно, подпись); None — без границы
+DAY_BUCKETS = ((None, -1, "раньше срока"), (0, 30, "до 30 дн."), (31, 90, "31-90 дн."),
+               (91, 180, "91-180 дн."), (181, 365, "181-365 дн."), (366, None, "более года"))
+
+
+def copy_columns(cursor, query, columns):
+    """
+    Результат query (без NULL, только int4/float8/date) как словарь массивов.
+    columns: [(имя, тип)] в порядке колонок запроса. Даты — datetime64[D],
+    'infinity' становится NaT.
+    """
+    buf = io.BytesIO()
+    cursor.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary)", buf)
+    data = buf.getbuffer()
+    if bytes(data[:11]) != COPY_SIGNATURE:
+        raise ValueError("Неожиданный заголовок бинарного COPY")
+    # подпись, флаги (4 байта), длина расширения заголовка (4 байта) и само расширение
+    start = 19 + int.from_bytes(data[15:19], "big")
+    body = data[start:len(data) - 2]  # в конце — маркер -1 (2 байта)
+
+    fields = [("_count", ">i2")]
+    for i, (name, kind) in enumerate(columns):
+        fields += [(f"_len{i}", ">i4"), (name, WIRE_TYPES[kind])]
+    dtype = np.dtype(fields)
+    if len(body) % dtype.itemsize:
+        raise ValueError("Строки COPY разной длины: в запросе есть NULL или колонка переменной ширины")
+    rec = np.frombuffer(body, dtype=dtype)
+
+    out = {}
+    for name, kind in columns:
+        col = rec[name]
+        if kind == "date":
+            days = col.astype(np.int64)
+            dates = (days + PG_EPOCH_DAYS).astype("datetime64[D]")
+            dates[days == PG_DATE_INFINITY] = np.datetime64("NaT")
+            out[name] = dates
+        else:
+            out[name] = col.astype(np.float64 if kind == "float8" else np.int64)
+    return out
+
+
+def load_arrays(cursor):
+    return {
+        "payments": copy_columns(cursor, PAYMENTS_SQL, [
+            ("contract", "int4"), ("date", "date"), ("amount", "float8")]),
+        "contracts": copy_columns(cursor, CONTRACTS_SQL, [
+            ("contract", "int4"), ("customer", "int4"), ("concluded", "date"), ("total", "float8")]),
+        "stages": copy_columns(cursor, STAGES_SQL, [
+            ("contract", "int4"), ("due", "date"), ("amount", "float8")]),
+    }
+
+
+def lookup(keys, values, wanted):
+    """values[i] для keys[i] == wanted (keys уникальны); маска найденных."""
+    if not len(keys):
+        return np.zeros(len(wanted), dtype=values.dtype), np.zeros(len(wanted), dtype=bool)
+    order = np.argsort(keys)
+    keys, values = keys[order], values[order]
+    pos = np.clip(np.searchsorted(keys, wanted), 0, len(keys) - 1)
+    return values[pos], keys[pos] == wanted
+
+
+def payment_size_stats(payments):
+    amounts = payments["amount"]
+    if not len(amounts):
+        return []
+    rows = [("Платежей", len(amounts)), ("Сумма", amounts.sum()), ("Средний платёж", amounts.mean())]
+    for p, v in zip(PERCENTILES, np.percentile(amounts, PERCENTILES)):
+        rows.append((f"{p}-й перцентиль", v))
+    return rows
+
+
+def customer_concentration(payments, contracts, top=10):
+    """Доли заказчиков в поступлениях, индекс Херфиндаля-Хиршмана и крупнейшие заказчики."""
+    customer, found = lookup(contracts["contract"], contracts["customer"], payments["contract"])
+    if not found.any():
+        return 0.0, []
+    codes, inv = np.unique(customer[found], return_inverse=True)
+    paid = np.bincount(inv, weights=payments["amount"][found])
+    share = paid / paid.sum()
+    hhi = float((share ** 2).sum() * 10000)
+    best = np.argsort(paid)[::-1][:top]
+    return hhi, [(int(codes[i]), paid[i], share[i]) for i in best]
+
+
+def days_to_pay(payments, contracts, stages):
+    """
+    По каждому договору — дата, когда оплаты набрали сумму договора.
+    Возвращает дни от заключения и дни от срока последнего этапа.
+    """
+    c, d, a = payments["contract"], payments["date"], payments["amount"]
+    order = np.lexsort((d, c))
+    c, d, a = c[order], d[order], a[order]
+    if not len(c):
+        return np.empty(0), np.empty(0)
+
+    # нарастающий итог внутри договора: общий cumsum минус итог до начала группы
+    cum = np.cumsum(a)
+    starts = np.flatnonzero(np.r_[True, c[1:] != c[:-1]])
+    group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(c)]))
+    cum_in_contract = cum - (cum[starts] - a[starts])[group]
+
+    total, found = lookup(contracts["contract"], contracts["total"], c)
+    reached = found & (total > 0) & (cum_in_contract >= total - 0.005)
+    # первая по дате строка, где договор оплачен полностью
+    paid_contracts, first = np.unique(c[reached], return_index=True)
+    paid_on = d[reached][first]
+
+    concluded, _ = lookup(contracts["contract"], contracts["concluded"], paid_contracts)
+    from_conclusion = (paid_on - concluded).astype(np.int64)
+
+    # срок последнего этапа договора (этапы без срока не учитываем)
+    dated = ~np.isnat(stages["due"])
+    s_contract, s_due = stages["contract"][dated], stages["due"][dated].astype(np.int64)
+    if len(s_contract):
+        s_codes, s_inv = np.unique(s_contract, return_inverse=True)
+        last_due = np.full(len(s_codes), np.iinfo(np.int64).min)
+        np.maximum.at(last_due, s_inv, s_due)
+        due, has_due = lookup(s_codes, last_due, paid_contracts)
+        from_due = paid_on.astype(np.int64)[has_due] - due[has_due]
+    else:
+        from_due = np.empty(0, dtype=np.int64)
+    return from_conclusion, from_due
+
+
+def day_distribution(days):
+    rows = []
+    for lo, hi, label in DAY_BUCKETS:
+        mask = np.ones(len(days), dtype=bool)
+        if lo is not None:
+            mask &= days >= lo
+        if hi is not None:
+            mask &= days <= hi
+        rows.append((label, int(mask.sum())))
+    if len(days):
+        rows += [("медиана, дн.", float(np.median(days))), ("90-й перцентиль, дн.", float(np.percentile(days, 90)))]
+    return rows
+
+
+def customer_names(cursor, codes):
+    """Имена заказчиков для кодов одним запросом; ненайденный код остаётся числом."""
+    if not codes:
+        return {}
+    cursor.execute("SELECT organization_code, name FROM organizations WHERE organization_code = ANY(%s)",
+                   (list(codes),))
+    return {r["organization_code"]: r["name"] for r in cursor.fetchall()}
+
+
+def build_report(cursor):
+    """Строки для окна отчёта: [{"Раздел", "Показатель", "Значение"}]."""
+    data = load_arrays(cursor)
+    rows = []
+
+    def add(section, label, value):
+        if isinstance(value, (float, np.floating)):
+            value = f"{value:,.2f}".replace(",", " ")
+        rows.append({"Раздел": section, "Показатель": label, "Значение": value})
+
+    for label, value in payment_size_stats(data["payments"]):
+        add("Размер платежа", label, value)
+
+    hhi, best = customer_concentration(data["payments"], data["contracts"])
+    names = customer_names(cursor, [code for code, _, _ in best])
+    add("Концентрация заказчиков", "Индекс Херфиндаля-Хиршмана", round(hhi))
+    for code, paid, share in best:
+        add("Концентрация заказчиков", names.get(code) or str(code), f"{paid:,.2f} ({share:.1%})".replace(",", " "))
+
+    from_conclusion, from_due = days_to_pay(data["payments"], data["contracts"], data["stages"])
+    add("Срок полной оплаты", "Договоров оплачено полностью", len(from_conclusion))
+    for label, value in day_distribution(from_conclusion):
+        add("От заключения договора", label, value)
+    for label, value in day_distribution(from_due):
+        add("От срока последнего этапа", label, value)
+    return rows
@@ -2,4 +2,36 @@ DB_HOST = "10.51.124.98"
 DB_PORT = 5432
 DB_NAME = "student"         
 DB_USER = "postgres"            
-DB_PASSWORD = "postgres"
\ No newline at end of file
+DB_PASSWORD = "postgres"
+
+# локальный снимок данных для быстрого запуска и просмотра без связи (None — отключить)
+SNAPSHOT_PATH = "snapshot.sqlite3"
+# сколько секунд ждать подключения к БД
+DB_CONNECT_TIMEOUT = 5
+
+# строк отчёта на одну страницу ("Загрузить ещё")
+REPORT_PAGE_SIZE = 1000
+# выше этой оценки EXPLAIN отчёт запускается только после подтверждения
+REPORT_CONFIRM_ROWS = 100000
+
+# statement_timeout (мс) для долгих операций по видам; 0 — без ограничения
+STATEMENT_TIMEOUTS = {
+    "load": 60000,      # загрузка таблицы
+    "report": 120000,   # отчёты и аналитика
+    "bulk": 60000,      # массовое изменение и удаление
+    "service": 0,       # пересчёты, архив, секции
+}
+
+# память под недавно открытые таблицы (МБ), лишние вытесняются по LRU
+TABLE_CACHE_MB = 256
+
+# сохранённые наборы условий отчётов (None — не сохранять)
+REPORT_PRESETS_PATH = "report_presets.json"
+
+# реплика только для чтения: чем отличаются параметры подключения, например
+# {"host": "10.51.124.99"}; None — всё читается с основного сервера
+REPLICA = None
+# через сколько секунд снова пробовать недоступную реплику
+REPLICA_RETRY_SECONDS = 60
+# сколько ждать (мс), пока реплика догонит свою же запись, прежде чем читать с основного
+REPLICA_CATCHUP_WAIT_MS = 300
\ No newline at end of file
@@ -33,7 +33,8 @@ CREATE TABLE organizations (
     okpo VARCHAR(20),
     bik VARCHAR(20),
     created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    is_active BOOLEAN DEFAULT TRUE
+    is_active BOOLEAN DEFAULT TRUE,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Таблица видов оплат
@@ -82,6 +83,7 @@ CREATE TABLE contract_stages (
     advance_amount DECIMAL(15,2) DEFAULT 0 CHECK (advance_amount >= 0),
     topic VARCHAR(500),
     notes TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     PRIMARY KEY (contract_code, stage_number),
     CONSTRAINT fk_contract FOREIGN KEY (contract_code) 
@@ -92,19 +94,93 @@ CREATE TABLE contract_stages (
 );
 
 -- Таблица оплат
+-- Секционирована по месяцам payment_date (PostgreSQL 13+): отчёты с фильтром
+-- по дате читают только нужные секции. Ключ секционирования обязан входить
+-- в PK; payment_id по-прежнему уникален за счёт последовательности.
 CREATE TABLE payments (
-    payment_id SERIAL PRIMARY KEY,
+    payment_id SERIAL,
     contract_code INTEGER NOT NULL,
     payment_date DATE NOT NULL DEFAULT CURRENT_DATE,
     payment_amount DECIMAL(15,2) NOT NULL CHECK (payment_amount > 0),
     payment_type_code INTEGER NOT NULL,
     payment_document_number VARCHAR(100),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
+    PRIMARY KEY (payment_id, payment_date),
     CONSTRAINT fk_payment_contract FOREIGN KEY (contract_code) 
         REFERENCES contracts(contract_code) ON DELETE CASCADE,
     CONSTRAINT fk_payment_type FOREIGN KEY (payment_type_code) 
         REFERENCES payment_types(payment_type_code) ON DELETE RESTRICT
-);
+) PARTITION BY RANGE (payment_date);
+
+-- Платежи вне созданных месячных секций
+CREATE TABLE payments_default PARTITION OF payments DEFAULT;
+
+-- Создаёт недостающие месячные секции payments: от months_back месяцев назад
+-- до months_ahead вперёд. Если подходящие строки уже лежат в payments_default,
+-- переносит их в новую секцию. Запускать регулярно, например через pg_cron:
+--   SELECT cron.schedule('payments-partitions', '0 3 1 * *', 'SELECT ensure_payment_partitions()');
+CREATE OR REPLACE FUNCTION ensure_payment_partitions(months_back INTEGER DEFAULT 0, months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER AS $$
+DECLARE
+    m DATE;
+    m_next DATE;
+    part TEXT;
+    created INTEGER := 0;
+BEGIN
+    FOR m IN
+        SELECT generate_series(
+            date_trunc('month', CURRENT_DATE) - make_interval(months => months_back),
+            date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead),
+            INTERVAL '1 month')::date
+    LOOP
+        part := 'payments_' || to_char(m, 'YYYY_MM');
+        m_next := (m + INTERVAL '1 month')::date;
+        CONTINUE WHEN to_regclass(part) IS NOT NULL;
+
+        IF EXISTS (SELECT 1 FROM payments_default WHERE payment_date >= m AND payment_date < m_next) THEN
+            EXECUTE format('CREATE TABLE %I (LIKE payments INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM payments_default WHERE payment_date >= %L AND payment_date < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved', m, m_next, part);
+            EXECUTE format('ALTER TABLE payments ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', part, m, m_next);
+            -- перенос из default оставил надгробия; касаемся строк, чтобы
+            -- клиенты при дельта-обновлении вернули их обратно
+            EXECUTE format('UPDATE %I SET updated_at = NOW()', part);
+        ELSE
+            EXECUTE format('CREATE TABLE %I PARTITION OF payments FOR VALUES FROM (%L) TO (%L)', part, m, m_next);
+        END IF;
+        created := created + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Отсоединяет месячные секции старше keep_months месяцев. Таблицы
+-- payments_ГГГГ_ММ остаются в БД как архив (их можно выгрузить или удалить),
+-- но рабочие запросы и отчёты их больше не читают.
+CREATE OR REPLACE FUNCTION detach_old_payment_partitions(keep_months INTEGER DEFAULT 60)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    part TEXT;
+    boundary DATE := (date_trunc('month', CURRENT_DATE) - make_interval(months => keep_months))::date;
+BEGIN
+    FOR part IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'payments'::regclass
+          AND c.relname ~ '^payments_[0-9]{4}_[0-9]{2}$'
+          AND to_date(substr(c.relname, 10), 'YYYY_MM') < boundary
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE payments DETACH PARTITION %I', part);
+        RETURN NEXT part;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_payment_partitions(12, 3);
 -- 1. Для быстрого поиска договоров по заказчику и дате
 CREATE INDEX idx_contracts_customer_date ON contracts(customer_code, conclusion_date);
 
@@ -116,6 +192,32 @@ CREATE INDEX idx_payments_contract_date ON payments(contract_code, payment_date)
 
 -- 4. Для поиска организаций по ИНН и названию
 CREATE INDEX idx_organizations_inn_name ON organizations(inn, name);
+
+-- 5. Для дельта-обновления клиентов по updated_at
+CREATE INDEX idx_contracts_updated_at ON contracts(updated_at);
+CREATE INDEX idx_contract_stages_updated_at ON contract_stages(updated_at);
+CREATE INDEX idx_payments_updated_at ON payments(updated_at);
+CREATE INDEX idx_organizations_updated_at ON organizations(updated_at);
+
+-- 6. Для подсказок при вводе в формах: префикс по lower(...) и вхождение/похожесть через pg_trgm
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX idx_organizations_name_prefix ON organizations(lower(name) text_pattern_ops);
+CREATE INDEX idx_organizations_name_trgm ON organizations USING gin (name gin_trgm_ops);
+CREATE INDEX idx_contracts_topic_prefix ON contracts(lower(topic) text_pattern_ops);
+CREATE INDEX idx_contracts_topic_trgm ON contracts USING gin (topic gin_trgm_ops);
+
+-- 7. Полнотекстовый поиск по теме и примечанию (русская морфология).
+-- Индекс по выражению, а не хранимая колонка: строки читаются через SELECT *,
+-- и tsvector не должен попадать в каждую строку клиента, витрину и архив.
+-- Запрос должен использовать то же выражение text_search_tsv(topic, notes).
+CREATE OR REPLACE FUNCTION text_search_tsv(topic TEXT, notes TEXT)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('russian', COALESCE(topic, '')), 'A')
+        || setweight(to_tsvector('russian', COALESCE(notes, '')), 'B')
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+CREATE INDEX idx_contracts_fts ON contracts USING gin (text_search_tsv(topic, notes));
+CREATE INDEX idx_contract_stages_fts ON contract_stages USING gin (text_search_tsv(topic, notes));
 -- VIEW по одной таблице: активные договоры
 CREATE VIEW active_contracts_view AS
 SELECT 
@@ -182,4 +284,526 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER update_contracts_updated_at 
     BEFORE UPDATE ON contracts 
     FOR EACH ROW 
-    EXECUTE FUNCTION update_updated_at_column();
\ No newline at end of file
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_contract_stages_updated_at 
+    BEFORE UPDATE ON contract_stages 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_payments_updated_at 
+    BEFORE UPDATE ON payments 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_organizations_updated_at 
+    BEFORE UPDATE ON organizations 
+    FOR EACH ROW 
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- "Надгробия" удалённых строк: по ним клиент при дельта-обновлении
+-- узнаёт, какие строки пропали с момента прошлой загрузки.
+CREATE TABLE deleted_rows (
+    id BIGSERIAL PRIMARY KEY,
+    table_name VARCHAR(63) NOT NULL,
+    pk JSONB NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE INDEX idx_deleted_rows_table_time ON deleted_rows(table_name, deleted_at);
+
+-- Аргументы: логическое имя таблицы и колонки первичного ключа
+CREATE OR REPLACE FUNCTION log_deleted_row()
+RETURNS TRIGGER AS $$
+DECLARE
+    rec JSONB := to_jsonb(OLD);
+    pk JSONB := '{}'::jsonb;
+    i INTEGER;
+BEGIN
+    FOR i IN 1 .. TG_NARGS - 1 LOOP
+        pk := pk || jsonb_build_object(TG_ARGV[i], rec -> TG_ARGV[i]);
+    END LOOP;
+    INSERT INTO deleted_rows (table_name, pk) VALUES (TG_ARGV[0], pk);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER log_contracts_delete
+    AFTER DELETE ON contracts
+    FOR EACH ROW EXECUTE FUNCTION log_deleted_row('contracts', 'contract_code');
+
+CREATE TRIGGER log_contract_stages_delete
+    AFTER DELETE ON contract_stages
+    FOR EACH ROW EXECUTE FUNCTION log_deleted_row('contract_stages', 'contract_code', 'stage_number');
+
+CREATE TRIGGER log_payments_delete
+    AFTER DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION log_deleted_row('payments', 'payment_id');
+
+CREATE TRIGGER log_organizations_delete
+    AFTER DELETE ON organizations
+    FOR EACH ROW EXECUTE FUNCTION log_deleted_row('organizations', 'organization_code');
+
+-- Чистка старых надгробий (клиент с более старой отметкой перечитает таблицу целиком)
+CREATE OR REPLACE FUNCTION purge_deleted_rows(keep INTERVAL DEFAULT INTERVAL '7 days')
+RETURNS INTEGER AS $$
+DECLARE
+    n INTEGER;
+BEGIN
+    DELETE FROM deleted_rows WHERE deleted_at < clock_timestamp() - keep;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Живая лента изменений для клиентов (LISTEN table_changes).
+-- Аргументы триггера: логическое имя таблицы и колонки первичного ключа.
+-- В канал уходит компактная запись {"table", "op", "pk"}, строку клиент дочитывает сам.
+CREATE OR REPLACE FUNCTION notify_table_change()
+RETURNS TRIGGER AS $$
+DECLARE
+    rec JSONB;
+    pk JSONB := '{}'::jsonb;
+    i INTEGER;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        rec := to_jsonb(OLD);
+    ELSE
+        rec := to_jsonb(NEW);
+    END IF;
+    FOR i IN 1 .. TG_NARGS - 1 LOOP
+        pk := pk || jsonb_build_object(TG_ARGV[i], rec -> TG_ARGV[i]);
+    END LOOP;
+    PERFORM pg_notify('table_changes',
+        jsonb_build_object('table', TG_ARGV[0], 'op', TG_OP, 'pk', pk)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_contracts_change
+    AFTER INSERT OR UPDATE OR DELETE ON contracts
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('contracts', 'contract_code');
+
+CREATE TRIGGER notify_contract_stages_change
+    AFTER INSERT OR UPDATE OR DELETE ON contract_stages
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('contract_stages', 'contract_code', 'stage_number');
+
+CREATE TRIGGER notify_payments_change
+    AFTER INSERT OR UPDATE OR DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('payments', 'payment_id');
+
+CREATE TRIGGER notify_organizations_change
+    AFTER INSERT OR UPDATE OR DELETE ON organizations
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('organizations', 'organization_code');
+
+CREATE TRIGGER notify_contract_types_change
+    AFTER INSERT OR UPDATE OR DELETE ON contract_types
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('contract_types', 'contract_type_code');
+
+CREATE TRIGGER notify_execution_stages_change
+    AFTER INSERT OR UPDATE OR DELETE ON execution_stages
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('execution_stages', 'stage_code');
+
+CREATE TRIGGER notify_vat_rates_change
+    AFTER INSERT OR UPDATE OR DELETE ON vat_rates
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('vat_rates', 'vat_code');
+
+CREATE TRIGGER notify_payment_types_change
+    AFTER INSERT OR UPDATE OR DELETE ON payment_types
+    FOR EACH ROW EXECUTE FUNCTION notify_table_change('payment_types', 'payment_type_code');
+
+
+-- Распределение оплат договора по его этапам (см. stage_allocation_view
+-- и refresh_stage_allocations в конце файла). Хранится по этапам и
+-- пересчитывается только для договоров из allocation_dirty.
+CREATE TABLE stage_payment_allocations (
+    contract_code INTEGER NOT NULL,
+    stage_number INTEGER NOT NULL,
+    advance_paid DECIMAL(15,2) NOT NULL,   -- погашено из аванса этапа
+    paid_amount DECIMAL(15,2) NOT NULL,    -- погашено всего, включая аванс
+    refreshed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp(),
+    PRIMARY KEY (contract_code, stage_number)
+);
+
+-- Договоры, у которых изменились этапы или оплаты
+CREATE TABLE allocation_dirty (
+    contract_code INTEGER PRIMARY KEY
+);
+
+CREATE OR REPLACE FUNCTION mark_allocation_dirty()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO allocation_dirty VALUES (OLD.contract_code) ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO allocation_dirty VALUES (NEW.contract_code) ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER allocation_dirty_contract_stages
+    AFTER INSERT OR UPDATE OR DELETE ON contract_stages
+    FOR EACH ROW EXECUTE FUNCTION mark_allocation_dirty();
+
+CREATE TRIGGER allocation_dirty_payments
+    AFTER INSERT OR UPDATE OR DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION mark_allocation_dirty();
+
+-- Снимок дебиторской задолженности по этапам для отчёта по срокам (aging).
+-- Долг этапа — его сумма минус погашенное по stage_payment_allocations.
+-- Корзины по дням просрочки считаются при чтении от CURRENT_DATE,
+-- поэтому снимок не устаревает со сменой дня — только при изменении данных.
+CREATE VIEW receivables_by_stage_view AS
+SELECT
+    cs.contract_code,
+    cs.stage_number,
+    c.customer_code,
+    cs.stage_execution_date AS due_date,
+    cs.stage_amount,
+    (cs.stage_amount - COALESCE(a.paid_amount, 0))::DECIMAL(15,2) AS unpaid_amount
+FROM contract_stages cs
+JOIN contracts c ON c.contract_code = cs.contract_code
+LEFT JOIN stage_payment_allocations a
+    ON a.contract_code = cs.contract_code AND a.stage_number = cs.stage_number;
+
+CREATE TABLE receivables_snapshot (
+    contract_code INTEGER NOT NULL,
+    stage_number INTEGER NOT NULL,
+    customer_code INTEGER NOT NULL,
+    due_date DATE,
+    stage_amount DECIMAL(15,2) NOT NULL,
+    unpaid_amount DECIMAL(15,2) NOT NULL,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp(),
+    PRIMARY KEY (contract_code, stage_number)
+);
+
+CREATE INDEX idx_receivables_snapshot_due ON receivables_snapshot(due_date) WHERE unpaid_amount > 0;
+
+-- Договоры, затронутые с прошлого пересчёта снимка
+CREATE TABLE receivables_dirty (
+    contract_code INTEGER PRIMARY KEY
+);
+
+CREATE OR REPLACE FUNCTION mark_receivables_dirty()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO receivables_dirty VALUES (OLD.contract_code) ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO receivables_dirty VALUES (NEW.contract_code) ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER receivables_dirty_contracts
+    AFTER INSERT OR DELETE OR UPDATE OF customer_code ON contracts
+    FOR EACH ROW EXECUTE FUNCTION mark_receivables_dirty();
+
+CREATE TRIGGER receivables_dirty_contract_stages
+    AFTER INSERT OR UPDATE OR DELETE ON contract_stages
+    FOR EACH ROW EXECUTE FUNCTION mark_receivables_dirty();
+
+CREATE TRIGGER receivables_dirty_payments
+    AFTER INSERT OR UPDATE OR DELETE ON payments
+    FOR EACH ROW EXECUTE FUNCTION mark_receivables_dirty();
+
+-- Пересчёт снимка: по умолчанию только затронутые договоры,
+-- full_rebuild => TRUE — полностью. Возвращает число пересчитанных этапов.
+CREATE OR REPLACE FUNCTION refresh_receivables_snapshot(full_rebuild BOOLEAN DEFAULT FALSE)
+RETURNS INTEGER AS $$
+DECLARE
+    touched INTEGER[];
+    n INTEGER;
+BEGIN
+    -- снимок строится по распределению оплат — оно должно быть свежим
+    PERFORM refresh_stage_allocations(full_rebuild);
+
+    IF full_rebuild THEN
+        DELETE FROM receivables_dirty;
+        DELETE FROM receivables_snapshot;
+        INSERT INTO receivables_snapshot
+            (contract_code, stage_number, customer_code, due_date, stage_amount, unpaid_amount)
+        SELECT contract_code, stage_number, customer_code, due_date, stage_amount, unpaid_amount
+        FROM receivables_by_stage_view;
+        GET DIAGNOSTICS n = ROW_COUNT;
+        RETURN n;
+    END IF;
+
+    WITH d AS (DELETE FROM receivables_dirty RETURNING contract_code)
+    SELECT array_agg(contract_code) INTO touched FROM d;
+    IF touched IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM receivables_snapshot WHERE contract_code = ANY(touched);
+    INSERT INTO receivables_snapshot
+        (contract_code, stage_number, customer_code, due_date, stage_amount, unpaid_amount)
+    SELECT contract_code, stage_number, customer_code, due_date, stage_amount, unpaid_amount
+    FROM receivables_by_stage_view
+    WHERE contract_code = ANY(touched);
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Договоры с готовыми именами из справочников: все колонки contracts (коды
+-- нужны для редактирования) плюс имена. Обычное представление — для
+-- дочитывания изменённых строк с теми же колонками, что и у витрины.
+CREATE VIEW contracts_detailed AS
+SELECT
+    c.*,
+    cust.name AS customer_name,
+    exec.name AS executor_name,
+    ct.type_name AS contract_type_name,
+    es.stage_name AS execution_stage_name,
+    v.description AS vat_description
+FROM contracts c
+LEFT JOIN organizations cust ON c.customer_code = cust.organization_code
+LEFT JOIN organizations exec ON c.executor_code = exec.organization_code
+LEFT JOIN contract_types ct ON c.contract_type_code = ct.contract_type_code
+LEFT JOIN execution_stages es ON c.execution_stage_code = es.stage_code
+LEFT JOIN vat_rates v ON c.vat_code = v.vat_code;
+
+-- Витрина договоров для главного окна
+CREATE MATERIALIZED VIEW contracts_detailed_mv AS
+SELECT * FROM contracts_detailed;
+
+-- уникальный индекс обязателен для REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX idx_contracts_detailed_mv_pk ON contracts_detailed_mv(contract_code);
+
+-- Момент начала последнего пересчёта: от него клиент догоняет изменения по updated_at
+CREATE TABLE mv_refresh_state (
+    view_name VARCHAR(63) PRIMARY KEY,
+    refreshed_at TIMESTAMP NOT NULL
+);
+
+INSERT INTO mv_refresh_state VALUES ('contracts_detailed_mv', clock_timestamp());
+
+-- Очередь "витрина устарела": только вставки, чтобы пишущие транзакции
+-- не конкурировали за одну строку-флаг
+CREATE TABLE mv_refresh_queue (
+    id BIGSERIAL PRIMARY KEY,
+    view_name VARCHAR(63) NOT NULL,
+    queued_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE OR REPLACE FUNCTION queue_mv_refresh()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO mv_refresh_queue (view_name) VALUES (TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER queue_mv_contracts
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON contracts
+    FOR EACH STATEMENT EXECUTE FUNCTION queue_mv_refresh('contracts_detailed_mv');
+
+CREATE TRIGGER queue_mv_organizations
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON organizations
+    FOR EACH STATEMENT EXECUTE FUNCTION queue_mv_refresh('contracts_detailed_mv');
+
+CREATE TRIGGER queue_mv_contract_types
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON contract_types
+    FOR EACH STATEMENT EXECUTE FUNCTION queue_mv_refresh('contracts_detailed_mv');
+
+CREATE TRIGGER queue_mv_execution_stages
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON execution_stages
+    FOR EACH STATEMENT EXECUTE FUNCTION queue_mv_refresh('contracts_detailed_mv');
+
+CREATE TRIGGER queue_mv_vat_rates
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON vat_rates
+    FOR EACH STATEMENT EXECUTE FUNCTION queue_mv_refresh('contracts_detailed_mv');
+
+-- Пересчёт витрины, если в очереди что-то есть. Параллельный вызов
+-- (несколько клиентов или планировщик) просто вернёт FALSE.
+-- Расписание, например через pg_cron:
+--   SELECT cron.schedule('contracts-mv', '* * * * *', 'SELECT refresh_contracts_detailed_mv()');
+CREATE OR REPLACE FUNCTION refresh_contracts_detailed_mv()
+RETURNS BOOLEAN AS $$
+DECLARE
+    last_id BIGINT;
+    started TIMESTAMP;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('contracts_detailed_mv')) THEN
+        RETURN FALSE;
+    END IF;
+    SELECT MAX(id) INTO last_id FROM mv_refresh_queue WHERE view_name = 'contracts_detailed_mv';
+    IF last_id IS NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    started := clock_timestamp();
+    REFRESH MATERIALIZED VIEW CONCURRENTLY contracts_detailed_mv;
+    DELETE FROM mv_refresh_queue WHERE view_name = 'contracts_detailed_mv' AND id <= last_id;
+    UPDATE mv_refresh_state SET refreshed_at = started WHERE view_name = 'contracts_detailed_mv';
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Архив закрытых договоров: рабочие таблицы, представления и отчёты
+-- читают только живые данные. Структура архивных таблиц совпадает с рабочими,
+-- чтобы *_all могли объединять их через UNION ALL.
+CREATE TABLE contracts_archive (
+    LIKE contracts INCLUDING CONSTRAINTS,
+    PRIMARY KEY (contract_code)
+);
+
+CREATE TABLE contract_stages_archive (
+    LIKE contract_stages INCLUDING CONSTRAINTS,
+    PRIMARY KEY (contract_code, stage_number),
+    FOREIGN KEY (contract_code) REFERENCES contracts_archive(contract_code) ON DELETE CASCADE
+);
+
+CREATE TABLE payments_archive (
+    LIKE payments INCLUDING CONSTRAINTS,
+    PRIMARY KEY (payment_id),
+    FOREIGN KEY (contract_code) REFERENCES contracts_archive(contract_code) ON DELETE CASCADE
+);
+
+CREATE INDEX idx_payments_archive_contract_date ON payments_archive(contract_code, payment_date);
+CREATE INDEX idx_contracts_archive_fts ON contracts_archive USING gin (text_search_tsv(topic, notes));
+CREATE INDEX idx_contract_stages_archive_fts ON contract_stages_archive USING gin (text_search_tsv(topic, notes));
+
+CREATE VIEW contracts_all AS
+SELECT * FROM contracts
+UNION ALL
+SELECT * FROM contracts_archive;
+
+CREATE VIEW contract_stages_all AS
+SELECT * FROM contract_stages
+UNION ALL
+SELECT * FROM contract_stages_archive;
+
+CREATE VIEW payments_all AS
+SELECT * FROM payments
+UNION ALL
+SELECT * FROM payments_archive;
+
+-- Переносит в архив договоры, срок исполнения которых прошёл более min_age
+-- назад и которые оплачены полностью (не меньше суммы договора и суммы этапов).
+-- Пачки по batch_size договоров, каждая в своей транзакции: блокировки
+-- короткие, прерванный запуск просто продолжится со следующей пачки.
+-- Вызывать вне явной транзакции (autocommit):
+--   CALL archive_closed_contracts(500);
+CREATE OR REPLACE PROCEDURE archive_closed_contracts(
+    batch_size INTEGER DEFAULT 500,
+    min_age INTERVAL DEFAULT INTERVAL '1 year',
+    INOUT archived INTEGER DEFAULT 0)
+LANGUAGE plpgsql AS $$
+DECLARE
+    batch INTEGER[];
+BEGIN
+    archived := 0;
+    LOOP
+        SELECT array_agg(contract_code) INTO batch FROM (
+            SELECT c.contract_code
+            FROM contracts c
+            WHERE c.execution_date < CURRENT_DATE - min_age
+              AND COALESCE((SELECT SUM(p.payment_amount) FROM payments p
+                            WHERE p.contract_code = c.contract_code), 0)
+                  >= GREATEST(COALESCE(c.total_amount, 0),
+                              COALESCE((SELECT SUM(cs.stage_amount) FROM contract_stages cs
+                                        WHERE cs.contract_code = c.contract_code), 0))
+            ORDER BY c.contract_code
+            LIMIT batch_size
+            FOR UPDATE OF c SKIP LOCKED
+        ) t;
+        EXIT WHEN batch IS NULL;
+
+        -- в архив — от родителя к детям, из рабочих таблиц — от детей к родителю
+        INSERT INTO contracts_archive SELECT * FROM contracts WHERE contract_code = ANY(batch);
+        INSERT INTO contract_stages_archive SELECT * FROM contract_stages WHERE contract_code = ANY(batch);
+        INSERT INTO payments_archive SELECT * FROM payments WHERE contract_code = ANY(batch);
+        DELETE FROM payments WHERE contract_code = ANY(batch);
+        DELETE FROM contract_stages WHERE contract_code = ANY(batch);
+        DELETE FROM contracts WHERE contract_code = ANY(batch);
+
+        archived := archived + array_length(batch, 1);
+        COMMIT;
+    END LOOP;
+END;
+$$;
+
+
+-- Распределение оплат по этапам одним проходом по всем договорам.
+-- Каждый этап — две порции: аванс (advance_amount) и остаток суммы этапа.
+-- Оплаты договора гасят сначала авансы всех этапов, затем остатки; внутри
+-- порции — по сроку этапа, при равных сроках по номеру (FIFO).
+-- Переплата сверх суммы этапов ни на какой этап не ложится.
+-- Читает и архив: договор после переноса в архив сохраняет своё распределение.
+CREATE VIEW stage_allocation_view AS
+SELECT
+    t.contract_code,
+    t.stage_number,
+    COALESCE(SUM(t.filled) FILTER (WHERE t.is_advance), 0)::DECIMAL(15,2) AS advance_paid,
+    SUM(t.filled)::DECIMAL(15,2) AS paid_amount
+FROM (
+    SELECT
+        q.contract_code,
+        q.stage_number,
+        q.is_advance,
+        -- сколько оплат осталось к началу порции, но не больше самой порции
+        LEAST(q.amount, GREATEST(0, q.total_paid - (SUM(q.amount) OVER (
+            PARTITION BY q.contract_code
+            ORDER BY q.is_advance DESC, q.stage_execution_date NULLS LAST, q.stage_number
+            ROWS UNBOUNDED PRECEDING
+        ) - q.amount))) AS filled
+    FROM (
+        SELECT cs.contract_code, cs.stage_number, cs.stage_execution_date,
+               pay.total_paid, tr.is_advance, tr.amount
+        FROM contract_stages_all cs
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(SUM(p.payment_amount), 0) AS total_paid
+            FROM payments_all p
+            WHERE p.contract_code = cs.contract_code
+        ) pay
+        CROSS JOIN LATERAL (VALUES
+            (TRUE, COALESCE(cs.advance_amount, 0)),
+            (FALSE, cs.stage_amount - COALESCE(cs.advance_amount, 0))
+        ) tr(is_advance, amount)
+    ) q
+) t
+GROUP BY t.contract_code, t.stage_number;
+
+-- Пересчёт распределения: по умолчанию только договоры из allocation_dirty,
+-- full_rebuild => TRUE — полностью. Возвращает число пересчитанных этапов.
+CREATE OR REPLACE FUNCTION refresh_stage_allocations(full_rebuild BOOLEAN DEFAULT FALSE)
+RETURNS INTEGER AS $$
+DECLARE
+    touched INTEGER[];
+    n INTEGER;
+BEGIN
+    IF full_rebuild THEN
+        DELETE FROM allocation_dirty;
+        DELETE FROM stage_payment_allocations;
+        INSERT INTO stage_payment_allocations (contract_code, stage_number, advance_paid, paid_amount)
+        SELECT contract_code, stage_number, advance_paid, paid_amount
+        FROM stage_allocation_view;
+        GET DIAGNOSTICS n = ROW_COUNT;
+        RETURN n;
+    END IF;
+
+    WITH d AS (DELETE FROM allocation_dirty RETURNING contract_code)
+    SELECT array_agg(contract_code) INTO touched FROM d;
+    IF touched IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM stage_payment_allocations WHERE contract_code = ANY(touched);
+    INSERT INTO stage_payment_allocations (contract_code, stage_number, advance_paid, paid_amount)
+    SELECT contract_code, stage_number, advance_paid, paid_amount
+    FROM stage_allocation_view
+    WHERE contract_code = ANY(touched);
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT refresh_stage_allocations(TRUE);
@@ -0,0 +1,437 @@
+"""
+Нагрузочный тест: N клиентов одновременно повторяют запросы DatabaseApp
+(открытие таблицы — из витрины, как в окне, список справочника для поля формы,
+отчёты, добавление оплаты и правка договора) и показывают по каждой
+операции пропускную способность, задержки p50/p95/p99 и время ожидания
+блокировок.
+
+    python loadtest.py seed --contracts 20000
+    python loadtest.py run --clients 20 --duration 60
+    python loadtest.py run --clients 50 --processes --mix open_table=5,report_actual=1,add_payment=4
+
+Подключение берётся из config.py, ключи --host/--port/--dbname/--user/--password
+его переопределяют. seed заполняет синтетикой пустую БД (схема из ktkursovaya.sql).
+
+Ожидания блокировок собирает отдельное соединение: раз в --lock-sample-ms
+смотрит в pg_stat_activity, какие запросы теста ждут блокировку (каждый
+запрос помечен комментарием /* loadtest:операция */). Время ожидания —
+число таких наблюдений, умноженное на интервал, то есть оценка.
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, DB_CONNECT_TIMEOUT, REPORT_PAGE_SIZE
+from tables import FIELD_NAMES, REF_MAPPING, MATERIALIZED_SOURCES
+from reports import REPORT_DEFS
+
+# отчёты — по рабочим таблицам, без архива
+LIVE_SOURCES = {t: t for t in ("contracts", "contract_stages", "payments")}
+
+DEFAULT_MIX = {
+    "open_table": 20,
+    "reference": 30,
+    "report_contract_details": 5,
+    "report_planned": 5,
+    "report_actual": 5,
+    "report_aging": 2,
+    "add_payment": 20,
+    "edit_contract": 13,
+}
+
+TOPICS = ("Поставка оборудования", "Ремонт помещений", "Разработка программного обеспечения",
+          "Техническое обслуживание", "Монтаж систем вентиляции", "Консультационные услуги",
+          "Проектирование сетей связи", "Поставка расходных материалов")
+
+
+def tagged(op, sql):
+    # метка в тексте запроса: по ней сэмплер узнаёт операцию в pg_stat_activity
+    return f"/* loadtest:{op} */ {sql}"
+
+
+def op_open_table(cur, rnd, ctx):
+    # открытие таблицы в главном окне: все строки целиком, из витрины с именами,
+    # если она есть (по умолчанию окно читает её, см. display_source)
+    table = rnd.choice(list(FIELD_NAMES))
+    source = MATERIALIZED_SOURCES[table][0] if table in MATERIALIZED_SOURCES else table
+    cur.execute(tagged("open_table", f"SELECT * FROM {source}"))
+    cur.fetchall()
+
+
+def op_reference(cur, rnd, ctx):
+    # список справочника для поля формы (get_ref_list)
+    tbl, field, code_col = REF_MAPPING[rnd.choice(list(REF_MAPPING))]
+    cur.execute(tagged("reference", f"SELECT {code_col}, {field} FROM {tbl} ORDER BY {field}"))
+    cur.fetchall()
+
+
+def report_op(key):
+    """Первая страница отчёта и итоги по нему — как run_report без условий."""
+    rep = REPORT_DEFS[key]
+    name = f"report_{key}"
+    base = rep["sql"].format(where="", keys="", **LIVE_SOURCES)
+    expr, direction = rep["default_sort"]
+    page_sql = tagged(name, f"{base}\nORDER BY {expr} {direction}, {', '.join(rep['key'])}\nLIMIT %s")
+    sums = "".join(f', SUM("{c}")' for c in rep["totals"])
+    totals_sql = tagged(name, f"SELECT COUNT(*){sums} FROM ({base}) r")
+
+    def run(cur, rnd, ctx):
+        if rep.get("before"):
+            cur.execute(tagged(name, rep["before"]))
+            cur.connection.commit()
+        cur.execute(page_sql, (REPORT_PAGE_SIZE,))
+        cur.fetchall()
+        cur.execute(totals_sql)
+        cur.fetchone()
+    return name, run
+
+
+def op_add_payment(cur, rnd, ctx):
+    cur.execute(tagged("add_payment", """
+        INSERT INTO payments (contract_code, payment_date, payment_amount, payment_type_code, payment_document_number)
+        VALUES (%s, CURRENT_DATE, %s, %s, %s) RETURNING *
+    """), (rnd.choice(ctx["contracts"]), round(rnd.uniform(1000, 100000), 2),
+           rnd.choice(ctx["payment_types"]), f"LT-{rnd.randrange(10 ** 6)}"))
+    cur.fetchone()
+
+
+def op_edit_contract(cur, rnd, ctx):
+    # правят в основном текущие договоры — они и дают конфликты блокировок
+    cur.execute(tagged("edit_contract", "UPDATE contracts SET notes = %s WHERE contract_code = %s RETURNING *"),
+                (f"Правка нагрузочного теста {rnd.randrange(10 ** 6)}", rnd.choice(ctx["hot_contracts"])))
+    cur.fetchone()
+
+
+OPERATIONS = {
+    "open_table": op_open_table,
+    "reference": op_reference,
+    "add_payment": op_add_payment,
+    "edit_contract": op_edit_contract,
+}
+OPERATIONS.update(report_op(key) for key in REPORT_DEFS)
+
+
+def connect(conn_kwargs, **extra):
+    return psycopg2.connect(**conn_kwargs, connect_timeout=DB_CONNECT_TIMEOUT, **extra)
+
+
+def load_context(cur, hot):
+    # коды, на которые ссылаются записывающие операции
+    cur.execute("SELECT contract_code FROM contracts ORDER BY contract_code DESC")
+    contracts = [r["contract_code"] for r in cur.fetchall()]
+    cur.execute("SELECT payment_type_code FROM payment_types")
+    payment_types = [r["payment_type_code"] for r in cur.fetchall()]
+    cur.connection.commit()
+    if not contracts or not payment_types:
+        raise RuntimeError("В БД нет договоров или видов оплат — сначала loadtest.py seed")
+    return {"contracts": contracts, "payment_types": payment_types, "hot_contracts": contracts[:hot]}
+
+
+def run_client(client_id, conn_kwargs, mix, deadline, think_ms, hot, seed):
+    """Один клиент до deadline (time.time()); {операция: {"latencies": [...], "errors": {код: n}}}."""
+    rnd = random.Random(seed * 100003 + client_id)
+    conn = connect(conn_kwargs, application_name=f"loadtest-{client_id}")
+    stats = {name: {"latencies": [], "errors": defaultdict(int)} for name in mix}
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        ctx = load_context(cur, hot)
+        names, weights = list(mix), list(mix.values())
+        while time.time() < deadline:
+            name = rnd.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                OPERATIONS[name](cur, rnd, ctx)
+                conn.commit()
+                stats[name]["latencies"].append(time.perf_counter() - started)
+            except psycopg2.Error as e:
+                conn.rollback()
+                stats[name]["errors"][e.pgcode or type(e).__name__] += 1
+            if think_ms:
+                time.sleep(rnd.expovariate(1000 / think_ms))
+    finally:
+        conn.close()
+    return {name: {"latencies": s["latencies"], "errors": dict(s["errors"])} for name, s in stats.items()}
+
+
+class LockSampler(threading.Thread):
+    """Периодически считает запросы теста, ждущие блокировку, по операциям."""
+
+    def __init__(self, conn_kwargs, interval):
+        super().__init__(daemon=True)
+        self.conn_kwargs = conn_kwargs
+        self.interval = interval
+        self.samples = defaultdict(int)  # операция -> сколько раз застали в ожидании
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = connect(self.conn_kwargs, application_name="loadtest-sampler")
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            while not self.stopped.wait(self.interval):
+                cur.execute(r"""
+                    SELECT substring(query from '^/\* loadtest:([a-z_]+) \*/'), count(*)
+                    FROM pg_stat_activity
+                    WHERE datname = current_database() AND wait_event_type = 'Lock'
+                      AND application_name LIKE 'loadtest-%'
+                    GROUP BY 1
+                """)
+                for op, n in cur.fetchall():
+                    self.samples[op or "?"] += n
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def percentile(values, p):
+    # по рангу в отсортированном списке
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(results, elapsed, lock_samples, lock_interval):
+    merged = {}
+    for client in results:
+        for name, s in client.items():
+            m = merged.setdefault(name, {"latencies": [], "errors": defaultdict(int)})
+            m["latencies"].extend(s["latencies"])
+            for code, n in s["errors"].items():
+                m["errors"][code] += n
+    summary = {}
+    for name, m in merged.items():
+        lat = sorted(m["latencies"])
+        summary[name] = {
+            "ops": len(lat),
+            "errors": dict(m["errors"]),
+            "ops_per_sec": len(lat) / elapsed if elapsed else 0.0,
+            "p50_ms": None if not lat else percentile(lat, 50) * 1000,
+            "p95_ms": None if not lat else percentile(lat, 95) * 1000,
+            "p99_ms": None if not lat else percentile(lat, 99) * 1000,
+            "lock_wait_s": lock_samples.get(name, 0) * lock_interval,
+        }
+    return summary
+
+
+def print_summary(summary, elapsed, clients):
+    def ms(v):
+        return "—" if v is None else f"{v:.1f}"
+
+    print(f"\nКлиентов: {clients}, длительность: {elapsed:.1f} с")
+    print(f"{'операция':<26}{'выполнено':>10}{'ошибок':>8}{'оп/с':>9}{'p50 мс':>10}{'p95 мс':>10}"
+          f"{'p99 мс':>10}{'блок., с':>10}")
+    total_ops = 0
+    for name, s in sorted(summary.items()):
+        total_ops += s["ops"]
+        print(f"{name:<26}{s['ops']:>10}{sum(s['errors'].values()):>8}{s['ops_per_sec']:>9.1f}"
+              f"{ms(s['p50_ms']):>10}{ms(s['p95_ms']):>10}{ms(s['p99_ms']):>10}{s['lock_wait_s']:>10.1f}")
+    print(f"{'всего':<26}{total_ops:>10}{'':>8}{total_ops / elapsed if elapsed else 0:>9.1f}")
+    for name, s in sorted(summary.items()):
+        if s["errors"]:
+            codes = ", ".join(f"{code}: {n}" for code, n in sorted(s["errors"].items()))
+            print(f"  ошибки {name}: {codes}")
+
+
+def parse_mix(text):
+    """"open_table=5,add_payment=2" -> {операция: вес}; без ключа — DEFAULT_MIX."""
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"неизвестная операция {name!r}; есть: {', '.join(sorted(OPERATIONS))}")
+        try:
+            mix[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"вес операции {name!r} должен быть числом")
+    if not any(w > 0 for w in mix.values()):
+        raise argparse.ArgumentTypeError("хотя бы у одной операции вес должен быть больше нуля")
+    return mix
+
+
+def run(args, conn_kwargs):
+    mix = args.mix
+    deadline = time.time() + args.duration
+    pool_cls = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    sampler = LockSampler(conn_kwargs, args.lock_sample_ms / 1000)
+    sampler.start()
+    started = time.perf_counter()
+    with pool_cls(max_workers=args.clients) as pool:
+        futures = [pool.submit(run_client, i, conn_kwargs, mix, deadline, args.think_ms, args.hot, args.seed)
+                   for i in range(args.clients)]
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+
+    summary = summarize(results, elapsed, sampler.samples, sampler.interval)
+    print_summary(summary, elapsed, args.clients)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"clients": args.clients, "duration_s": elapsed, "mix": mix, "operations": summary},
+                      f, ensure_ascii=False, indent=2)
+
+
+def seed(args, conn_kwargs):
+    """Синтетические справочники, организации, договоры с этапами и оплаты в пустую БД."""
+    conn = connect(conn_kwargs)
+    cur = conn.cursor()
+    cur.execute("SELECT count(*) FROM contracts")
+    if cur.fetchone()[0] and not args.force:
+        raise SystemExit("В БД уже есть договоры; синтетику добавляю только с --force")
+
+    cur.executemany("INSERT INTO contract_types (type_name) VALUES (%s) ON CONFLICT DO NOTHING",
+                    [("Поставка",), ("Подряд",), ("Услуги",), ("НИОКР",)])
+    cur.executemany("INSERT INTO execution_stages (stage_name) VALUES (%s) ON CONFLICT DO NOTHING",
+                    [("Подготовка",), ("Исполнение",), ("Приёмка",), ("Закрыт",)])
+    cur.executemany("INSERT INTO payment_types (payment_type_name) VALUES (%s) ON CONFLICT DO NOTHING",
+                    [("Аванс",), ("Оплата этапа",), ("Окончательный расчёт",)])
+    cur.execute("""
+        INSERT INTO vat_rates (percentage, description)
+        SELECT p, 'НДС ' || p || '%' FROM unnest(ARRAY[0, 10, 20]) AS p
+        WHERE NOT EXISTS (SELECT 1 FROM vat_rates)
+    """)
+    cur.execute("""
+        INSERT INTO organizations (name, inn, address, phone)
+        SELECT 'ООО «Нагрузка ' || g || '»', 'LT' || g, 'г. Тестовый, ул. Синтетическая, ' || g, '+7 000 ' || g
+        FROM generate_series(1, %s) AS g
+        ON CONFLICT (inn) DO NOTHING
+    """, (args.organizations,))
+    conn.commit()
+
+    def codes(sql):
+        cur.execute(sql)
+        return [r[0] for r in cur.fetchall()]
+
+    refs = (codes("SELECT organization_code FROM organizations"),
+            codes("SELECT contract_type_code FROM contract_types"),
+            codes("SELECT stage_code FROM execution_stages"),
+            codes("SELECT vat_code FROM vat_rates"),
+            codes("SELECT payment_type_code FROM payment_types"))
+    if len(refs[0]) < 2:
+        raise SystemExit("Нужно хотя бы две организации (заказчик и исполнитель)")
+    # секции payments за весь период синтетических дат
+    cur.execute("SELECT ensure_payment_partitions(%s, 24)", (args.years * 12 + 1,))
+    conn.commit()
+
+    done = 0
+    while done < args.contracts:
+        batch = min(args.batch, args.contracts - done)
+        # random() — в подзапросах с generate_series, чтобы считался для каждой строки
+        cur.execute("""
+            WITH refs AS (
+                SELECT %s::int[] AS o, %s::int[] AS t, %s::int[] AS s, %s::int[] AS v,
+                       %s::int[] AS pt, %s::text[] AS w
+            ), new AS (
+                INSERT INTO contracts (conclusion_date, customer_code, executor_code, contract_type_code,
+                                       execution_stage_code, vat_code, execution_date, topic, notes)
+                SELECT d, o[1 + i], o[1 + (i + 1 + g %% (cardinality(o) - 1)) %% cardinality(o)],
+                       t[1 + g %% cardinality(t)], s[1 + g %% cardinality(s)], v[1 + g %% cardinality(v)],
+                       d + %s * 90, w[1 + g %% cardinality(w)] || ' №' || g, 'Синтетический договор'
+                FROM (
+                    SELECT g, refs.*, CURRENT_DATE - (random() * %s)::int AS d,
+                           (random() * (cardinality(o) - 1))::int AS i
+                    FROM refs, generate_series(1, %s) AS g
+                ) x
+                RETURNING contract_code, conclusion_date
+            ), stages AS (
+                INSERT INTO contract_stages (contract_code, stage_number, stage_execution_date, stage_code,
+                                             stage_amount, advance_amount, topic)
+                SELECT contract_code, k, conclusion_date + k * 90, s[1 + k %% cardinality(s)],
+                       amount, CASE WHEN k = 1 THEN round(amount * 0.2, 2) ELSE 0 END, 'Этап ' || k
+                FROM (
+                    SELECT n.contract_code, n.conclusion_date, k, refs.s,
+                           round((10000 + random() * 990000)::numeric, 2) AS amount
+                    FROM new n, refs, generate_series(1, %s) AS k
+                ) x
+                RETURNING contract_code, stage_amount
+            ), totals AS (
+                SELECT contract_code, SUM(stage_amount) AS total FROM stages GROUP BY contract_code
+            )
+            INSERT INTO payments (contract_code, payment_date, payment_amount, payment_type_code, payment_document_number)
+            SELECT n.contract_code, n.conclusion_date + k * 60, round(t.total / (%s + 1), 2),
+                   refs.pt[1 + k %% cardinality(refs.pt)], 'LT-' || n.contract_code || '-' || k
+            FROM new n JOIN totals t USING (contract_code), refs, generate_series(1, %s) AS k
+            WHERE t.total > 0
+        """, (*refs[:5], list(TOPICS), args.stages, args.years * 365, batch, args.stages,
+              args.payments, args.payments))
+        conn.commit()
+        done += batch
+        print(f"договоров: {done}/{args.contracts}", flush=True)
+
+    print("Суммы договоров, распределение оплат, витрина, статистика…", flush=True)
+    cur.execute("""
+        UPDATE contracts c SET total_amount = s.total
+        FROM (SELECT contract_code, SUM(stage_amount) AS total FROM contract_stages GROUP BY contract_code) s
+        WHERE s.contract_code = c.contract_code AND c.total_amount IS NULL
+    """)
+    conn.commit()
+    cur.execute("SELECT refresh_receivables_snapshot(TRUE)")
+    # полный пересчёт снимка уже перестроил распределение оплат; догоняем то, что
+    # могло остаться в allocation_dirty, иначе первый отчёт contract_details у всех
+    # клиентов пересчитал бы его внутри замеряемой операции
+    cur.execute("SELECT refresh_stage_allocations()")
+    cur.execute("SELECT refresh_contracts_detailed_mv()")
+    conn.commit()
+    conn.autocommit = True
+    cur.execute("ANALYZE")
+    conn.close()
+    print("Готово.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест запросов приложения к PostgreSQL")
+    parser.add_argument("--host", default=DB_HOST)
+    parser.add_argument("--port", type=int, default=DB_PORT)
+    parser.add_argument("--dbname", default=DB_NAME)
+    parser.add_argument("--user", default=DB_USER)
+    parser.add_argument("--password", default=DB_PASSWORD)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_seed = sub.add_parser("seed", help="заполнить пустую БД синтетическими данными")
+    p_seed.add_argument("--contracts", type=int, default=20000)
+    p_seed.add_argument("--stages", type=int, default=3, help="этапов на договор")
+    p_seed.add_argument("--payments", type=int, default=3, help="оплат на договор")
+    p_seed.add_argument("--organizations", type=int, default=500)
+    p_seed.add_argument("--years", type=int, default=4, help="за сколько лет даты заключения")
+    p_seed.add_argument("--batch", type=int, default=5000, help="договоров в одной транзакции")
+    p_seed.add_argument("--force", action="store_true", help="добавить, даже если договоры уже есть")
+
+    p_run = sub.add_parser("run", help="запустить нагрузку")
+    p_run.add_argument("--clients", type=int, default=10)
+    p_run.add_argument("--duration", type=float, default=60, help="секунд")
+    p_run.add_argument("--mix", type=parse_mix, default=None,
+                       help="веса операций: open_table=20,reference=30,... (по умолчанию — смесь DEFAULT_MIX)")
+    p_run.add_argument("--processes", action="store_true",
+                       help="клиенты в отдельных процессах (без общего GIL на разбор строк)")
+    p_run.add_argument("--think-ms", type=float, default=0, help="средняя пауза клиента между операциями")
+    p_run.add_argument("--hot", type=int, default=50, help="сколько последних договоров правят клиенты")
+    p_run.add_argument("--lock-sample-ms", type=float, default=100)
+    p_run.add_argument("--seed", type=int, default=1, help="зерно случайной последовательности операций")
+    p_run.add_argument("--json", help="сохранить результаты в файл")
+
+    args = parser.parse_args()
+    conn_kwargs = {"host": args.host, "port": args.port, "dbname": args.dbname,
+                   "user": args.user, "password": args.password}
+    if args.command == "seed":
+        seed(args, conn_kwargs)
+    else:
+        if args.mix is None:
+            args.mix = dict(DEFAULT_MIX)
+        run(args, conn_kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,26 @@
 import customtkinter as ctk
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import RealDictCursor, execute_values
 import tkinter as tk
 from tkinter import ttk, messagebox
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+from config import (DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, SNAPSHOT_PATH, DB_CONNECT_TIMEOUT,
+                    REPORT_PAGE_SIZE, REPORT_CONFIRM_ROWS, STATEMENT_TIMEOUTS, TABLE_CACHE_MB, REPORT_PRESETS_PATH,
+                    REPLICA, REPLICA_RETRY_SECONDS, REPLICA_CATCHUP_WAIT_MS)
+from tables import FIELD_NAMES, TABLE_PKS, REF_MAPPING, MATERIALIZED_SOURCES
+from reports import REPORT_DEFS
+from snapshot_store import SnapshotStore
+import analytics
 from decimal import Decimal, InvalidOperation
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+import json
+import queue
+import re
+import select
+import sys
+import threading
+import time
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
@@ -16,107 +31,877 @@ style.configure("Treeview", background="#2b2b2b", foreground="white", fieldbackg
 style.configure("Treeview.Heading", background="#1f6aa5", foreground="white", font=("Arial", 11, "bold"))
 style.map("Treeview", background=[("selected", "#1f6aa5")])
 
-FIELD_NAMES = {
-    "vat_rates": {
-        "vat_code": "Код",
-        "percentage": "Процент НДС",
-        "description": "Описание"
-    },
-    "contract_types": {
-        "contract_type_code": "Код",
-        "type_name": "Тип договора"
-    },
-    "execution_stages": {
-        "stage_code": "Код",
-        "stage_name": "Стадия"
-    },
-    "payment_types": {
-        "payment_type_code": "Код",
-        "payment_type_name": "Вид оплаты"
-    },
-    "organizations": {
-        "organization_code": "Код",
-        "name": "Наименование",
-        "postal_index": "Индекс",
-        "address": "Адрес",
-        "phone": "Телефон",
-        "fax": "Факс",
-        "inn": "ИНН",
-        "correspondent_account": "Корр. счёт",
-        "bank_name": "Банк",
-        "settlement_account": "Расчётный счет",
-        "okonh": "ОКОНХ",
-        "okpo": "ОКПО",
-        "bik": "БИК",
-        "created_date": "Дата создания",
-        "is_active": "Активна"
-    },
-    "contracts": {
-        "contract_code": "Код",
-        "conclusion_date": "Дата заключения",
-        "customer_code": "Заказчик",
-        "executor_code": "Исполнитель",
-        "contract_type_code": "Тип договора",
-        "execution_stage_code": "Стадия",
-        "vat_code": "НДС",
-        "execution_date": "План. дата",
-        "topic": "Тема",
-        "notes": "Примечание",
-        "total_amount": "Сумма",
-        "created_at": "Создано",
-        "updated_at": "Обновлено"
+# большие справочники: в формах вместо полного списка — поиск по мере ввода
+TYPEAHEAD_TABLES = {"organizations", "contracts"}
+TYPEAHEAD_LIMIT = 20
+
+# таблицы с updated_at и надгробиями в deleted_rows — для них "Обновить"
+# дочитывает только изменения с прошлой отметки
+DELTA_TABLES = {"contracts", "contract_stages", "payments", "organizations"}
+# запас к отметке: NOW() в updated_at — время начала транзакции, и строка
+# долгой транзакции может стать видна позже, чем появились более новые
+WATERMARK_OVERLAP = "1 minute"
+# совпадает с purge_deleted_rows: более старую отметку дельтой не догнать
+TOMBSTONE_RETENTION_DAYS = 7
+
+# полнотекстовый поиск по теме и примечанию (индексы на text_search_tsv)
+FTS_TABLES = {"contracts", "contract_stages"}
+# фрагмент с подсветкой считаем только для лучших по рангу строк
+FTS_HEADLINE_LIMIT = 200
+FTS_HEADLINE_OPTIONS = "StartSel=«, StopSel=», MaxFragments=2, MaxWords=20, MinWords=5"
+# поле отчёта -> индексированный tsvector для оператора "words"
+FTS_FIELD_EXPRS = {"c.topic": "text_search_tsv(c.topic, c.notes)"}
+
+# операторы условий отчёта по типу поля (первый — по умолчанию);
+# in — значения через ";", between — "от; до"
+FILTER_OPS = {
+    "int": ("=", ">=", "<=", "between", "in"),
+    "num": ("=", ">=", "<=", "between", "in"),
+    "date": ("=", ">=", "<=", "between", "in"),
+    "text": ("contains", "starts", "=", "in", "words"),
+}
+# группы условий: внутри группы AND, между группами OR
+FILTER_GROUPS = 5
+
+# Ввод строк списком (BatchEntryGrid): поля строки ввода, обязательные,
+# поля, которые не очищаются после добавления строки (один день выписки,
+# один вид оплаты), поля с датой сегодня по умолчанию, номер по порядку,
+# поля без повторов в пакете, значения вместо пустых и колонка для итога
+BATCH_ENTRY = {
+    "payments": {
+        "fields": ("contract_code", "payment_date", "payment_amount", "payment_type_code", "payment_document_number"),
+        "required": ("contract_code", "payment_date", "payment_amount", "payment_type_code"),
+        "sticky": ("payment_date", "payment_type_code"),
+        "today": ("payment_date",),
+        "counter": None,
+        "unique": (),
+        "fill": {},
+        "total": "payment_amount",
     },
     "contract_stages": {
-        "contract_code": "Код договора",
-        "stage_number": "№ этапа",
-        "stage_execution_date": "Дата этапа",
-        "stage_code": "Стадия",
-        "stage_amount": "Сумма этапа",
-        "advance_amount": "Аванс",
-        "topic": "Тема этапа",
-        "notes": "Примечание"
+        "fields": ("stage_number", "stage_execution_date", "stage_code", "stage_amount", "advance_amount", "topic", "notes"),
+        "required": ("stage_number", "stage_code", "stage_amount"),
+        "sticky": ("stage_code",),
+        "today": (),
+        "counter": "stage_number",
+        "unique": ("stage_number",),
+        "fill": {"advance_amount": Decimal("0")},
+        "total": "stage_amount",
     },
-    "payments": {
-        "payment_id": "Код",
-        "contract_code": "Договор",
-        "payment_date": "Дата платежа",
-        "payment_amount": "Сумма",
-        "payment_type_code": "Вид оплаты",
-        "payment_document_number": "№ документа"
-    }
 }
 
+# рабочие таблицы, у которых есть архив (*_archive) и объединение с ним (*_all)
+ARCHIVED_TABLES = ("contracts", "contract_stages", "payments")
+# договоров в одной транзакции archive_closed_contracts
+ARCHIVE_BATCH_SIZE = 500
+
+# чем заменить NULL в ключе постраничного чтения отчёта (по типу поля);
+# сами NULL упорядочивает отдельная часть ключа "выражение IS NULL"
+KEYSET_NULL_DEFAULTS = {"int": "0", "num": "0", "date": "DATE '0001-01-01'", "text": "''"}
+
+# шаг отчёта "Денежный поток": подпись -> (единица date_trunc, шаг generate_series)
+CASHFLOW_UNITS = {"Месяц": ("month", "1 month"), "Неделя": ("week", "1 week")}
+
+# окно прогресса долгой операции появляется, только если она идёт дольше этого
+PROGRESS_DELAY_MS = 300
+
+# канал NOTIFY, в который пишут триггеры notify_table_change
+CHANGE_CHANNEL = "table_changes"
+CHANGE_POLL_MS = 300
+
 menu_names = {
     "vat_rates": "Ставки НДС", "contract_types": "Типы договоров", "execution_stages": "Стадии",
     "payment_types": "Виды оплаты", "organizations": "Организации", "contracts": "Договоры",
     "contract_stages": "Этапы договоров", "payments": "Платежи"
 }
 
+def connect_db(**overrides):
+    params = dict(host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
+                  user=DB_USER, password=DB_PASSWORD,
+                  connect_timeout=DB_CONNECT_TIMEOUT)
+    params.update(overrides)
+    return psycopg2.connect(**params)
+
+
+class ChangeListener(threading.Thread):
+    """
+    Фоновое соединение, слушающее LISTEN table_changes.
+    Уведомления складываются в очередь, разбирает их главный поток.
+    После переподключения в очередь кладётся None — признак, что часть
+    уведомлений могла потеряться и нужна полная сверка.
+    """
+
+    def __init__(self, out_queue):
+        super().__init__(daemon=True)
+        self.out_queue = out_queue
+        self.stop_event = threading.Event()
+
+    def run(self):
+        first = True
+        while not self.stop_event.is_set():
+            conn = None
+            try:
+                conn = connect_db()
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {CHANGE_CHANNEL}")
+                if not first:
+                    self.out_queue.put(None)
+                first = False
+
+                while not self.stop_event.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        try:
+                            change = json.loads(n.payload)
+                        except ValueError:
+                            continue
+                        change["pid"] = n.pid
+                        self.out_queue.put(change)
+            except Exception:
+                # БД недоступна — пробуем переподключиться чуть позже
+                self.stop_event.wait(5)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class OperationCancelled(Exception):
+    """Долгую операцию отменил пользователь (или уже выполняется другая)."""
+
+
+class AutocompleteEntry(ctk.CTkFrame):
+    """
+    Поле выбора FK с подсказками по мере ввода (app.typeahead).
+    Выбранный элемент хранит свой код, поэтому по тексту ничего не ищется
+    и одинаковые названия не путаются.
+    """
+
+    def __init__(self, master, app, col, width=400):
+        super().__init__(master, fg_color="transparent")
+        self.app = app
+        self.col = col
+        self.code = None
+        self.items = {}  # текст подсказки -> код
+        self.popup = None
+        self.listbox = None
+        self.job = None
+
+        self.entry = ctk.CTkEntry(self, width=width, placeholder_text="начните вводить…")
+        self.entry.pack(fill="x", expand=True)
+        self.entry.bind("<KeyRelease>", self.on_key)
+        self.entry.bind("<Down>", self.focus_list)
+        self.entry.bind("<Escape>", lambda e: self.close_popup())
+        self.entry.bind("<FocusOut>", lambda e: self.after(200, self.close_if_unfocused))
+        self.bind("<Destroy>", lambda e: self.close_popup() if e.widget is self else None, add="+")
+
+    def on_key(self, event):
+        if event.keysym in ("Down", "Up", "Return", "Escape", "Tab"):
+            return
+        self.code = None
+        if self.job is not None:
+            self.after_cancel(self.job)
+        self.job = self.after(250, self.search)
+
+    def search(self):
+        self.job = None
+        text = self.entry.get().strip()
+        if not text:
+            self.close_popup()
+            return
+        found = self.app.typeahead(self.col, text)
+        if found is None:
+            # соединение занято долгой операцией — спросим чуть позже
+            self.job = self.after(250, self.search)
+            return
+        self.items = dict(found)
+        self.show_popup([disp for disp, _ in found])
+
+    def show_popup(self, displays):
+        if not displays:
+            self.close_popup()
+            return
+        if self.popup is None:
+            self.popup = tk.Toplevel(self)
+            self.popup.overrideredirect(True)
+            self.listbox = tk.Listbox(
+                self.popup, bg="#2b2b2b", fg="white", selectbackground="#1f6aa5",
+                activestyle="none", exportselection=False, font=("Arial", 12)
+            )
+            self.listbox.pack(fill="both", expand=True)
+            self.listbox.bind("<ButtonRelease-1>", self.choose)
+            self.listbox.bind("<Return>", self.choose)
+            self.listbox.bind("<Escape>", lambda e: (self.close_popup(), self.entry.focus_set()))
+        self.listbox.delete(0, "end")
+        for disp in displays:
+            self.listbox.insert("end", disp)
+        x = self.entry.winfo_rootx()
+        y = self.entry.winfo_rooty() + self.entry.winfo_height()
+        height = min(len(displays), 8) * 22 + 4
+        self.popup.geometry(f"{self.entry.winfo_width()}x{height}+{x}+{y}")
+        self.popup.lift()
+
+    def focus_list(self, event=None):
+        if self.listbox is None:
+            return
+        self.listbox.focus_set()
+        self.listbox.selection_clear(0, "end")
+        self.listbox.selection_set(0)
+        self.listbox.activate(0)
+
+    def choose(self, event=None):
+        sel = self.listbox.curselection()
+        if not sel:
+            return
+        disp = self.listbox.get(sel[0])
+        self.set_value(self.items[disp], disp)
+        self.close_popup()
+        self.entry.focus_set()
+
+    def close_if_unfocused(self):
+        try:
+            focus = self.focus_get()
+        except (KeyError, tk.TclError):
+            focus = None
+        if focus is None or focus is not self.listbox:
+            self.close_popup()
+
+    def close_popup(self):
+        if self.popup is not None:
+            try:
+                self.popup.destroy()
+            except tk.TclError:
+                pass
+            self.popup = None
+            self.listbox = None
+
+    def set_value(self, code, disp):
+        self.code = code
+        self.entry.delete(0, "end")
+        self.entry.insert(0, disp)
+
+    def set_code(self, code):
+        if code is not None:
+            self.set_value(code, self.app.typeahead_label(self.col, code))
+
+    def get(self):
+        return self.entry.get()
+
+    def get_code(self):
+        if self.code is None:
+            return self.items.get(self.entry.get().strip())
+        return self.code
+
+
+class BatchEntryGrid(ctk.CTkFrame):
+    """
+    Ввод многих строк одной таблицы сеткой (BATCH_ENTRY[table]): внизу
+    строка ввода, Enter проверяет её и добавляет в список, фокус
+    возвращается в первую ячейку. FK вводятся кодом или названием
+    (договор — только кодом) и сверяются со справочниками. Из буфера обмена вставляются строки
+    с ячейками через табуляцию (Excel, банковская выписка); строки с
+    ошибками остаются в списке, помеченные, и исправляются двойным щелчком.
+    """
+
+    def __init__(self, master, app, table, height=12):
+        super().__init__(master)
+        self.app = app
+        self.table = table
+        self.spec = BATCH_ENTRY[table]
+        self.fields = self.spec["fields"]
+        self.items = {}  # iid в дереве -> {"raw": тексты ячеек, "values": dict или None, "error": текст}
+        names = FIELD_NAMES[table]
+
+        tree_frame = ctk.CTkFrame(self, fg_color="transparent")
+        tree_frame.pack(fill="both", expand=True)
+        self.tree = ttk.Treeview(tree_frame, columns=list(self.fields) + ["_error"], show="headings",
+                                 height=height, style="Treeview")
+        for c in self.fields:
+            self.tree.heading(c, text=names.get(c, c))
+            self.tree.column(c, width=110, anchor="w")
+        self.tree.heading("_error", text="Ошибка")
+        self.tree.column("_error", width=240, anchor="w")
+        self.tree.tag_configure("error", foreground="#ff6b6b")
+        self.tree.pack(side="left", fill="both", expand=True)
+        vsb = ctk.CTkScrollbar(tree_frame, command=self.tree.yview)
+        vsb.pack(side="right", fill="y")
+        self.tree.configure(yscrollcommand=vsb.set)
+        self.tree.bind("<Delete>", lambda e: self.remove_selected())
+        self.tree.bind("<Double-1>", lambda e: self.edit_selected())
+        self.tree.bind("<Control-v>", lambda e: self.paste())
+
+        line = ctk.CTkFrame(self, fg_color="transparent")
+        line.pack(fill="x", pady=(6, 0))
+        self.inputs = {}
+        for c in self.fields:
+            cell = ctk.CTkFrame(line, fg_color="transparent")
+            cell.pack(side="left", padx=2, fill="x", expand=True)
+            ctk.CTkLabel(cell, text=names.get(c, c), anchor="w", font=("Arial", 11)).pack(anchor="w")
+            if c in REF_MAPPING:
+                w = app.fk_widget(cell, c, width=140)
+                entry = w.entry if isinstance(w, AutocompleteEntry) else w
+            else:
+                w = entry = ctk.CTkEntry(cell, width=110)
+            w.pack(fill="x")
+            entry.bind("<Return>", lambda e: self.add_from_inputs(), add="+")
+            self.inputs[c] = w
+
+        buttons = ctk.CTkFrame(self, fg_color="transparent")
+        buttons.pack(fill="x", pady=4)
+        ctk.CTkButton(buttons, text="Добавить строку (Enter)", command=self.add_from_inputs).pack(side="left", padx=4)
+        ctk.CTkButton(buttons, text="Вставить из буфера", command=self.paste).pack(side="left", padx=4)
+        ctk.CTkButton(buttons, text="Удалить выбранные", fg_color="#cc3333", hover_color="#aa2222",
+                      command=self.remove_selected).pack(side="left", padx=4)
+        self.status = ctk.CTkLabel(buttons, text="", anchor="w")
+        self.status.pack(side="left", padx=10)
+
+        for c in self.spec["today"]:
+            self.set_input(c, date.today().strftime("%d.%m.%Y"))
+        self.reset_inputs()
+        self.update_status()
+
+    def input_text(self, c):
+        w = self.inputs[c]
+        if isinstance(w, AutocompleteEntry) and w.get_code() is not None:
+            return str(w.get_code())
+        return (w.get() or "").strip()
+
+    def set_input(self, c, text):
+        w = self.inputs[c]
+        if isinstance(w, AutocompleteEntry):
+            w.set_value(None, text)
+        elif isinstance(w, ctk.CTkComboBox):
+            w.set(text)
+        else:
+            w.delete(0, "end")
+            w.insert(0, text)
+
+    def reset_inputs(self):
+        for c in self.fields:
+            if c not in self.spec["sticky"]:
+                self.set_input(c, "")
+        counter = self.spec["counter"]
+        if counter:
+            used = [it["values"][counter] for it in self.items.values() if it["values"]]
+            self.set_input(counter, str(max(used, default=0) + 1))
+
+    def validate(self, raw):
+        """(значения, "") для текстов ячеек строки или (None, текст ошибки)."""
+        names = FIELD_NAMES[self.table]
+        values = {}
+        try:
+            for c, text in zip(self.fields, raw):
+                values[c] = self.app.parse_batch_cell(c, text)
+            missing = [names[c] for c in self.spec["required"] if values[c] is None]
+            if missing:
+                raise ValueError("не заполнено: " + ", ".join(missing))
+            for c, default in self.spec["fill"].items():
+                if values[c] is None:
+                    values[c] = default
+            self.app.check_batch_row(self.table, values)
+            for c in self.spec["unique"]:
+                if any(it["values"] and it["values"][c] == values[c] for it in self.items.values()):
+                    raise ValueError(f"{names[c]} {values[c]} уже есть в списке")
+        except ValueError as e:
+            return None, str(e)
+        return values, ""
+
+    def add_row(self, raw, values, error):
+        iid = self.tree.insert("", "end", values=list(raw) + [error], tags=("error",) if error else ())
+        self.items[iid] = {"raw": list(raw), "values": values, "error": error}
+        return iid
+
+    def add_from_inputs(self):
+        raw = [self.input_text(c) for c in self.fields]
+        if not any(raw):
+            return
+        values, error = self.validate(raw)
+        if error:
+            self.status.configure(text=f"Строка не добавлена: {error}", text_color="#ff6b6b")
+            return
+        self.tree.see(self.add_row(raw, values, ""))
+        self.reset_inputs()
+        self.update_status()
+        first = self.inputs[self.fields[0]]
+        (first.entry if isinstance(first, AutocompleteEntry) else first).focus_set()
+
+    def paste(self):
+        try:
+            text = self.clipboard_get()
+        except tk.TclError:
+            return
+        lines = [[cell.strip() for cell in line.split("\t")] for line in text.splitlines() if line.strip()]
+        lines = [(cells + [""] * len(self.fields))[:len(self.fields)] for cells in lines]
+        # коды и названия больших справочников проверяем одним запросом на всю вставку
+        for i, c in enumerate(self.fields):
+            if c in REF_MAPPING and not self.app.busy:
+                codes = [int(cells[i]) for cells in lines if cells[i].isdigit()]
+                self.app.known_fk_codes(c, codes)
+                names = [cells[i] for cells in lines
+                         if cells[i] and not cells[i].isdigit() and not re.fullmatch(r".*\[(\d+)\]", cells[i])]
+                if names and c != "contract_code":
+                    self.app.fk_codes_by_name(c, names)
+        for cells in lines:
+            self.add_row(cells, *self.validate(cells))
+        self.reset_inputs()
+        self.update_status()
+
+    def edit_selected(self):
+        # строка уходит из списка обратно в строку ввода
+        sel = self.tree.selection()
+        if not sel:
+            return
+        item = self.items.pop(sel[0])
+        self.tree.delete(sel[0])
+        for c, text in zip(self.fields, item["raw"]):
+            self.set_input(c, text)
+        self.update_status()
+
+    def remove_selected(self):
+        for iid in self.tree.selection():
+            self.items.pop(iid, None)
+            self.tree.delete(iid)
+        self.update_status()
+
+    def rows(self):
+        # проверенные строки в порядке списка
+        return [dict(self.items[iid]["values"]) for iid in self.tree.get_children() if self.items[iid]["values"]]
+
+    def error_count(self):
+        return sum(1 for it in self.items.values() if it["error"])
+
+    def update_status(self):
+        rows = self.rows()
+        total = sum(r[self.spec["total"]] or 0 for r in rows)
+        text = f"Строк: {len(rows)}, сумма: {total:,.2f}".replace(",", " ")
+        errors = self.error_count()
+        if errors:
+            text += f", с ошибками: {errors}"
+        self.status.configure(text=text, text_color="#ff6b6b" if errors else ("gray10", "gray90"))
+
+
+class PreparedStatements:
+    """
+    Реестр серверных подготовленных операторов (PREPARE/EXECUTE).
+    Запрос с %s-параметрами готовится один раз на каждом соединении
+    (основное, слушатель, пул, реплика — различаются по объекту и backend pid),
+    дальше выполняется через EXECUTE без повторного разбора и планирования.
+    На соединении держится не больше max_per_conn операторов, лишние
+    вытесняются по LRU через DEALLOCATE. Реестр текстов ограничен так же:
+    у отчётов текст меняется с условиями и сортировкой, и без предела он
+    рос бы всё время жизни программы.
+    """
+
+    def __init__(self, max_per_conn=200):
+        self.max_per_conn = max_per_conn
+        self.names = OrderedDict()  # текст запроса -> имя оператора, по LRU
+        self.counter = 0  # имена не переиспользуются: вытесненный текст может ещё жить на соединениях
+        self.prepared = {}  # (id соединения, pid) -> OrderedDict имён
+        self.stats = {"prepares": 0, "executes": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def to_dollar(sql):
+        # %s -> $1, $2, ...; %% -> % (PREPARE уходит на сервер без подстановки)
+        out, n = [], 0
+        for part in re.split(r"(%%|%s)", sql):
+            if part == "%s":
+                n += 1
+                out.append(f"${n}")
+            elif part == "%%":
+                out.append("%")
+            else:
+                out.append(part)
+        return "".join(out), n
+
+    def execute(self, cursor, sql, params=()):
+        sql = sql.strip().rstrip(";")
+        conn = cursor.connection
+        key = (id(conn), conn.get_backend_pid())
+        with self.lock:
+            name = self.names.get(sql)
+            if name is None:
+                self.counter += 1
+                name = self.names[sql] = f"ps_{self.counter}"
+                if len(self.names) > self.max_per_conn:
+                    self.names.popitem(last=False)
+            else:
+                self.names.move_to_end(sql)
+            on_conn = self.prepared.setdefault(key, OrderedDict())
+            ready = name in on_conn
+            if ready:
+                on_conn.move_to_end(name)
+
+        body, n = self.to_dollar(sql)
+        if not ready:
+            cursor.execute(f"PREPARE {name} AS {body}")
+            evicted = []
+            with self.lock:
+                on_conn[name] = None
+                self.stats["prepares"] += 1
+                while len(on_conn) > self.max_per_conn:
+                    evicted.append(on_conn.popitem(last=False)[0])
+                    self.stats["evictions"] += 1
+            for old in evicted:
+                cursor.execute(f"DEALLOCATE {old}")
+
+        with self.lock:
+            self.stats["executes"] += 1
+        if n:
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * n)})", list(params))
+        else:
+            cursor.execute(f"EXECUTE {name}")
+
+    def forget(self, conn):
+        # соединение закрыто или сброшено пулом (DISCARD ALL) — операторов на нём больше нет
+        with self.lock:
+            for key in [k for k in self.prepared if k[0] == id(conn)]:
+                del self.prepared[key]
+
+    def summary(self):
+        with self.lock:
+            return dict(self.stats, statements=len(self.names),
+                        connections=len(self.prepared))
+
+
 class DatabaseApp(ctk.CTk):
     def __init__(self):
         super().__init__()
         self.title("Система управления договорами")
         self.geometry("1500x900")
 
-        try:
-            self.conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
-                                        user=DB_USER, password=DB_PASSWORD)
-            self.cursor = self.conn.cursor(cursor_factory=RealDictCursor)
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Нет подключения к БД:\n{e}")
-            raise
+        self.conn = None
+        self.cursor = None
+        self.snapshot = SnapshotStore(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+        if self.snapshot is None:
+            # без снимка показывать нечего — подключаемся сразу, как раньше
+            try:
+                self.set_connection(connect_db())
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Нет подключения к БД:\n{e}")
+                raise
 
         self.current_table = None
         self.data = []
         self.filtered_data = []
-        self.reference_cache = {}  
-        self.sort_states = {}  
+        self.data_source = None  # откуда прочитаны self.data: таблица или витрина
+        self.row_index = {}  # iid (строка из PK) -> строка данных
+        self.search_index = {}  # iid -> текст строки для поиска
+        self.fts_key = None  # (таблица, запрос), для которых получены fts_hits
+        self.fts_hits = OrderedDict()  # iid -> фрагмент с подсветкой, по убыванию ранга
+        self.fts_job = None
+        self.watermarks = {}  # таблица -> время сервера на момент последней сверки
+        self.reference_cache = self.snapshot.load_references() if self.snapshot else {}
+        self.stmts = PreparedStatements()  # горячие запросы через PREPARE/EXECUTE
+        self.typeahead_cache = OrderedDict()  # (таблица, поле, текст) -> подсказки
+        self.fk_known = {}  # большой справочник -> коды, существование которых уже проверено
+        self.fk_names = {}  # большой справочник -> {название: [коды]} для ввода списком
+        self.sort_spec = []  # [(колонка, по убыванию)] — ключ сортировки
+        self.sort_keys = {}  # колонка -> ключи сортировки по индексам self.data
+        self.sort_cache = {}  # tuple(sort_spec) -> перестановка индексов self.data
+        self.table_cache = OrderedDict()  # таблица -> состояние недавно открытой таблицы (LRU)
+        self.open_reports = []  # открытые окна отчётов, которые надо обновлять
+        self.cashflow_cache = {}  # (единица, с архивом, начало периода) -> (план, факт) закрытых периодов
+        self.totals_job = None
+        self.connect_job = None
+        self.busy = False  # идёт долгая операция на self.conn (см. _run_cancellable)
+        # реплика для чтения (REPLICA) и позиция WAL последней своей записи
+        self.replica = None
+        self.replica_retry_at = 0
+        self.write_lsn = None
+        self.snapshot_saves = []  # фоновые записи снимка, дождаться при выходе
 
         self.create_widgets()
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+        # ---- живая лента изменений от других пользователей ----
+        self.change_queue = queue.Queue()
+        self.listener = None
+        self.change_job = None
+
+        if self.conn is not None:
+            self.go_online()
+        else:
+            # сначала показываем последнюю таблицу из снимка, БД догоняем в фоне
+            last = self.snapshot.get_meta("last_table")
+            if last in FIELD_NAMES:
+                self.load_table(last)
+            self.connect_in_background()
+
+    def set_connection(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor(cursor_factory=RealDictCursor)
+
+    def connect_replica(self):
+        """Подключает реплику из REPLICA; если она недоступна — повтор не раньше чем через REPLICA_RETRY_SECONDS."""
+        if self.replica is not None and self.replica.closed:
+            self.drop_replica()
+        if not REPLICA or self.replica is not None or time.monotonic() < self.replica_retry_at:
+            return
+        try:
+            replica = connect_db(**REPLICA)
+            replica.autocommit = True
+        except Exception:
+            self.replica_retry_at = time.monotonic() + REPLICA_RETRY_SECONDS
+            return
+        self.replica = replica
+
+    def drop_replica(self):
+        if self.replica is None:
+            return
+        self.stmts.forget(self.replica)
+        try:
+            self.replica.close()
+        except Exception:
+            pass
+        self.replica = None
+        self.replica_retry_at = time.monotonic() + REPLICA_RETRY_SECONDS
+
+    def note_write(self):
+        # позиция WAL после своей записи (или после чужой, о которой пришло
+        # уведомление): пока реплика её не догнала, читаем с основного
+        if self.replica is None:
+            return
+        try:
+            self.cursor.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+            self.write_lsn = self.cursor.fetchone()["lsn"]
+            self.conn.commit()
+        except Exception:
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+            # позицию не узнать — читаем с основного, пока реплику не переподключим
+            self.drop_replica()
+
+    def reader(self, wait=None):
+        """
+        (соединение, курсор) для чтения: реплика, если она есть и уже видит
+        свои записи, иначе основное соединение. wait — подождать реплику
+        до REPLICA_CATCHUP_WAIT_MS; по умолчанию ждём только в рабочем потоке
+        _run_cancellable, а в потоке Tk (перезапрос открытого отчёта по
+        уведомлению, "Загрузить ещё", итоги) сразу читаем с основного.
+        Курсор реплики новый на каждый вызов: рабочий поток _run_cancellable
+        и поток Tk не должны делить один курсор.
+        """
+        if wait is None:
+            wait = threading.current_thread() is not threading.main_thread()
+        if self.replica is None or self.replica.closed:
+            return self.conn, self.cursor
+        try:
+            cur = self.replica.cursor(cursor_factory=RealDictCursor)
+            if self.write_lsn is not None:
+                deadline = time.monotonic() + (REPLICA_CATCHUP_WAIT_MS / 1000 if wait else 0)
+                while True:
+                    cur.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn AS caught_up", (self.write_lsn,))
+                    if cur.fetchone()["caught_up"]:
+                        self.write_lsn = None
+                        break
+                    if time.monotonic() >= deadline:
+                        return self.conn, self.cursor
+                    time.sleep(0.05)
+        except psycopg2.Error:
+            self.drop_replica()
+            return self.conn, self.cursor
+        return self.replica, cur
+
+    def connect_in_background(self):
+        """Подключение к БД в отдельном потоке, чтобы окно не висело на таймауте."""
+        result = queue.Queue()
+
+        def worker():
+            try:
+                result.put(connect_db())
+            except Exception as e:
+                result.put(e)
+
+        def check():
+            try:
+                res = result.get_nowait()
+            except queue.Empty:
+                self.connect_job = self.after(100, check)
+                return
+            if isinstance(res, Exception):
+                self.status_lbl.configure(text=self.offline_text())
+                # повторяем попытку, пока пользователь смотрит снимок
+                self.connect_job = self.after(30000, self.connect_in_background)
+                return
+            self.connect_job = None
+            self.set_connection(res)
+            self.go_online()
+
+        threading.Thread(target=worker, daemon=True).start()
+        self.connect_job = self.after(100, check)
+
+    def offline_text(self):
+        text = "Нет связи с БД — только просмотр"
+        saved_at = self.snapshot.saved_at(self.current_table) if self.current_table and self.snapshot else None
+        if saved_at:
+            text += f" (снимок от {saved_at.strftime('%d.%m.%Y %H:%M')})"
+        return text
+
+    def go_online(self):
+        self.status_lbl.configure(text="")
+        # справочники из снимка могли устареть — перечитаем по мере надобности
+        self.reference_cache.clear()
+        self.listener = ChangeListener(self.change_queue)
+        self.listener.start()
+        self.connect_replica()
+        self.change_job = self.after(CHANGE_POLL_MS, self.process_changes)
+        if self.current_table:
+            # таблица показана из снимка — дочитываем то, что изменилось с тех пор
+            self.refresh()
+
+    def _run_cancellable(self, kind, title, fn, conn=None):
+        """
+        Выполняет fn() в рабочем потоке (только работа с БД, без Tk) и ждёт её,
+        не замораживая окно. Если операция затянулась, показывает прогресс
+        с прошедшим временем и кнопкой "Отменить" (conn.cancel()).
+        На время операции действует statement_timeout из STATEMENT_TIMEOUTS[kind].
+        Возвращает результат fn или пробрасывает её исключение;
+        отмена пользователем — OperationCancelled.
+        """
+        if self.busy:
+            raise OperationCancelled()
+        if conn is not None:
+            conns = [conn]
+        else:
+            # fn может читать с реплики (см. reader) — таймаут и отмена действуют на оба соединения
+            self.connect_replica()
+            conns = [c for c in (self.conn, self.replica) if c is not None]
+        self.busy = True
+        outcome = {}
+        cancelled = []
+        started = time.monotonic()
+
+        def worker():
+            try:
+                for c in conns:
+                    c.cursor().execute("SET statement_timeout = %s", (STATEMENT_TIMEOUTS.get(kind, 0),))
+                outcome["result"] = fn()
+            except Exception as e:
+                outcome["error"] = e
+            outcome["done"] = True
+
+        dlg = ctk.CTkToplevel(self)
+        dlg.withdraw()
+        dlg.title("Выполняется")
+        dlg.geometry("380x170")
+        ctk.CTkLabel(dlg, text=title, font=("Arial", 15, "bold")).pack(pady=(20, 5))
+        time_lbl = ctk.CTkLabel(dlg, text="", font=("Arial", 13))
+        time_lbl.pack(pady=5)
+
+        def cancel():
+            if cancelled:
+                return
+            cancelled.append(True)
+            cancel_btn.configure(state="disabled", text="Отменяется...")
+            for c in conns:
+                try:
+                    c.cancel()
+                except Exception:
+                    pass
+
+        cancel_btn = ctk.CTkButton(dlg, text="Отменить", fg_color="#aa3333", command=cancel)
+        cancel_btn.pack(pady=10)
+        dlg.protocol("WM_DELETE_WINDOW", cancel)
+
+        def tick():
+            if "done" in outcome:
+                dlg.destroy()
+                return
+            elapsed = time.monotonic() - started
+            if elapsed * 1000 >= PROGRESS_DELAY_MS and dlg.state() == "withdrawn":
+                dlg.deiconify()
+                dlg.after(50, lambda: dlg.winfo_exists() and dlg.grab_set())
+            time_lbl.configure(text=f"Прошло: {elapsed:.1f} с")
+            dlg.after(100, tick)
+
+        threading.Thread(target=worker, daemon=True).start()
+        dlg.after(20, tick)
+        self.wait_window(dlg)
+        self.busy = False
+
+        # после ошибки транзакция прервана — откатываем, затем возвращаем таймаут по умолчанию
+        for c in conns:
+            if "error" in outcome:
+                try:
+                    c.rollback()
+                except Exception:
+                    pass
+            try:
+                c.cursor().execute("RESET statement_timeout")
+            except Exception:
+                try:
+                    c.rollback()
+                except Exception:
+                    pass
+        if "error" in outcome:
+            if cancelled and isinstance(outcome["error"], psycopg2.extensions.QueryCanceledError):
+                raise OperationCancelled()
+            raise outcome["error"]
+        return outcome["result"]
+
+    def require_online(self):
+        if self.conn is None:
+            messagebox.showwarning("Нет связи с БД",
+                                   "Подключение к базе данных ещё не установлено.\n"
+                                   "Доступен только просмотр сохранённых данных.")
+            return False
+        if self.busy:
+            # идёт долгая операция (_run_cancellable), а окно прогресса ещё не
+            # появилось и не перехватило ввод: соединение не трогаем
+            self.bell()
+            return False
+        return True
+
+    def save_snapshot(self, wait=False):
+        # снимок текущей таблицы. Строки копируем: они остаются в LRU-кэше
+        # (stash_table), и при быстром возврате к таблице дельта правит их на
+        # месте, пока фоновый поток ещё сериализует снимок
+        table = self.current_table
+        if not (self.snapshot and self.conn is not None and table and self.data):
+            return
+        rows = [dict(r) for r in self.data]
+        args = (table, rows, self.watermarks.get(table), self.data_source)
+        if wait:
+            self.snapshot.save_table(*args)
+            return
+        saver = threading.Thread(target=self.snapshot.save_table, args=args, daemon=True)
+        saver.start()
+        self.snapshot_saves = [t for t in self.snapshot_saves if t.is_alive()] + [saver]
+
     def on_closing(self):
+        if self.listener is not None:
+            self.listener.stop()
+        for job in (self.change_job, self.totals_job, self.connect_job):
+            try:
+                self.after_cancel(job)
+            except Exception:
+                pass
+        if self.snapshot:
+            try:
+                self.save_snapshot(wait=True)
+                for saver in self.snapshot_saves:
+                    saver.join()
+                if self.conn is not None:
+                    self.snapshot.save_references(self.reference_cache)
+                if self.current_table:
+                    self.snapshot.set_meta("last_table", self.current_table)
+            except Exception:
+                # снимок — только ускорение, из-за него окно не должно зависать
+                pass
+        self.drop_replica()
         if self.conn:
+            self.stmts.forget(self.conn)
             self.conn.close()
         self.destroy()
 
@@ -126,9 +911,9 @@ class DatabaseApp(ctk.CTk):
         container.pack(fill="both", expand=True)
 
         # ========== ЛЕВОЕ МЕНЮ ==========
-        menu_frame = ctk.CTkFrame(container, width=260)
+        # меню с прокруткой: разделы отчётов и сервиса не влезают по высоте
+        menu_frame = ctk.CTkScrollableFrame(container, width=240)
         menu_frame.pack(side="left", fill="y")
-        menu_frame.pack_propagate(False)
 
         ctk.CTkLabel(
             menu_frame, 
@@ -174,6 +959,65 @@ class DatabaseApp(ctk.CTk):
             command=self.report_actual
         ).pack(fill="x", padx=15, pady=3)
 
+        ctk.CTkButton(
+            menu_frame, text="Дебиторка по срокам",
+            height=40, fg_color="#6c47ff", hover_color="#5538cc",
+            font=("Arial", 14),
+            command=self.report_aging
+        ).pack(fill="x", padx=15, pady=3)
+
+        ctk.CTkButton(
+            menu_frame, text="Денежный поток план/факт",
+            height=40, fg_color="#6c47ff", hover_color="#5538cc",
+            font=("Arial", 14),
+            command=self.report_cashflow
+        ).pack(fill="x", padx=15, pady=3)
+
+        ctk.CTkButton(
+            menu_frame, text="Аналитика оплат",
+            height=40, fg_color="#6c47ff", hover_color="#5538cc",
+            font=("Arial", 14),
+            command=self.report_analytics
+        ).pack(fill="x", padx=15, pady=3)
+
+        # --- секция обслуживания ---
+        ctk.CTkLabel(menu_frame, text="Сервис", font=("Arial", 16, "bold")).pack(pady=(25, 5))
+
+        ctk.CTkButton(
+            menu_frame, text="Пересчитать дебиторку",
+            height=36, fg_color="#555", hover_color="#444",
+            font=("Arial", 13),
+            command=self.rebuild_receivables
+        ).pack(fill="x", padx=15, pady=3)
+
+        ctk.CTkButton(
+            menu_frame, text="Обновить витрину договоров",
+            height=36, fg_color="#555", hover_color="#444",
+            font=("Arial", 13),
+            command=self.refresh_materialized
+        ).pack(fill="x", padx=15, pady=3)
+
+        ctk.CTkButton(
+            menu_frame, text="Секции платежей",
+            height=36, fg_color="#555", hover_color="#444",
+            font=("Arial", 13),
+            command=self.maintain_payment_partitions
+        ).pack(fill="x", padx=15, pady=3)
+
+        ctk.CTkButton(
+            menu_frame, text="Диагностика",
+            height=36, fg_color="#555", hover_color="#444",
+            font=("Arial", 13),
+            command=self.show_diagnostics
+        ).pack(fill="x", padx=15, pady=3)
+
+        ctk.CTkButton(
+            menu_frame, text="Архивировать закрытые",
+            height=36, fg_color="#555", hover_color="#444",
+            font=("Arial", 13),
+            command=self.archive_closed_contracts
+        ).pack(fill="x", padx=15, pady=3)
+
 
         # ========== ПРАВАЯ РАБОЧАЯ ОБЛАСТЬ ==========
         content = ctk.CTkFrame(container)
@@ -186,6 +1030,8 @@ class DatabaseApp(ctk.CTk):
             font=("Arial", 24, "bold")
         )
         self.lbl.pack(pady=15)
+        self.status_lbl = ctk.CTkLabel(content, text="", text_color="#e0a030", font=("Arial", 13))
+        self.status_lbl.pack()
 
         # ---------- ПОИСК И ФИЛЬТР ----------
         filter_frame = ctk.CTkFrame(content)
@@ -196,7 +1042,10 @@ class DatabaseApp(ctk.CTk):
         self.search_entry = ctk.CTkEntry(filter_frame, textvariable=self.search_var, width=260)
         self.search_entry.pack(side="left", padx=10)
         self.search_entry.bind("<KeyRelease>", lambda e: self.apply_filters())
-
+        self.fts_var = tk.BooleanVar(value=False)
+        ctk.CTkCheckBox(
+            filter_frame, text="По словам", variable=self.fts_var, command=self.apply_filters
+        ).pack(side="left", padx=5)
 
         ctk.CTkLabel(filter_frame, text="Фильтр:", font=("Arial", 14)).pack(side="left", padx=15)
         self.filter_col = ctk.CTkComboBox(filter_frame, width=200, values=[])
@@ -205,18 +1054,32 @@ class DatabaseApp(ctk.CTk):
         self.filter_val.pack(side="left", padx=10)
         self.filter_val.bind("<KeyRelease>", lambda e: self.apply_filters())
 
+        self.use_mv_var = tk.BooleanVar(value=True)
+        ctk.CTkCheckBox(
+            filter_frame, text="Имена из витрины", variable=self.use_mv_var,
+            command=lambda: self.current_table in MATERIALIZED_SOURCES and self.load_table(self.current_table)
+        ).pack(side="left", padx=10)
+
 
         # ---------- ТАБЛИЦА ----------
         table_frame = ctk.CTkFrame(content)
         table_frame.pack(fill="both", expand=True)
 
-        self.tree = ttk.Treeview(table_frame, style="Treeview", show="headings")
+        self.tree = ttk.Treeview(table_frame, style="Treeview", show="headings", selectmode="extended")
         self.tree.pack(side="left", fill="both", expand=True)
+        self.tree.bind("<Shift-Button-1>", self.on_tree_shift_click)
+        self.tree.bind("<<TreeviewSelect>>", lambda e: self.show_fts_snippet())
 
         vsb = ctk.CTkScrollbar(table_frame, command=self.tree.yview)
         vsb.pack(side="right", fill="y")
         self.tree.configure(yscrollcommand=vsb.set)
 
+        # ---------- ИТОГИ ПО ФИЛЬТРУ ----------
+        self.totals_lbl = ctk.CTkLabel(content, text="", anchor="w", font=("Arial", 13))
+        self.totals_lbl.pack(fill="x", padx=10, pady=(6, 0))
+        self.fts_lbl = ctk.CTkLabel(content, text="", anchor="w", justify="left", font=("Arial", 13))
+        self.fts_lbl.pack(fill="x", padx=10)
+
 
         # ---------- КНОПКИ ДЕЙСТВИЙ ----------
         btns = ctk.CTkFrame(content)
@@ -225,6 +1088,9 @@ class DatabaseApp(ctk.CTk):
         ctk.CTkButton(btns, text="Добавить", height=40, fg_color="green",
                       font=("Arial", 14), command=self.add_record).pack(side="left", padx=8)
 
+        ctk.CTkButton(btns, text="Ввод списком", height=40, fg_color="green",
+                      font=("Arial", 14), command=self.batch_entry).pack(side="left", padx=8)
+
         ctk.CTkButton(btns, text="Изменить", height=40,
                       font=("Arial", 14), command=self.edit_record).pack(side="left", padx=8)
 
@@ -236,26 +1102,58 @@ class DatabaseApp(ctk.CTk):
                       font=("Arial", 14), command=self.refresh).pack(side="left", padx=8)
 
 
-    def load_table(self, table):
+    def load_table(self, table, fresh=False):
         if table not in FIELD_NAMES:
             messagebox.showerror("Ошибка", "Неизвестная таблица")
             return
+        if self.busy:
+            return
 
+        switching = table != self.current_table
+        if switching:
+            self.save_snapshot()
+            self.stash_table()
         self.current_table = table
         self.lbl.configure(text=f"Таблица: {menu_names[table]}")
+        if switching and not fresh and self.restore_table(table):
+            return
         try:
-            self.cursor.execute(f"SELECT * FROM {table}")
-            rows = self.cursor.fetchall()
-            self.data = []
-            for row in rows:
-                if isinstance(row, dict):
-                    self.data.append(dict(row))
-                else:
-                    keys = [desc[0] for desc in self.cursor.description]
-                    self.data.append(dict(zip(keys, row)))
+            rows = None
+            from_snapshot = False
+            source = self.display_source(table)
+            if self.snapshot and not fresh and (self.conn is None or table in DELTA_TABLES):
+                # из снимка открывается мгновенно; на связи — затем догоняем дельтой
+                snap = self.snapshot.load_table(table)
+                if snap is not None and (self.conn is None or snap[1] is not None):
+                    if self.conn is None or snap[2] == source:
+                        rows, watermark, source = snap[0], snap[1], snap[2]
+                        from_snapshot = True
+            if rows is None and self.conn is None:
+                raise RuntimeError("нет связи с БД, а в локальном снимке этой таблицы нет")
+            if rows is None:
+                rows, watermark, source = self._run_cancellable(
+                    "load", f"Загрузка: {menu_names[table]}", lambda: self.read_source(table, source))
+            self.data = rows
+            self.data_source = source
+            self.sort_spec = []
+            self.invalidate_sort()
+            self.row_index = {self.row_iid(r): r for r in self.data}
+            self.search_index = {}
+            self.fts_key = None
+            self.fts_lbl.configure(text="")
+            if watermark is not None:
+                self.watermarks[table] = watermark
             self.filtered_data = self.data.copy()
             self.setup_tree()
             self.populate_tree()
+            self.schedule_totals()
+            if self.conn is None:
+                self.status_lbl.configure(text=self.offline_text())
+            elif source != table or from_snapshot:
+                # догоняем изменения, сделанные после пересчёта витрины или сохранения снимка
+                if not self.delta_refresh(table):
+                    self.load_table(table, fresh=True)
+                    return
 
             # setup filter_col values to Russian names
             rus_fields = list(FIELD_NAMES.get(self.current_table, {}).values())
@@ -267,9 +1165,262 @@ class DatabaseApp(ctk.CTk):
                 self.conn.rollback()
             except:
                 pass
-            messagebox.showerror("Ошибка загрузки", f"Не удалось загрузить таблицу {table}:\n{e}")
+            if isinstance(e, OperationCancelled):
+                self.tree.delete(*self.tree.get_children())
+            else:
+                messagebox.showerror("Ошибка загрузки", f"Не удалось загрузить таблицу {table}:\n{e}")
             self.data = []
             self.filtered_data = []
+            self.row_index = {}
+            self.search_index = {}
+            self.sort_spec = []
+            self.invalidate_sort()
+
+    def stash_table(self):
+        """Кладёт открытую таблицу в LRU-кэш вместе с сортировкой, фильтрами и индексами."""
+        table = self.current_table
+        if not table or not self.data:
+            return
+        self.table_cache[table] = {
+            "data": self.data,
+            "data_source": self.data_source,
+            "row_index": self.row_index,
+            "search_index": self.search_index,
+            "sort_spec": self.sort_spec,
+            "sort_keys": self.sort_keys,
+            "sort_cache": self.sort_cache,
+            "filters": (self.search_var.get(), self.filter_col.get(), self.filter_val.get()),
+            "size": self.estimate_table_size(),
+        }
+        self.table_cache.move_to_end(table)
+        budget = TABLE_CACHE_MB * 1024 * 1024
+        while self.table_cache and sum(e["size"] for e in self.table_cache.values()) > budget:
+            self.table_cache.popitem(last=False)
+
+    def estimate_table_size(self):
+        # средний размер строки по выборке × число строк; индексы, текст
+        # поиска и ключи сортировки — примерно столько же сверху
+        if not self.data:
+            return 0
+        sample = self.data[::max(1, len(self.data) // 50)][:50]
+        per_row = sum(sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r.values()) for r in sample) / len(sample)
+        return int(per_row * len(self.data) * 2)
+
+    def restore_table(self, table):
+        """Показывает таблицу из LRU-кэша и догоняет её дельтой. False — в кэше её нет."""
+        entry = self.table_cache.pop(table, None)
+        if entry is None:
+            return False
+        self.data = entry["data"]
+        self.data_source = entry["data_source"]
+        self.row_index = entry["row_index"]
+        self.search_index = entry["search_index"]
+        self.sort_spec = entry["sort_spec"]
+        self.sort_keys = entry["sort_keys"]
+        self.sort_cache = entry["sort_cache"]
+
+        self.setup_tree()
+        self.update_sort_headings()
+        search, col, val = entry["filters"]
+        self.search_var.set(search)
+        self.filter_col.configure(values=list(FIELD_NAMES[table].values()))
+        self.filter_col.set(col)
+        self.filter_val.delete(0, "end")
+        self.filter_val.insert(0, val)
+        self.apply_filters()
+
+        if self.conn is None:
+            self.status_lbl.configure(text=self.offline_text())
+        elif table in self.watermarks:
+            try:
+                if not self.delta_refresh(table):
+                    self.load_table(table, fresh=True)
+            except Exception as e:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+                messagebox.showerror("Ошибка загрузки", f"Не удалось обновить таблицу {table}:\n{e}")
+        return True
+
+    def drop_cached_tables(self, tables=None):
+        # без updated_at таблицу дельтой не догнать — при возврате читаем заново
+        for table in list(self.table_cache):
+            if table not in DELTA_TABLES and (tables is None or table in tables):
+                del self.table_cache[table]
+
+    def display_source(self, table):
+        # откуда читать таблицу для показа: витрина с готовыми именами или сама таблица
+        mv = MATERIALIZED_SOURCES.get(table)
+        if mv and self.use_mv_var.get():
+            return mv[0]
+        return table
+
+    def live_source(self, table):
+        # откуда дочитывать изменённые строки: если таблица показана из витрины —
+        # из представления с теми же именами, иначе из самой таблицы
+        mv = MATERIALIZED_SOURCES.get(table)
+        if mv and table == self.current_table and self.data_source == mv[0]:
+            return mv[1]
+        return table
+
+    def with_display_names(self, table, rows):
+        """Строки своей записи (RETURNING *) — с именами, если таблица показана из витрины."""
+        if not rows or self.live_source(table) == table:
+            return rows
+        pks = [{c: r[c] for c in TABLE_PKS[table]} for r in rows]
+        return self.fetch_rows_by_pk(table, pks)
+
+    def drop_named_tables(self, ref_tables):
+        # имена в витрине — копии из справочников, дельта по updated_at их
+        # переименования не увидит: такую таблицу из кэша не берём
+        for table, (mv, _, names) in MATERIALIZED_SOURCES.items():
+            entry = self.table_cache.get(table)
+            if entry and entry["data_source"] == mv and any(REF_MAPPING[c][0] in ref_tables for c in names):
+                del self.table_cache[table]
+
+    def read_source(self, table, source):
+        """(строки, отметка, откуда прочитано): витрина, а если её нет или не догнать — сама таблица."""
+        conn, cur = self.reader()
+        if conn is not self.conn and self.server_clock(cur) is None:
+            # реплика с запуска не воспроизвела ни одной транзакции — отметки для дельты нет
+            conn, cur = self.conn, self.cursor
+        if source != table:
+            try:
+                rows, watermark = self.read_rows(cur, table, source)
+                if rows is not None:
+                    return rows, watermark, source
+            except psycopg2.Error as e:
+                if isinstance(e, psycopg2.extensions.QueryCanceledError):
+                    raise
+                # витрины нет в этой БД — читаем саму таблицу
+                conn.rollback()
+        rows, watermark = self.read_rows(cur, table, table)
+        return rows, watermark, table
+
+    def read_rows(self, cur, table, source):
+        """
+        Строки из source и отметка времени для дельта-обновления.
+        Для витрины отметка — момент её пересчёта; (None, None), если витрина
+        устарела сильнее, чем хранятся надгробия, и дельтой её не догнать.
+        """
+        if source != table:
+            cur.execute("SELECT refreshed_at FROM mv_refresh_state WHERE view_name = %s", (source,))
+            state = cur.fetchone()
+            if state is None or (self.server_clock(cur) - state["refreshed_at"]).days >= TOMBSTONE_RETENTION_DAYS:
+                return None, None
+            watermark = state["refreshed_at"]
+        else:
+            watermark = self.server_clock(cur) if table in DELTA_TABLES else None
+        cur.execute(f"SELECT * FROM {source}")
+        return [dict(r) for r in cur.fetchall()], watermark
+
+    def show_diagnostics(self):
+        if not self.require_online():
+            return
+        # счётчики реестра PREPARE и статистика планов из pg_prepared_statements
+        stats = self.stmts.summary()
+        header = (f"Подготовлено: {stats['prepares']}   Выполнений: {stats['executes']}   "
+                  f"Вытеснено: {stats['evictions']}   Запросов в реестре: {stats['statements']}   "
+                  f"Соединений: {stats['connections']}")
+        try:
+            self.cursor.execute("""
+                SELECT name AS "Оператор", generic_plans AS "Generic-планов",
+                       custom_plans AS "Custom-планов", prepare_time AS "Подготовлен",
+                       left(statement, 120) AS "Запрос"
+                FROM pg_prepared_statements
+                ORDER BY generic_plans + custom_plans DESC
+            """)
+        except psycopg2.Error:
+            # до PostgreSQL 14 счётчиков планов нет
+            self.conn.rollback()
+            self.cursor.execute("""
+                SELECT name AS "Оператор", prepare_time AS "Подготовлен",
+                       left(statement, 120) AS "Запрос"
+                FROM pg_prepared_statements
+                ORDER BY prepare_time
+            """)
+        rows = self.cursor.fetchall()
+        self.show_report("Диагностика: подготовленные запросы", rows, totals=header)
+
+    def maintain_payment_partitions(self):
+        if not self.require_online():
+            return
+        try:
+            n = self._run_cancellable("service", "Секции платежей",
+                                      lambda: self.call_service("SELECT ensure_payment_partitions() AS n"))
+            messagebox.showinfo("Секции платежей", f"Создано новых секций: {n}")
+        except OperationCancelled:
+            pass
+        except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            messagebox.showerror("Ошибка", str(e))
+
+    def archive_closed_contracts(self):
+        if not self.require_online():
+            return
+        if not messagebox.askyesno(
+                "Архив", "Перенести в архив договоры, исполненные более года назад и оплаченные полностью?"):
+            return
+        # процедура сама фиксирует каждую пачку, а COMMIT внутри CALL возможен
+        # только вне транзакции — поэтому отдельное соединение в autocommit
+        conn = None
+        try:
+            conn = connect_db()
+            conn.autocommit = True
+            cur = conn.cursor()
+
+            def run():
+                cur.execute("CALL archive_closed_contracts(%s)", (ARCHIVE_BATCH_SIZE,))
+                return cur.fetchone()[0]
+
+            # отмена останавливает текущую пачку, уже перенесённые остаются в архиве
+            archived = self._run_cancellable("service", "Перенос в архив", run, conn=conn)
+        except OperationCancelled:
+            archived = None
+        except Exception as e:
+            messagebox.showerror("Ошибка", str(e))
+            return
+        finally:
+            if conn is not None:
+                conn.close()
+        if archived is None:
+            messagebox.showinfo("Архив", "Перенос прерван. Уже перенесённые пачки остались в архиве.")
+        else:
+            messagebox.showinfo("Архив", f"Перенесено в архив договоров: {archived}")
+        if self.current_table in ARCHIVED_TABLES:
+            self.refresh()
+
+    def call_service(self, sql):
+        # служебная функция БД с единственным результатом; фиксируем сразу
+        self.cursor.execute(sql)
+        value = next(iter(self.cursor.fetchone().values()))
+        self.conn.commit()
+        self.note_write()
+        return value
+
+    def refresh_materialized(self):
+        if not self.require_online():
+            return
+        try:
+            done = self._run_cancellable("service", "Пересчёт витрины договоров",
+                                         lambda: self.call_service("SELECT refresh_contracts_detailed_mv() AS done"))
+        except OperationCancelled:
+            return
+        except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            messagebox.showerror("Ошибка", str(e))
+            return
+        if done:
+            messagebox.showinfo("Витрина", "Витрина договоров пересчитана")
+        else:
+            messagebox.showinfo("Витрина", "Витрина актуальна или уже пересчитывается")
 
     def setup_tree(self):
         for i in self.tree.get_children():
@@ -290,76 +1441,153 @@ class DatabaseApp(ctk.CTk):
             anchor = "center" if col.endswith("_code") or col.endswith("_id") else "w"
             self.tree.column(col, width=width, anchor=anchor)
 
-    def populate_tree(self):
-        for i in self.tree.get_children():
-            self.tree.delete(i)
+    def row_iid(self, row, table=None):
+        # iid строки в дереве = значения первичного ключа через ":"
+        pk_cols = TABLE_PKS[table or self.current_table]
+        return ":".join(str(row.get(c)) for c in pk_cols)
+
+    def selected_rows(self):
+        # выбранные в дереве строки данных (поиск по индексу PK, без перебора)
+        rows = []
+        for iid in self.tree.selection():
+            row = self.row_index.get(iid)
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    def row_values(self, row):
+        values = []
+        pk_cols = TABLE_PKS.get(self.current_table, ())
+        names = MATERIALIZED_SOURCES.get(self.current_table, (None, None, {}))[2]
+
+        for col in self.tree["columns"]:
+            val = row.get(col)
+
+            # ---- PK ----
+            if col in pk_cols:
+                values.append("" if val is None else str(val))
+                continue
 
-        for row in self.filtered_data:
-            values = []
+            # ---- FK отображение ----
+            if col.endswith("_code"):
+                # имя уже пришло из витрины — справочник не нужен
+                name_col = names.get(col)
+                disp = row[name_col] if name_col in row else self.get_display(col, val)
+                values.append("" if disp is None else disp)
+                continue
 
-            # определяем PK (для красоты)
-            pk_col = next((k for k in row if k.endswith("_code") or k.endswith("_id") or k == "payment_id"), None)
+            # ---- красивые даты ----
+            if col in ("created_at", "updated_at", "created_date") and val:
+                try:
+                    values.append(val.strftime("%d.%m.%Y"))
+                except:
+                    s = str(val)
+                    values.append(s.split()[0])
+                continue
 
-            for col in self.tree["columns"]:
-                val = row.get(col)
+            # ---- числа ----
+            if isinstance(val, (int, float, Decimal)):
+                try:
+                    values.append(f"{Decimal(val):.2f}")
+                except:
+                    values.append(str(val))
+                continue
 
-                # ---- PK ----
-                if col == pk_col:
-                    values.append("" if val is None else str(val))
-                    continue
+            # ---- текст ----
+            values.append("" if val is None else str(val))
+        return values
 
-                # ---- FK отображение ----
-                if col.endswith("_code") and col != pk_col:
-                    disp = self.get_display(col, val)
-                    values.append("" if disp is None else disp)
-                    continue
+    def populate_tree(self):
+        for i in self.tree.get_children():
+            self.tree.delete(i)
 
-                # ---- красивые даты ----
-                if col in ("created_at", "updated_at", "created_date") and val:
-                    try:
-                        values.append(val.strftime("%d.%m.%Y"))
-                    except:
-                        s = str(val)
-                        values.append(s.split()[0])
-                    continue
+        for row in self.filtered_data:
+            self.tree.insert("", "end", iid=self.row_iid(row), values=self.row_values(row))
 
-                # ---- числа ----
-                if isinstance(val, (int, float, Decimal)):
-                    try:
-                        values.append(f"{Decimal(val):.2f}")
-                    except:
-                        values.append(str(val))
-                    continue
 
-                # ---- текст ----
-                values.append("" if val is None else str(val))
+    def sort_by(self, col, add=False):
+        """
+        Клик по заголовку — сортировка по одной колонке (повторный клик
+        меняет направление), Shift+клик — добавить колонку к ключу сортировки.
+        """
+        spec = list(self.sort_spec)
+        pos = next((i for i, (c, _) in enumerate(spec) if c == col), None)
+        if add:
+            if pos is None:
+                spec.append((col, True))
+            else:
+                spec[pos] = (col, not spec[pos][1])
+        elif len(spec) == 1 and pos == 0:
+            spec = [(col, not spec[0][1])]
+        else:
+            spec = [(col, True)]
+        self.sort_spec = spec
 
-            self.tree.insert("", "end", values=values)
+        # перестановка из кэша; видимые строки просто выстраиваем по ней
+        perm = self.sort_permutation()
+        visible = {id(r) for r in self.filtered_data}
+        self.filtered_data = [self.data[i] for i in perm if id(self.data[i]) in visible]
 
+        self.update_sort_headings()
+        self.populate_tree()
 
-    def sort_by(self, col):
-        # toggle sort state
-        reverse = self.sort_states.get(col, False)
-        # Use key that handles None
-        def keyfn(r):
-            v = r.get(col)
-            return (v is None, v)
-        self.filtered_data.sort(key=keyfn, reverse=not reverse)
-        self.sort_states[col] = not reverse
-        # update heading indicators (simple)
+    def update_sort_headings(self):
         for c in self.tree["columns"]:
             base = FIELD_NAMES[self.current_table].get(c, c)
             marker = ""
-            if c == col:
-                marker = " ↓" if self.sort_states[col] else " ↑"
+            for n, (col, desc) in enumerate(self.sort_spec, 1):
+                if c == col:
+                    marker = " ↓" if desc else " ↑"
+                    if len(self.sort_spec) > 1:
+                        marker += str(n)
             self.tree.heading(c, text=base + marker)
-        self.populate_tree()
 
-    def apply_filters(self, *_):
-        # Если таблица не загружена — нечего фильтровать
-        if not getattr(self, "data", None):
+    def on_tree_shift_click(self, event):
+        if self.tree.identify_region(event.x, event.y) != "heading":
+            return
+        col_id = self.tree.identify_column(event.x)  # "#3"
+        try:
+            col = self.tree["columns"][int(col_id[1:]) - 1]
+        except (ValueError, IndexError):
             return
+        self.sort_by(col, add=True)
+        return "break"
+
+    def sort_key_column(self, col):
+        # сравнимые ключи колонки, считаются один раз на загрузку; None — в конце
+        keys = self.sort_keys.get(col)
+        if keys is None:
+            keys = self.sort_keys[col] = [(r.get(col) is None, r.get(col)) for r in self.data]
+        return keys
 
+    def sort_permutation(self):
+        """
+        Порядок индексов self.data для текущего sort_spec. Кэшируется по набору
+        ключей; для того же набора с обратными направлениями кэш просто
+        разворачивается.
+        """
+        key = tuple(self.sort_spec)
+        perm = self.sort_cache.get(key)
+        if perm is not None:
+            return perm
+        flipped = self.sort_cache.get(tuple((c, not d) for c, d in key))
+        if flipped is not None:
+            perm = flipped[::-1]
+        else:
+            # устойчивая сортировка от младшего ключа к старшему
+            perm = list(range(len(self.data)))
+            for col, desc in reversed(key):
+                perm.sort(key=self.sort_key_column(col).__getitem__, reverse=desc)
+        self.sort_cache[key] = perm
+        return perm
+
+    def invalidate_sort(self):
+        # индексы в кэшированных перестановках относятся к прежнему self.data
+        self.sort_keys = {}
+        self.sort_cache = {}
+
+    def current_filters(self):
+        # (строка поиска, колонка фильтра, значение фильтра, запрос по словам) из виджетов
         search = ""
         try:
             if hasattr(self, "search_entry") and self.search_entry is not None:
@@ -373,24 +1601,14 @@ class DatabaseApp(ctk.CTk):
             except Exception:
                 search = ""
 
-        # --- 2) начинаем с полного набора данных ---
-        result = list(self.data)
-
-        # --- 3) "простой поиск" по всем полям ---
-        if search:
-            result = [
-                r for r in result
-                if any(search in str(v).lower() for v in r.values() if v is not None)
-            ]
-
-        # --- 4) фильтр по выбранному полю (как у тебя) ---
-        # ВАЖНО: этот блок оставлен максимально совместимым — если чего-то нет, просто пропускаем.
+        # ВАЖНО: если чего-то нет, фильтр по полю просто не применяется.
         try:
             filt_col_disp = (self.filter_col.get() or "").strip()
             filt_val = (self.filter_val.get() or "").strip().lower()
         except Exception:
             filt_col_disp, filt_val = "", ""
 
+        eng_col = None
         if filt_col_disp and filt_val and getattr(self, "current_table", None):
             try:
                 eng_col = next(
@@ -400,35 +1618,420 @@ class DatabaseApp(ctk.CTk):
             except Exception:
                 eng_col = None
 
-            if eng_col:
-                result = [
-                    r for r in result
-                    if filt_val in str(r.get(eng_col, "")).lower()
-                ]
+        # в режиме "по словам" строка поиска уходит на сервер вместо поиска подстроки
+        words = ""
+        if search and self.fts_var.get() and self.conn is not None and self.current_table in FTS_TABLES:
+            words, search = (self.search_var.get() or "").strip(), ""
+
+        return search, eng_col, filt_val, words
+
+    def search_text(self, row):
+        # текст строки для "простого поиска" по колонкам таблицы;
+        # \0 не даёт совпасть на стыке полей
+        return "\0".join(
+            str(row[c]).lower() for c in FIELD_NAMES[self.current_table] if row.get(c) is not None
+        )
+
+    def row_matches(self, iid, row, filters):
+        search, eng_col, filt_val, words = filters
+        if words and iid not in self.fts_hits:
+            return False
+        if search:
+            text = self.search_index.get(iid)
+            if text is None:
+                text = self.search_index[iid] = self.search_text(row)
+            if search not in text:
+                return False
+        if eng_col:
+            val = row.get(eng_col)
+            if filt_val not in ("" if val is None else str(val).lower()):
+                return False
+        return True
 
-        # --- 5) сохраняем и перерисовываем ---
-        self.filtered_data = result
+    def apply_filters(self, *_):
+        # Если таблица не загружена — нечего фильтровать
+        if not getattr(self, "data", None):
+            return
+
+        filters = self.current_filters()
+        words = filters[3]
+        if words and self.fts_key != (self.current_table, words):
+            # совпадения ищет сервер; таблицу перерисуем, когда придёт ответ
+            self.schedule_fts()
+            return
+        # при активной сортировке идём по кэшированной перестановке — заново не сортируем
+        if self.sort_spec:
+            rows = [self.data[i] for i in self.sort_permutation()]
+        elif words:
+            # без явной сортировки — по релевантности
+            rows = [self.row_index[iid] for iid in self.fts_hits if iid in self.row_index]
+        else:
+            rows = self.data
+        if filters[0] or filters[1] or words:
+            self.filtered_data = [
+                r for r in rows
+                if self.row_matches(self.row_iid(r), r, filters)
+            ]
+        else:
+            self.filtered_data = list(rows)
         self.populate_tree()
+        self.show_fts_snippet()
+        self.schedule_totals()
+
+    def schedule_fts(self):
+        if self.fts_job is not None:
+            self.after_cancel(self.fts_job)
+        self.fts_job = self.after(400, self.run_fts)
+
+    def run_fts(self):
+        """
+        Полнотекстовый поиск по теме и примечанию текущей таблицы: iid
+        совпавших строк по убыванию ts_rank и фрагменты ts_headline.
+        """
+        self.fts_job = None
+        if self.busy:
+            self.schedule_fts()
+            return
+        table = self.current_table
+        words = self.current_filters()[3]
+        if not words:
+            self.apply_filters()
+            return
+        pk = ", ".join(TABLE_PKS[table])
+        conn, cur = self.reader(wait=False)
+        try:
+            cur.execute(f"""
+                SELECT {pk},
+                       CASE WHEN row_number() OVER (ORDER BY rank DESC) <= %s
+                            THEN ts_headline('russian', concat_ws(' — ', topic, notes), q, %s)
+                       END AS snippet
+                FROM (
+                    SELECT {pk}, topic, notes, q, ts_rank(text_search_tsv(topic, notes), q) AS rank
+                    FROM {table}, websearch_to_tsquery('russian', %s) AS q
+                    WHERE text_search_tsv(topic, notes) @@ q
+                ) t
+                ORDER BY rank DESC
+            """, (FTS_HEADLINE_LIMIT, FTS_HEADLINE_OPTIONS, words))
+            found = cur.fetchall()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except:
+                pass
+            messagebox.showerror("Ошибка", f"Не удалось выполнить поиск по словам:\n{e}")
+            return
+        self.fts_hits = OrderedDict((self.row_iid(r, table), r["snippet"]) for r in found)
+        self.fts_key = (table, words)
+        self.apply_filters()
+
+    def show_fts_snippet(self):
+        # фрагмент темы/примечания выбранной строки, найденные слова в «»
+        text = ""
+        if self.current_filters()[3]:
+            focus = self.tree.focus()
+            snippet = self.fts_hits.get(focus) if focus else None
+            if snippet:
+                text = f"Найдено: {' '.join(snippet.split())}"
+            elif not self.filtered_data:
+                text = "По словам ничего не найдено"
+        self.fts_lbl.configure(text=text)
+
+    def filter_where(self, table, filters):
+        """
+        Серверный аналог row_matches: тот же поиск и фильтр по полю
+        в виде WHERE, чтобы итоги совпадали с тем, что видно в таблице.
+        """
+        search, eng_col, filt_val, words = filters
+        parts, params = [], []
+        if words:
+            parts.append("text_search_tsv(topic, notes) @@ websearch_to_tsquery('russian', %s)")
+            params.append(words)
+        if search:
+            cols = ", ".join(f"{c}::text" for c in FIELD_NAMES[table])
+            parts.append(f"strpos(lower(concat_ws(chr(1), {cols})), %s) > 0")
+            params.append(search)
+        if eng_col:
+            parts.append(f"strpos(lower(COALESCE({eng_col}::text, '')), %s) > 0")
+            params.append(filt_val)
+        return ("WHERE " + " AND ".join(parts)) if parts else "", params
+
+    def schedule_totals(self):
+        # пересчёт итогов с задержкой: не дёргаем сервер на каждую клавишу
+        if self.totals_job is not None:
+            self.after_cancel(self.totals_job)
+        self.totals_job = self.after(400, self.update_totals)
+
+    def update_totals(self):
+        self.totals_job = None
+        if self.busy:
+            self.schedule_totals()
+            return
+        table = self.current_table
+        if not table:
+            self.totals_lbl.configure(text="")
+            return
+        if self.conn is None:
+            # без связи считаем только строки, суммы — по данным сервера
+            self.totals_lbl.configure(text=f"Записей: {len(self.filtered_data):,}".replace(",", " "))
+            return
+        num_cols = [c for c in FIELD_NAMES[table] if "amount" in c or "percentage" in c]
+        where_sql, params = self.filter_where(table, self.current_filters())
+        conn, cur = self.reader(wait=False)
+        try:
+            cur.execute(self.totals_query(table, num_cols, where_sql), params)
+            totals = cur.fetchone()
+        except Exception:
+            try:
+                conn.rollback()
+            except:
+                pass
+            self.totals_lbl.configure(text="")
+            return
+        labels = [FIELD_NAMES[table][c] for c in num_cols]
+        self.totals_lbl.configure(text=self.format_totals(totals, labels))
+
+    def apply_row_change(self, table, op, row):
+        """
+        Точечно применяет изменение одной строки (INSERT/UPDATE/DELETE)
+        к загруженным данным, индексам и дереву — без перезагрузки таблицы.
+        """
+        if table != self.current_table:
+            return
+        self.schedule_totals()
+        self.invalidate_sort()
+        if self.current_filters()[3]:
+            # совпадения по словам посчитаны до изменения — сервер пересчитает их заново
+            self.fts_key = None
+            self.schedule_fts()
+        iid = self.row_iid(row)
+        old = self.row_index.get(iid)
+
+        if op == "DELETE":
+            if old is None:
+                return
+            del self.row_index[iid]
+            self.search_index.pop(iid, None)
+            self.data = [r for r in self.data if r is not old]
+            if self.tree.exists(iid):
+                self.filtered_data = [r for r in self.filtered_data if r is not old]
+                self.tree.delete(iid)
+            return
+
+        # INSERT / UPDATE: правим словарь на месте, чтобы data и filtered_data
+        # продолжали ссылаться на один и тот же объект
+        if old is None:
+            old = dict(row)
+            self.data.append(old)
+            self.row_index[iid] = old
+        else:
+            # сливаем, а не заменяем: в строке без имён (RETURNING *, сама таблица)
+            # имя сбрасываем только у изменившегося кода
+            names = MATERIALIZED_SOURCES.get(table, (None, None, {}))[2]
+            for code_col, name_col in names.items():
+                if name_col not in row and old.get(code_col) != row.get(code_col):
+                    old.pop(name_col, None)
+            old.update(row)
+        self.search_index[iid] = self.search_text(old)
+
+        visible = self.row_matches(iid, old, self.current_filters())
+        if visible and self.tree.exists(iid):
+            self.tree.item(iid, values=self.row_values(old))
+        elif visible:
+            self.filtered_data.append(old)
+            self.tree.insert("", "end", iid=iid, values=self.row_values(old))
+        elif self.tree.exists(iid):
+            self.filtered_data = [r for r in self.filtered_data if r is not old]
+            self.tree.delete(iid)
+
+    def fetch_row(self, cursor=None):
+        # одна строка результата (RETURNING *) как обычный dict
+        cursor = cursor or self.cursor
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        if isinstance(row, dict):
+            return dict(row)
+        keys = [desc[0] for desc in cursor.description]
+        return dict(zip(keys, row))
+
+    def fetch_rows_by_pk(self, table, pks):
+        # строки таблицы по списку PK (dict-ов) одним запросом
+        if not pks:
+            return []
+        cond, params = self.pk_condition(table, pks)
+        self.cursor.execute(f"SELECT * FROM {self.live_source(table)} WHERE {cond}", params)
+        return [dict(r) for r in self.cursor.fetchall()]
+
+    # -------------------- Живая лента изменений (LISTEN/NOTIFY) --------------------
+
+    def process_changes(self):
+        if self.busy:
+            # соединение занято долгой операцией — изменения подождут в очереди
+            self.change_job = self.after(CHANGE_POLL_MS, self.process_changes)
+            return
+        changes = []
+        try:
+            while True:
+                changes.append(self.change_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if changes:
+            try:
+                self.apply_remote_changes(changes)
+            except Exception:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+        self.change_job = self.after(CHANGE_POLL_MS, self.process_changes)
+
+    def apply_remote_changes(self, changes):
+        # уведомление приходит с основного сервера после фиксации: пока реплика
+        # не воспроизвела эту позицию, отчёты и таблицы перечитываем с основного
+        self.note_write()
+        if any(c is None for c in changes):
+            # слушатель переподключался — уведомления могли потеряться
+            self.reference_cache.clear()
+            self.cashflow_cache.clear()
+            self.drop_cached_tables()
+            self.refresh()
+            self.refresh_open_reports(None)
+            return
+
+        own_pid = self.conn.get_backend_pid()
+        by_table = {}
+        for c in changes:
+            if c.get("table") not in TABLE_PKS:
+                continue
+            by_table.setdefault(c["table"], [])
+            # свои изменения уже применены в apply_row_change
+            if c.get("pid") != own_pid:
+                by_table[c["table"]].append(c)
+
+        self.drop_cached_tables(by_table.keys())
+        self.drop_named_tables(by_table.keys())
+        if by_table.keys() & {"contract_stages", "payments"}:
+            # задним числом могли изменить и закрытый период
+            self.cashflow_cache.clear()
+        for table, items in by_table.items():
+            if not items:
+                continue
+            for k in [k for k in self.typeahead_cache if k[0] == table]:
+                del self.typeahead_cache[k]
+            self.fk_names.pop(table, None)
+            self.update_reference_cache(table, items)
+            if table == self.current_table:
+                self.apply_remote_rows(table, items)
+        self.refresh_open_reports(set(by_table))
+
+    def apply_remote_rows(self, table, items):
+        # по каждому PK важна только последняя операция
+        last = {}
+        for c in items:
+            last[self.row_iid(c["pk"], table)] = c
+        upserts = []
+        for c in last.values():
+            if c["op"] == "DELETE":
+                self.apply_row_change(table, "DELETE", c["pk"])
+            else:
+                upserts.append(c["pk"])
+
+        found = set()
+        for row in self.fetch_rows_by_pk(table, upserts):
+            found.add(self.row_iid(row, table))
+            self.apply_row_change(table, "UPDATE", row)
+        # строку успели удалить, пока шло уведомление
+        for pk in upserts:
+            if self.row_iid(pk, table) not in found:
+                self.apply_row_change(table, "DELETE", pk)
+
+    def update_reference_cache(self, table, items):
+        # точечно правим закэшированные справочники вместо полной перезагрузки
+        changed_codes = set()
+        # колонки имён открытой таблицы, если она показана из витрины
+        shown_names = {}
+        if self.current_table and self.live_source(self.current_table) != self.current_table:
+            shown_names = MATERIALIZED_SOURCES[self.current_table][2]
+        for tbl, field, code_col in set(REF_MAPPING.values()):
+            if tbl != table:
+                continue
+            cache = self.reference_cache.get(f"{tbl}_{field}")
+            name_cols = {c: n for c, n in shown_names.items() if REF_MAPPING[c][:2] == (tbl, field)}
+            if not cache and not name_cols:
+                continue
+            codes = {c["pk"].get(code_col) for c in items}
+            changed_codes |= codes
+            fresh = {}
+            alive = [c["pk"].get(code_col) for c in items if c["op"] != "DELETE"]
+            if alive:
+                self.cursor.execute(f"SELECT {code_col}, {field} FROM {tbl} WHERE {code_col} = ANY(%s)", (alive,))
+                fresh = {row[code_col]: row[field] for row in self.cursor.fetchall()}
+            if cache:
+                cmap = cache["map"]
+                for code in codes:
+                    if fresh.get(code) is None:
+                        cmap.pop(code, None)
+                    else:
+                        cmap[code] = str(fresh[code])
+                cache["list"] = sorted(set(cmap.values()))
+            # готовые имена из витрины устарели — берём новые (удалённый код — без имени)
+            for row in self.data:
+                for code_col_in_row, name_col in name_cols.items():
+                    if row.get(code_col_in_row) in codes:
+                        row[name_col] = fresh.get(row[code_col_in_row])
+
+        # перерисовываем строки открытой таблицы, которые ссылаются на изменённые коды
+        if not changed_codes or not self.current_table:
+            return
+        fk_cols = [col for col in self.tree["columns"]
+                   if col in REF_MAPPING and REF_MAPPING[col][0] == table
+                   and col not in TABLE_PKS[self.current_table]]
+        if not fk_cols:
+            return
+        self.invalidate_sort()
+        for row in self.filtered_data:
+            if any(row.get(col) in changed_codes for col in fk_cols):
+                self.tree.item(self.row_iid(row), values=self.row_values(row))
 
+    def refresh_open_reports(self, tables):
+        # tables=None — обновить все открытые отчёты
+        for entry in list(self.open_reports):
+            if entry["pending"]:
+                continue
+            if tables is not None and not (entry["tables"] & tables):
+                continue
+            entry["pending"] = True
+            # небольшая задержка, чтобы пачка изменений дала один перезапрос
+            self.after(1000, lambda e=entry: self.rerun_report(e))
+
+    def rerun_report(self, entry):
+        if self.busy:
+            self.after(1000, lambda: self.rerun_report(entry))
+            return
+        entry["pending"] = False
+        try:
+            if not entry["win"].winfo_exists():
+                return
+            entry["fill"](*entry["reload"]())
+        except Exception:
+            try:
+                self.conn.rollback()
+            except:
+                pass
 
     # Unified get_display using cache
     def get_display(self, col, code):
         if code is None:
             return ""
-        mapping = {
-            "customer_code": ("organizations", "name", "organization_code"),
-            "executor_code": ("organizations", "name", "organization_code"),
-            "contract_type_code": ("contract_types", "type_name", "contract_type_code"),
-            "execution_stage_code": ("execution_stages", "stage_name", "stage_code"),
-            "vat_code": ("vat_rates", "description", "vat_code"),
-            "payment_type_code": ("payment_types", "payment_type_name", "payment_type_code"),
-            "stage_code": ("execution_stages", "stage_name", "stage_code"),
-        }
-        if col not in mapping:
+        # contract_code в таблицах показываем как есть, без темы договора
+        if col not in REF_MAPPING or col == "contract_code":
             return str(code)
-        tbl, field, code_col = mapping[col]
+        tbl, field, code_col = REF_MAPPING[col]
         cache_key = f"{tbl}_{field}"
         if cache_key not in self.reference_cache:
+            if self.busy:
+                # справочник дочитаем, когда соединение освободится
+                return str(code)
             # populate cache
             try:
                 self.cursor.execute(f"SELECT {code_col}, {field} FROM {tbl}")
@@ -453,59 +2056,457 @@ class DatabaseApp(ctk.CTk):
         return cmap.get(code, cmap.get(str(code), str(code)))
 
     def add_record(self):
+        if not self.require_online():
+            return
         if self.current_table == "contracts":
             self.add_contract_with_stages()
         else:
             self.edit_form("add")
 
-    def edit_record(self):
-        sel = self.tree.selection()
-        if not sel:
-            messagebox.showwarning("Внимание", "Выберите запись для редактирования")
-            return
-        item_id = sel[0]
-        # find index by item_id position in displayed children
-        try:
-            idx = list(self.tree.get_children()).index(item_id)
-        except ValueError:
-            messagebox.showerror("Ошибка", "Не удалось найти выбранную запись")
-            return
-        if idx >= len(self.filtered_data):
-            messagebox.showerror("Ошибка", "Неверный индекс записи")
-            return
-        self.edit_form("edit", self.filtered_data[idx])
+    def batch_entry(self):
+        if not self.require_online():
+            return
+        if self.current_table != "payments":
+            messagebox.showinfo("Ввод списком", "Списком вводятся оплаты; этапы — так же, при создании договора")
+            return
+        self.batch_payments_form()
+
+    def edit_record(self):
+        if not self.require_online():
+            return
+        rows = self.selected_rows()
+        if not rows:
+            messagebox.showwarning("Внимание", "Выберите запись для редактирования")
+            return
+        if len(rows) > 1:
+            self.bulk_edit_form(rows)
+            return
+        self.edit_form("edit", rows[0])
+
+    def delete_record(self):
+        if not self.require_online():
+            return
+        rows = self.selected_rows()
+        if not rows:
+            messagebox.showwarning("Внимание", "Выберите запись для удаления")
+            return
+        question = "Удалить запись?" if len(rows) == 1 else f"Удалить выбранные записи ({len(rows)})?"
+        if not messagebox.askyesno("Удаление", question):
+            return
+        table = self.current_table
+        try:
+            deleted, failed = self._run_cancellable(
+                "bulk", f"Удаление записей: {len(rows)}",
+                lambda: self.bulk_apply(table, rows, f"DELETE FROM {table}", []))
+        except OperationCancelled:
+            return
+        except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            messagebox.showerror("Ошибка", f"Не удалось удалить запись:\n{e}")
+            return
+        self.invalidate_cache_for_table(table)
+        for row in deleted:
+            self.apply_row_change(table, "DELETE", row)
+        if failed or len(rows) > 1:
+            self.show_bulk_summary("Удалено", len(deleted), failed)
+
+    def pk_condition(self, table, rows):
+        # WHERE по набору PK: "pk = ANY(%s)" или unnest для составного ключа
+        pk_cols = TABLE_PKS[table]
+        if len(pk_cols) == 1:
+            return f"{pk_cols[0]} = ANY(%s)", [[r[pk_cols[0]] for r in rows]]
+        cols = ", ".join(pk_cols)
+        arrays = ", ".join(["%s::int[]"] * len(pk_cols))
+        return f"({cols}) IN (SELECT * FROM unnest({arrays}))", [[r[c] for r in rows] for c in pk_cols]
+
+    def bulk_apply(self, table, rows, sql_head, head_params):
+        """
+        Выполняет sql_head ("DELETE FROM t" / "UPDATE t SET ...") для набора строк
+        одним оператором в одной транзакции. Если мешает ограничение (FK и т.п.),
+        повторяет построчно с SAVEPOINT в той же транзакции, чтобы применить
+        всё остальное и собрать список отказов.
+        Возвращает (изменённые строки из RETURNING *, [(строка, ошибка)]).
+        """
+        cond, cond_params = self.pk_condition(table, rows)
+        try:
+            self.stmts.execute(self.cursor, f"{sql_head} WHERE {cond} RETURNING *", head_params + cond_params)
+            changed = [dict(r) for r in self.cursor.fetchall()]
+            self.conn.commit()
+            return changed, []
+        except psycopg2.IntegrityError:
+            self.conn.rollback()
+
+        changed, failed = [], []
+        for row in rows:
+            cond, cond_params = self.pk_condition(table, [row])
+            self.cursor.execute("SAVEPOINT bulk_row")
+            try:
+                self.stmts.execute(self.cursor, f"{sql_head} WHERE {cond} RETURNING *", head_params + cond_params)
+                changed.extend(dict(r) for r in self.cursor.fetchall())
+                self.cursor.execute("RELEASE SAVEPOINT bulk_row")
+            except psycopg2.IntegrityError as e:
+                self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_row")
+                failed.append((row, e))
+        self.conn.commit()
+        return changed, failed
+
+    def show_bulk_summary(self, verb, done, failed):
+        lines = [f"{verb}: {done}"]
+        if failed:
+            fk = [f for f in failed if f[1].pgcode == "23503"]
+            other = len(failed) - len(fk)
+            if fk:
+                lines.append(f"Пропущено из-за ссылок (FK): {len(fk)}")
+            if other:
+                lines.append(f"Пропущено из-за других ограничений: {other}")
+            for row, e in failed[:5]:
+                msg = e.diag.message_primary or str(e)
+                lines.append(f"  [{self.row_iid(row)}] {msg}")
+            if len(failed) > 5:
+                lines.append("  ...")
+        messagebox.showinfo("Итог", "\n".join(lines))
+
+    def parse_field_value(self, field, raw):
+        # значение поля из строки — общие правила для форм, массового изменения
+        # и ввода списком; ValueError при ошибке
+        raw = (raw or "").strip()
+        if field.endswith("_code"):
+            code = self.get_code_by_disp(field, raw)
+            if raw and code is None:
+                raise ValueError(f"Значение '{raw}' не найдено в справочнике")
+            return code
+        if raw == "":
+            return None
+        if field == "is_active":
+            return raw.lower() in ("1", "да", "true", "yes")
+        if "date" in field:
+            try:
+                if "." in raw:
+                    return datetime.strptime(raw, "%d.%m.%Y").date()
+                return datetime.strptime(raw, "%Y-%m-%d").date()
+            except ValueError:
+                raise ValueError(f"Поле {field} должно быть датой")
+        if "amount" in field or "percentage" in field:
+            # суммы принимаем и в виде "1 234,50" (Excel, банковские выписки)
+            raw = raw.replace(" ", "").replace("\xa0", "").replace(",", ".")
+            try:
+                value = Decimal(raw)
+            except InvalidOperation:
+                raise ValueError(f"Поле {field} должно быть числом")
+            if not value.is_finite():
+                raise ValueError(f"Поле {field} должно быть числом")
+            return value
+        return raw
+
+    def parse_batch_cell(self, field, raw):
+        # ячейка ввода списком: FK — код или название, номер этапа — целое,
+        # остальное — по общим правилам parse_field_value
+        raw = (raw or "").strip()
+        if raw == "":
+            return None
+        if field in REF_MAPPING:
+            return self.resolve_fk_text(field, raw)
+        if field == "stage_number":
+            if not raw.isdigit():
+                raise ValueError("Номер этапа должен быть целым числом")
+            return int(raw)
+        return self.parse_field_value(field, raw)
+
+    def resolve_fk_text(self, col, raw):
+        """
+        Код FK по тексту: число или подсказка "…[код]" — код (проверяется по
+        справочнику), иначе название. Договор — только по коду: темы не
+        уникальны, и оплата ушла бы на произвольный из одноимённых договоров.
+        """
+        found = re.fullmatch(r".*\[(\d+)\]", raw)  # текст подсказки typeahead_text
+        if raw.isdigit() or found:
+            code = int(found.group(1) if found else raw)
+            if code in self.known_fk_codes(col, [code]):
+                return code
+            raise ValueError(f"Код {code} не найден в {REF_MAPPING[col][0]}")
+        if col == "contract_code":
+            raise ValueError("Укажите номер договора или выберите договор из подсказки")
+        codes = self.fk_codes_by_name(col, [raw]).get(raw, [])
+        if not codes:
+            raise ValueError(f"Значение '{raw}' не найдено в справочнике")
+        if len(codes) > 1:
+            raise ValueError(f"'{raw}' — несколько записей ({', '.join(map(str, sorted(codes)))}), укажите код")
+        return codes[0]
+
+    def fk_codes_by_name(self, col, names):
+        """
+        {название: [коды]} для названий справочника col; несколько кодов — название
+        неоднозначно. Малые справочники — по кэшу, большие — одним запросом = ANY
+        на все названия сразу, с запоминанием.
+        """
+        tbl, field, code_col = REF_MAPPING[col]
+        if tbl not in TYPEAHEAD_TABLES:
+            self.get_ref_list(col)
+            cmap = self.reference_cache.get(f"{tbl}_{field}", {}).get("map", {})
+            wanted = set(names)
+            found = {}
+            for code, disp in cmap.items():
+                if disp in wanted:
+                    found.setdefault(disp, []).append(code)
+            return found
+        known = self.fk_names.setdefault(tbl, {})
+        missing = list({n for n in names if n not in known})
+        if missing and self.busy:
+            raise ValueError("База занята другой операцией, проверьте строку ещё раз")
+        if missing:
+            try:
+                self.cursor.execute(f"SELECT {code_col}, {field} FROM {tbl} WHERE {field} = ANY(%s)", (missing,))
+                rows = self.cursor.fetchall()
+            except psycopg2.Error:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+                raise ValueError("Не удалось проверить названия по базе")
+            for n in missing:
+                known[n] = []
+            for r in rows:
+                known[r[field]].append(r[code_col])
+        return {n: known[n] for n in names if known.get(n)}
+
+    def known_fk_codes(self, col, codes):
+        """
+        Какие из кодов есть в справочнике col: малые справочники — по кэшу,
+        большие (TYPEAHEAD_TABLES) — одним запросом, с запоминанием найденных.
+        """
+        tbl, field, code_col = REF_MAPPING[col]
+        if tbl not in TYPEAHEAD_TABLES:
+            self.get_ref_list(col)
+            cmap = self.reference_cache.get(f"{tbl}_{field}", {}).get("map", {})
+            return {c for c in codes if c in cmap}
+        known = self.fk_known.setdefault(tbl, set())
+        missing = list({c for c in codes if c not in known})
+        if missing and self.busy:
+            # запрос и откат на self.conn помешали бы идущей долгой операции
+            raise ValueError("База занята другой операцией, проверьте строку ещё раз")
+        if missing:
+            try:
+                self.cursor.execute(f"SELECT {code_col} FROM {tbl} WHERE {code_col} = ANY(%s)", (missing,))
+                known.update(r[code_col] for r in self.cursor.fetchall())
+            except psycopg2.Error:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+                raise ValueError("Не удалось проверить коды по базе")
+        return {c for c in codes if c in known}
+
+    def check_batch_row(self, table, values):
+        # те же CHECK, что в схеме: иначе сервер отверг бы весь пакет из-за одной строки
+        if table == "payments" and values["payment_amount"] <= 0:
+            raise ValueError("Сумма платежа должна быть больше нуля")
+        if table == "contract_stages":
+            if values["stage_amount"] < 0 or values["advance_amount"] < 0:
+                raise ValueError("Суммы этапа не могут быть отрицательными")
+            if values["advance_amount"] > values["stage_amount"]:
+                raise ValueError("Аванс больше суммы этапа")
+
+    def insert_rows(self, table, rows):
+        """
+        Вставляет строки (dict-ы с одинаковыми ключами) одним многострочным
+        INSERT ... VALUES (...), (...) — один запрос к серверу на весь пакет.
+        Возвращает вставленные строки (RETURNING *); commit — за вызывающим.
+        """
+        cols = list(rows[0])
+        inserted = execute_values(
+            self.cursor,
+            f"INSERT INTO {table} ({', '.join(cols)}) VALUES %s RETURNING *",
+            [tuple(r[c] for c in cols) for r in rows],
+            page_size=len(rows), fetch=True
+        )
+        return [dict(r) for r in inserted]
+
+    def batch_payments_form(self):
+        win = ctk.CTkToplevel(self)
+        win.title("Ввод оплат списком")
+        win.geometry("1150x650")
+
+        ctk.CTkLabel(
+            win, justify="left", anchor="w", font=("Arial", 12),
+            text="Enter — добавить строку, двойной щелчок — исправить, Delete — удалить.\n"
+                 "Ctrl+V — вставить строки из Excel или выписки (ячейки через табуляцию, в порядке колонок)."
+        ).pack(fill="x", padx=15, pady=(15, 0))
+        grid = BatchEntryGrid(win, self, "payments")
+        grid.pack(fill="both", expand=True, padx=15, pady=10)
+
+        def save():
+            if grid.error_count():
+                messagebox.showerror("Ошибка", f"Исправьте или удалите строки с ошибками ({grid.error_count()})", parent=win)
+                return
+            rows = grid.rows()
+            if not rows:
+                messagebox.showwarning("Внимание", "Список пуст", parent=win)
+                return
+
+            def insert():
+                inserted = self.insert_rows("payments", rows)
+                self.conn.commit()
+                return inserted
+
+            try:
+                inserted = self._run_cancellable("bulk", f"Сохранение оплат: {len(rows)}", insert)
+            except OperationCancelled:
+                return
+            except Exception as e:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+                messagebox.showerror("Ошибка", f"Оплаты не сохранены:\n{e}", parent=win)
+                return
+            self.invalidate_cache_for_table("payments")
+            for row in inserted:
+                self.apply_row_change("payments", "INSERT", row)
+            win.destroy()
+            messagebox.showinfo("Успех", f"Сохранено оплат: {len(inserted)}")
+
+        ctk.CTkButton(win, text="Сохранить все", fg_color="green", font=("Arial", 14, "bold"),
+                      height=40, command=save).pack(pady=(0, 15))
+
+    def bulk_edit_form(self, rows):
+        table = self.current_table
+        fields = {
+            f: rus for f, rus in FIELD_NAMES[table].items()
+            if f not in TABLE_PKS[table] and f not in ("created_date", "created_at", "updated_at")
+        }
+        by_label = {rus: f for f, rus in fields.items()}
+
+        win = ctk.CTkToplevel(self)
+        win.title(f"Массовое изменение ({len(rows)} записей)")
+        win.geometry("600x300")
+        win.grab_set()
+
+        ctk.CTkLabel(win, text=f"Выбрано записей: {len(rows)}", font=("Arial", 16, "bold")).pack(pady=(15, 10))
+
+        ctk.CTkLabel(win, text="Поле:", anchor="w").pack(padx=20, anchor="w")
+        field_box = ctk.CTkComboBox(win, values=list(by_label))
+        field_box.pack(fill="x", padx=20, pady=2)
+
+        ctk.CTkLabel(win, text="Новое значение:", anchor="w").pack(padx=20, pady=(10, 0), anchor="w")
+        value_frame = ctk.CTkFrame(win, fg_color="transparent")
+        value_frame.pack(fill="x", padx=20, pady=2)
+        value_box = {"w": None}
+
+        def on_field(label):
+            field = by_label.get(label)
+            if value_box["w"] is not None:
+                value_box["w"].destroy()
+            if field and field.endswith("_code"):
+                w = self.fk_widget(value_frame, field)
+            else:
+                w = ctk.CTkEntry(value_frame)
+            w.pack(fill="x")
+            value_box["w"] = w
+
+        field_box.configure(command=on_field)
+        if by_label:
+            field_box.set(next(iter(by_label)))
+            on_field(field_box.get())
+
+        def save():
+            field = by_label.get(field_box.get())
+            if not field:
+                messagebox.showerror("Ошибка", "Выберите поле")
+                return
+            w = value_box["w"]
+            try:
+                if isinstance(w, AutocompleteEntry):
+                    value = w.get_code()
+                    if value is None and w.get().strip():
+                        raise ValueError("Выберите значение из списка")
+                else:
+                    value = self.parse_field_value(field, w.get())
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
+                return
+            try:
+                updated, failed = self._run_cancellable(
+                    "bulk", f"Изменение записей: {len(rows)}",
+                    lambda: self.bulk_apply(table, rows, f"UPDATE {table} SET {field} = %s", [value]))
+            except OperationCancelled:
+                return
+            except Exception as e:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+                messagebox.showerror("Ошибка", str(e))
+                return
+            self.invalidate_cache_for_table(table)
+            win.destroy()
+            for row in self.with_display_names(table, updated):
+                self.apply_row_change(table, "UPDATE", row)
+            self.show_bulk_summary("Изменено", len(updated), failed)
+
+        ctk.CTkButton(win, text="Применить ко всем", fg_color="green", command=save).pack(pady=15)
 
-    def delete_record(self):
-        sel = self.tree.selection()
-        if not sel:
-            messagebox.showwarning("Внимание", "Выберите запись для удаления")
-            return
-        if not messagebox.askyesno("Удаление", "Удалить запись?"):
-            return
-        item_id = sel[0]
-        try:
-            idx = list(self.tree.get_children()).index(item_id)
-        except ValueError:
-            messagebox.showerror("Ошибка", "Не удалось определить выбранную запись")
-            return
-        if not self.data:
+    def refresh(self):
+        if not self.current_table or not self.require_online():
             return
-        pk = next(k for k in self.data[0] if k.endswith("_code") or k == "payment_id" or k.endswith("_id"))
-        try:
-            self.cursor.execute(f"DELETE FROM {self.current_table} WHERE {pk} = %s", (self.filtered_data[idx][pk],))
-            self.conn.commit()
-            self.invalidate_cache_for_table(self.current_table)
-            self.refresh()
-        except Exception as e:
+        if self.current_table in self.watermarks:
             try:
-                self.conn.rollback()
-            except:
-                pass
-            messagebox.showerror("Ошибка", f"Не удалось удалить запись:\n{e}")
+                if self.delta_refresh(self.current_table):
+                    return
+            except Exception:
+                try:
+                    self.conn.rollback()
+                except:
+                    pass
+        self.load_table(self.current_table, fresh=True)
 
-    def refresh(self):
-        if self.current_table:
-            self.load_table(self.current_table)
+    def server_clock(self, cur):
+        """
+        Отметка для дельта-обновления по данным, видным через cur.
+        На основном сервере — clock_timestamp(), а не now(): соединение может
+        долго держать открытую транзакцию. На реплике — время фиксации последней
+        воспроизведённой транзакции по часам основного: своим часам реплика
+        отставание не учитывает. None — реплика ещё ничего не воспроизвела.
+        """
+        if self.replica is not None and cur.connection is self.replica:
+            cur.execute("SELECT pg_last_xact_replay_timestamp()::timestamp AS ts")
+        else:
+            cur.execute("SELECT clock_timestamp()::timestamp AS ts")
+        return cur.fetchone()["ts"]
+
+    def delta_refresh(self, table):
+        """
+        Дочитывает строки, изменённые с прошлой отметки (updated_at),
+        и удаления из deleted_rows. False — если нужна полная загрузка.
+        """
+        since = self.watermarks[table]
+        # дельта — с основного: небольшой запрос, а реплика могла ещё не
+        # воспроизвести строки, зафиксированные до отметки
+        cur = self.cursor
+        now = self.server_clock(cur)
+        if (now - since).days >= TOMBSTONE_RETENTION_DAYS:
+            return False
+
+        cur.execute(
+            "SELECT pk FROM deleted_rows WHERE table_name = %s AND deleted_at > %s::timestamp - %s::interval",
+            (table, since, WATERMARK_OVERLAP)
+        )
+        deleted = [r["pk"] for r in cur.fetchall()]
+        cur.execute(
+            f"SELECT * FROM {self.live_source(table)} WHERE updated_at > %s::timestamp - %s::interval",
+            (since, WATERMARK_OVERLAP)
+        )
+        changed = [dict(r) for r in cur.fetchall()]
+
+        # сначала удаления: строка, удалённая и вставленная заново, останется
+        for pk in deleted:
+            self.apply_row_change(table, "DELETE", pk)
+        for row in changed:
+            self.apply_row_change(table, "UPDATE", row)
+        self.watermarks[table] = now
+        return True
 
     def get_table_columns(self, table):
         try:
@@ -531,18 +2532,16 @@ class DatabaseApp(ctk.CTk):
         widgets = {}
         fields = FIELD_NAMES.get(self.current_table, {})
 
-        # ---- Определяем PK поля таблицы ----
-        pk_field = None
-        for f in fields:
-            if f.endswith("_code") or f == "payment_id" or f.endswith("_id"):
-                pk_field = f
-                break
+        # ---- PK поля таблицы ----
+        pk_cols = TABLE_PKS.get(self.current_table, ())
+        # одиночный PK — SERIAL, при добавлении его не вводят;
+        # составной (contract_stages) вводится вручную
+        auto_pk = pk_cols[0] if len(pk_cols) == 1 else None
 
         # ---- READONLY поля при редактировании ----
         readonly_fields = set()
         if mode == "edit":
-            if pk_field:
-                readonly_fields.add(pk_field)
+            readonly_fields.update(pk_cols)
         for f in ("created_date", "created_at", "updated_at"):
             if f in fields and mode == "edit":
                 readonly_fields.add(f)
@@ -551,7 +2550,7 @@ class DatabaseApp(ctk.CTk):
         for field, label_text in fields.items():
 
             # --- при добавлении пропускаем PK и системные даты ---
-            if mode == "add" and (field == pk_field or field in ("created_date", "created_at", "updated_at")):
+            if mode == "add" and (field == auto_pk or field in ("created_date", "created_at", "updated_at")):
                 continue
 
             ctk.CTkLabel(frame, text=f"{label_text}:", anchor="w").pack(pady=(6, 2), anchor="w")
@@ -582,13 +2581,15 @@ class DatabaseApp(ctk.CTk):
                 continue
 
             # ---- FK-поля ----
-            if field.endswith("_code") or field.endswith("_id"):
-                vals = self.get_ref_list(field)
-                combo = ctk.CTkComboBox(frame, values=vals)
+            if field.endswith("_code"):
+                combo = self.fk_widget(frame, field)
                 if data and data.get(field) is not None:
-                    disp = self.get_display(field, data[field])
-                    try: combo.set(disp)
-                    except: pass
+                    if isinstance(combo, AutocompleteEntry):
+                        combo.set_code(data[field])
+                    else:
+                        disp = self.get_display(field, data[field])
+                        try: combo.set(disp)
+                        except: pass
                 combo.pack(fill="x", pady=2)
                 widgets[field] = ("fk", combo)
                 continue
@@ -619,6 +2620,8 @@ class DatabaseApp(ctk.CTk):
             widgets[field] = ("text_short", entry)
 
         def save():
+            if not self.require_online():
+                return
             values = {}
 
             for field, (wtype, w) in widgets.items():
@@ -636,8 +2639,10 @@ class DatabaseApp(ctk.CTk):
                     continue
 
                 if wtype == "fk":
-                    disp = w.get()
-                    values[field] = self.get_code_by_disp(field, disp)
+                    values[field] = self.fk_code(field, w)
+                    if values[field] is None and w.get().strip():
+                        messagebox.showerror("Ошибка", f"Выберите значение поля {fields[field]} из списка")
+                        return
                     continue
 
                 try:
@@ -645,29 +2650,11 @@ class DatabaseApp(ctk.CTk):
                 except:
                     val = ""
 
-                if val == "":
-                    values[field] = None
-                    continue
-
-                if wtype == "num":
-                    try:
-                        values[field] = Decimal(val)
-                    except:
-                        messagebox.showerror("Ошибка", f"Поле {field} должно быть числом")
-                        return
-
-                elif wtype == "date":
-                    try:
-                        if "." in val:
-                            dt = datetime.strptime(val, "%d.%m.%Y").date()
-                        else:
-                            dt = datetime.strptime(val, "%Y-%m-%d").date()
-                        values[field] = dt
-                    except:
-                        messagebox.showerror("Ошибка", f"Поле {field} должно быть датой")
-                        return
-                else:
-                    values[field] = val
+                try:
+                    values[field] = self.parse_field_value(field, val)
+                except ValueError as e:
+                    messagebox.showerror("Ошибка", str(e))
+                    return
 
             # ---- обязательные поля ----
             if self.current_table == "organizations" and not values.get("name"):
@@ -690,26 +2677,36 @@ class DatabaseApp(ctk.CTk):
 
                     cols = ", ".join(keys)
                     ph = ", ".join(["%s"] * len(vals))
-                    self.cursor.execute(f"INSERT INTO {self.current_table} ({cols}) VALUES ({ph})", vals)
+                    self.cursor.execute(f"INSERT INTO {self.current_table} ({cols}) VALUES ({ph}) RETURNING *", vals)
+                    op = "INSERT"
 
                 else:
-                    if not pk_field:
+                    if not pk_cols:
                         messagebox.showerror("Ошибка", "PK не найден")
                         return
 
-                    set_keys = [k for k in values if k != pk_field]
-                    params = [values[k] for k in set_keys] + [data[pk_field]]
+                    set_keys = [k for k in values if k not in pk_cols]
+                    params = [values[k] for k in set_keys] + [data[c] for c in pk_cols]
                     sets = ", ".join(f"{k}=%s" for k in set_keys)
+                    where = " AND ".join(f"{c} = %s" for c in pk_cols)
 
-                    self.cursor.execute(
-                        f"UPDATE {self.current_table} SET {sets} WHERE {pk_field} = %s",
+                    self.stmts.execute(
+                        self.cursor,
+                        f"UPDATE {self.current_table} SET {sets} WHERE {where} RETURNING *",
                         params
                     )
+                    op = "UPDATE"
 
+                row = self.fetch_row()
                 self.conn.commit()
                 self.invalidate_cache_for_table(self.current_table)
                 win.destroy()
-                self.refresh()
+                if row is not None:
+                    row = (self.with_display_names(self.current_table, [row]) or [row])[0]
+                    self.apply_row_change(self.current_table, op, row)
+                elif mode == "edit":
+                    # запись успели удалить
+                    self.apply_row_change(self.current_table, "DELETE", data)
 
             except Exception as e:
                 self.conn.rollback()
@@ -720,21 +2717,13 @@ class DatabaseApp(ctk.CTk):
 
 
     def get_ref_list(self, col):
-        mapping = {
-            "customer_code": ("organizations", "name", "organization_code"),
-            "executor_code": ("organizations", "name", "organization_code"),
-            "contract_type_code": ("contract_types", "type_name", "contract_type_code"),
-            "execution_stage_code": ("execution_stages", "stage_name", "stage_code"),
-            "vat_code": ("vat_rates", "description", "vat_code"),
-            "payment_type_code": ("payment_types", "payment_type_name", "payment_type_code"),
-            "stage_code": ("execution_stages", "stage_name", "stage_code"),
-            "contract_code": ("contracts", "topic", "contract_code")
-        }
-        if col not in mapping:
+        if col not in REF_MAPPING:
             return []
-        tbl, field, code_col = mapping[col]
+        tbl, field, code_col = REF_MAPPING[col]
         key = f"{tbl}_{field}"
         if key not in self.reference_cache:
+            if self.busy:
+                return []
             try:
                 self.cursor.execute(f"SELECT {code_col}, {field} FROM {tbl} ORDER BY {field}")
                 rows = self.cursor.fetchall()
@@ -758,19 +2747,9 @@ class DatabaseApp(ctk.CTk):
     def get_code_by_disp(self, col, disp):
         if not disp:
             return None
-        mapping = {
-            "customer_code": ("organizations", "name", "organization_code"),
-            "executor_code": ("organizations", "name", "organization_code"),
-            "contract_type_code": ("contract_types", "type_name", "contract_type_code"),
-            "execution_stage_code": ("execution_stages", "stage_name", "stage_code"),
-            "vat_code": ("vat_rates", "description", "vat_code"),
-            "payment_type_code": ("payment_types", "payment_type_name", "payment_type_code"),
-            "stage_code": ("execution_stages", "stage_name", "stage_code"),
-            "contract_code": ("contracts", "topic", "contract_code")
-        }
-        if col not in mapping:
+        if col not in REF_MAPPING:
             return None
-        tbl, field, code_col = mapping[col]
+        tbl, field, code_col = REF_MAPPING[col]
         cache_key = f"{tbl}_{field}"
         # try cache first
         if cache_key in self.reference_cache:
@@ -779,10 +2758,12 @@ class DatabaseApp(ctk.CTk):
             for k, v in cmap.items():
                 if str(v) == str(disp):
                     return k
+        if self.busy:
+            return None
         # otherwise query DB
         try:
             query = f"SELECT {code_col} FROM {tbl} WHERE {field} = %s LIMIT 1"
-            self.cursor.execute(query, (disp,))
+            self.stmts.execute(self.cursor, query, (disp,))
             result = self.cursor.fetchone()
             if not result:
                 return None
@@ -797,6 +2778,95 @@ class DatabaseApp(ctk.CTk):
                 pass
             return None
 
+    def typeahead_text(self, disp, code):
+        # код в подсказке различает организации с одинаковым названием
+        return f"{disp} [{code}]"
+
+    def typeahead(self, col, text):
+        """
+        Подсказки для AutocompleteEntry: [(текст, код)], не больше TYPEAHEAD_LIMIT.
+        Сначала совпадение по коду (если введено число) и по началу строки
+        (индекс lower(...) text_pattern_ops), затем — по вхождению/похожести
+        (триграммный индекс pg_trgm). Результаты кэшируются по тексту запроса.
+        None — соединение занято долгой операцией, повторить позже.
+        """
+        tbl, field, code_col = REF_MAPPING[col]
+        key = (tbl, field, text.lower())
+        cached = self.typeahead_cache.get(key)
+        if cached is not None:
+            self.typeahead_cache.move_to_end(key)
+            return cached
+        if self.busy:
+            return None
+
+        esc = self.like_escape(text.lower())
+        select = f"SELECT {code_col} AS code, {field} AS disp FROM {tbl}"
+        rows = []
+        try:
+            if text.isdigit() and len(text) <= 9:
+                self.cursor.execute(f"{select} WHERE {code_col} = %s", (int(text),))
+                rows += self.cursor.fetchall()
+            # шаблон подставляется в текст запроса, поэтому планировщик видит
+            # константный префикс и идёт по индексу
+            self.cursor.execute(
+                f"{select} WHERE lower({field}) LIKE %s ORDER BY lower({field}) LIMIT %s",
+                (esc + "%", TYPEAHEAD_LIMIT)
+            )
+            rows += self.cursor.fetchall()
+            if len(rows) < TYPEAHEAD_LIMIT and len(text) >= 3:
+                self.cursor.execute(
+                    f"{select} WHERE ({field} ILIKE %s OR {field} %% %s) AND lower({field}) NOT LIKE %s "
+                    f"ORDER BY similarity({field}, %s) DESC LIMIT %s",
+                    ("%" + esc + "%", text, esc + "%", text, TYPEAHEAD_LIMIT - len(rows))
+                )
+                rows += self.cursor.fetchall()
+        except psycopg2.Error:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            return []
+
+        found, seen = [], set()
+        for r in rows:
+            if r["code"] in seen or r["disp"] is None:
+                continue
+            seen.add(r["code"])
+            found.append((self.typeahead_text(r["disp"], r["code"]), r["code"]))
+
+        self.typeahead_cache[key] = found
+        while len(self.typeahead_cache) > 100:
+            self.typeahead_cache.popitem(last=False)
+        return found
+
+    def typeahead_label(self, col, code):
+        # текст для уже выбранного кода (форма редактирования)
+        tbl, field, code_col = REF_MAPPING[col]
+        if self.busy:
+            return self.typeahead_text("?", code)
+        try:
+            self.stmts.execute(self.cursor, f"SELECT {field} AS disp FROM {tbl} WHERE {code_col} = %s", (code,))
+            row = self.cursor.fetchone()
+        except psycopg2.Error:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            row = None
+        return self.typeahead_text(row["disp"] if row else "?", code)
+
+    def fk_widget(self, parent, col, width=400):
+        # поле выбора FK: поиск по мере ввода для больших справочников, иначе список
+        if REF_MAPPING[col][0] in TYPEAHEAD_TABLES:
+            return AutocompleteEntry(parent, self, col, width=width)
+        return ctk.CTkComboBox(parent, values=self.get_ref_list(col), width=width)
+
+    def fk_code(self, col, widget):
+        if isinstance(widget, AutocompleteEntry):
+            return widget.get_code()
+        disp = widget.get()
+        return self.get_code_by_disp(col, disp) if disp else None
+
     def create_form(self, parent, table, exclude=None):
         exclude = exclude or []
         try:
@@ -816,7 +2886,7 @@ class DatabaseApp(ctk.CTk):
     def add_contract_with_stages(self):
         win = ctk.CTkToplevel(self)
         win.title("Создание договора с этапами")
-        win.geometry("950x800")
+        win.geometry("1100x800")
         win.minsize(900, 700)
 
         # Главный скролл
@@ -839,7 +2909,7 @@ class DatabaseApp(ctk.CTk):
             rus_name = FIELD_NAMES["contracts"].get(field, field)
             ctk.CTkLabel(contract_frame, text=f"{rus_name}:", anchor="w").grid(row=i, column=0, sticky="w", padx=10, pady=4)
             if field.endswith("_code"):
-                combo = ctk.CTkComboBox(contract_frame, values=self.get_ref_list(field), width=400)
+                combo = self.fk_widget(contract_frame, field)
                 combo.grid(row=i, column=1, padx=10, pady=4, sticky="ew")
                 contract_widgets[field] = combo
             else:
@@ -854,119 +2924,23 @@ class DatabaseApp(ctk.CTk):
         stages_frame = ctk.CTkFrame(main_container)
         stages_frame.pack(fill="both", expand=True, pady=10)
 
-        stages_list = []
-
-        display_box = ctk.CTkTextbox(stages_frame, height=180, font=("Arial", 11))
-        display_box.pack(fill="both", expand=True, padx=10, pady=5)
-        display_box.insert("1.0", "Этапы ещё не добавлены...\n")
-        display_box.configure(state="disabled")
-
-        def update_display():
-            display_box.configure(state="normal")
-            display_box.delete("1.0", "end")
-            if not stages_list:
-                display_box.insert("1.0", "Этапы ещё не добавлены...\n")
-            else:
-                for i, stage in enumerate(stages_list, 1):
-                    topic = stage.get("topic") or "Без темы"
-                    amount = stage.get("stage_amount") or "0"
-                    date = stage.get("stage_execution_date") or ""
-                    display_box.insert("end", f"{i}. {topic} — {amount} руб. (план: {date})\n")
-            display_box.configure(state="disabled")
-
-        def add_stage():
-            stage_win = ctk.CTkToplevel(win)
-            stage_win.title("Новый этап")
-            stage_win.geometry("700x650")
-
-            stage_widgets = {}
-            stage_fields = ["stage_number", "stage_execution_date", "stage_code", "stage_amount", "advance_amount", "topic", "notes"]
-
-            for field in stage_fields:
-                rus = FIELD_NAMES["contract_stages"].get(field, field)
-                ctk.CTkLabel(stage_win, text=f"{rus}:", anchor="w").pack(pady=(10, 2), padx=20, anchor="w")
-                if field == "stage_code":
-                    combo = ctk.CTkComboBox(stage_win, values=self.get_ref_list("stage_code"), width=400)
-                    combo.pack(pady=2, padx=20, fill="x")
-                    stage_widgets[field] = combo
-                else:
-                    entry = ctk.CTkEntry(stage_win, width=400)
-                    entry.pack(pady=2, padx=20, fill="x")
-                    stage_widgets[field] = entry
-
-            def save_stage():
-                stage_data = {}
-                for field, widget in stage_widgets.items():
-                    val = ""
-                    try:
-                        val = widget.get().strip()
-                    except Exception:
-                        val = ""
-                    if field == "stage_code":
-                        val = self.get_code_by_disp(field, val)
-                    elif val == "":
-                        val = None
-                    else:
-                        if field in ("stage_amount", "advance_amount"):
-                            try:
-                                val = Decimal(val)
-                            except InvalidOperation:
-                                messagebox.showerror("Ошибка", f"Поле {field} должно быть числом")
-                                return
-                        elif "date" in field and val is not None:
-                            try:
-                                if "." in val:
-                                    dt = datetime.strptime(val, "%d.%m.%Y").date()
-                                else:
-                                    dt = datetime.strptime(val, "%Y-%m-%d").date()
-                                val = dt
-                            except Exception:
-                                messagebox.showerror("Ошибка", f"Поле {field} должно быть датой")
-                                return
-                    stage_data[field] = val
-                # ensure unique stage_number for this contract's stages_list
-                if any(s.get("stage_number") == stage_data.get("stage_number") for s in stages_list if stage_data.get("stage_number") is not None):
-                    messagebox.showerror("Ошибка", "Этап с таким номером уже есть в списке")
-                    return
-                stages_list.append(stage_data)
-                update_display()
-                stage_win.destroy()
-
-            ctk.CTkButton(stage_win, text="Сохранить этап", fg_color="green", command=save_stage).pack(pady=20)
-
-        ctk.CTkButton(stages_frame, text="+ Добавить этап", fg_color="#0066cc", command=add_stage).pack(pady=8)
+        stages_grid = BatchEntryGrid(stages_frame, self, "contract_stages", height=8)
+        stages_grid.pack(fill="both", expand=True, padx=10, pady=5)
 
         # === СОХРАНЕНИЕ ===
         def save_all():
+            if not self.require_online():
+                return
             contract_data = {}
             for field, widget in contract_widgets.items():
                 try:
                     if field.endswith("_code"):
-                        disp = widget.get()
-                        contract_data[field] = self.get_code_by_disp(field, disp) if disp else None
+                        contract_data[field] = self.fk_code(field, widget)
                     else:
-                        val = widget.get().strip()
-                        if val == "":
-                            contract_data[field] = None
-                        else:
-                            if "amount" in field:
-                                try:
-                                    contract_data[field] = Decimal(val)
-                                except InvalidOperation:
-                                    messagebox.showerror("Ошибка", f"Поле {field} должно быть числом")
-                                    return
-                            elif "date" in field:
-                                try:
-                                    if "." in val:
-                                        dt = datetime.strptime(val, "%d.%m.%Y").date()
-                                    else:
-                                        dt = datetime.strptime(val, "%Y-%m-%d").date()
-                                    contract_data[field] = dt
-                                except Exception:
-                                    messagebox.showerror("Ошибка", f"Поле {field} должно быть датой")
-                                    return
-                            else:
-                                contract_data[field] = val
+                        contract_data[field] = self.parse_field_value(field, widget.get())
+                except ValueError as e:
+                    messagebox.showerror("Ошибка", str(e))
+                    return
                 except Exception:
                     contract_data[field] = None
 
@@ -974,6 +2948,10 @@ class DatabaseApp(ctk.CTk):
             if not contract_data.get("topic"):
                 messagebox.showerror("Ошибка", "Поле 'Тема' обязательно")
                 return
+            if stages_grid.error_count():
+                messagebox.showerror("Ошибка", f"Исправьте или удалите этапы с ошибками ({stages_grid.error_count()})")
+                return
+            stages_list = stages_grid.rows()
             if not stages_list:
                 messagebox.showwarning("Внимание", "Договор создаётся без этапов. Продолжить?")
                 # allow empty stages
@@ -983,26 +2961,26 @@ class DatabaseApp(ctk.CTk):
                 cols = ", ".join(contract_data.keys())
                 ph = ", ".join(["%s"] * len(contract_data))
                 self.cursor.execute(
-                    f"INSERT INTO contracts ({cols}) VALUES ({ph}) RETURNING contract_code",
+                    f"INSERT INTO contracts ({cols}) VALUES ({ph}) RETURNING *",
                     list(contract_data.values())
                 )
-                result = self.cursor.fetchone()
-                contract_id = result['contract_code'] if isinstance(result, dict) else result[0]
-
-                for stage in stages_list:
-                    stage["contract_code"] = contract_id
-                    stage_cols = ", ".join(stage.keys())
-                    stage_ph = ", ".join(["%s"] * len(stage))
-                    self.cursor.execute(
-                        f"INSERT INTO contract_stages ({stage_cols}) VALUES ({stage_ph})",
-                        list(stage.values())
-                    )
+                contract_row = self.fetch_row()
+                contract_id = contract_row["contract_code"]
+
+                stage_rows = []
+                if stages_list:
+                    for stage in stages_list:
+                        stage["contract_code"] = contract_id
+                    stage_rows = self.insert_rows("contract_stages", stages_list)
                 self.conn.commit()
                 self.invalidate_cache_for_table("contracts")
                 self.invalidate_cache_for_table("contract_stages")
                 messagebox.showinfo("Успех", "Договор сохранён!")
                 win.destroy()
-                self.refresh()
+                contract_row = (self.with_display_names("contracts", [contract_row]) or [contract_row])[0]
+                self.apply_row_change("contracts", "INSERT", contract_row)
+                for stage_row in stage_rows:
+                    self.apply_row_change("contract_stages", "INSERT", stage_row)
             except Exception as e:
                 try:
                     self.conn.rollback()
@@ -1014,191 +2992,219 @@ class DatabaseApp(ctk.CTk):
 
         # -------------------- Параметры отчётов (фильтры + сортировка) --------------------
 
-    REPORT_DEFS = {
-        "contract_details": {
-            "title": "Сведения по договорам",
-            "fields": {
-                # label: (sql_expression, type)
-                "Код договора": ("c.contract_code", "int"),
-                "Тема": ("c.topic", "text"),
-                "№ этапа": ("cs.stage_number", "int"),
-                "Сумма этапа": ("cs.stage_amount", "num"),
-                "Оплачено по договору": ("COALESCE(pay.total_paid, 0)", "num"),
-                "Дебиторка": ("(c.total_amount - COALESCE(pay.total_paid, 0))", "num"),
-            },
-            "default_sort": ("c.contract_code", "ASC"),
-        },
-        "planned": {
-            "title": "Плановый график оплат по договорам",
-            "fields": {
-                "Код договора": ("c.contract_code", "int"),
-                "Тема": ("c.topic", "text"),
-                "План. дата": ("cs.stage_execution_date", "date"),
-                "Сумма этапа": ("cs.stage_amount", "num"),
-            },
-            "default_sort": ("cs.stage_execution_date", "ASC"),
-        },
-        "actual": {
-            "title": "Фактические поступления по договорам",
-            "fields": {
-                "Код договора": ("c.contract_code", "int"),
-                "Тема": ("c.topic", "text"),
-                "Дата платежа": ("p.payment_date", "date"),
-                "Сумма платежа": ("p.payment_amount", "num"),
-                "Вид оплаты": ("pt.payment_type_name", "text"),
-                "№ документа": ("p.payment_document_number", "text"),
-            },
-            "default_sort": ("p.payment_date", "ASC"),
-        },
-    }
-
-    def _build_where_and_order(self, report_key, f1, f2, sort_field_label, sort_dir):
+    @staticmethod
+    def like_escape(text):
+        # текст как литерал внутри шаблона LIKE (экранирующий символ по умолчанию — обратная косая черта)
+        return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    @staticmethod
+    def parse_date_range(raw):
+        """
+        Дата в условии отчёта как полуоткрытый интервал [начало, конец):
+        ДД.ММ.ГГГГ или ГГГГ-ММ-ДД — день, ММ.ГГГГ или ГГГГ-ММ — месяц, ГГГГ — год.
+        """
+        for fmt, unit in (("%d.%m.%Y", "day"), ("%Y-%m-%d", "day"),
+                          ("%m.%Y", "month"), ("%Y-%m", "month"), ("%Y", "year")):
+            try:
+                start = datetime.strptime(raw.strip(), fmt).date()
+            except ValueError:
+                continue
+            if unit == "day":
+                return start, start + timedelta(days=1)
+            if unit == "month":
+                return start, (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+            return start, start.replace(year=start.year + 1)
+        raise ValueError("ожидается ДД.ММ.ГГГГ, ММ.ГГГГ, ГГГГ или ГГГГ-ММ-ДД")
+
+    def _compile_condition(self, expr, ftype, op, raw):
+        """
+        Одно условие отчёта -> (SQL, параметры) в форме, пригодной для индекса:
+        выражение поля без функций сравнивается со значением, даты — интервалом
+        [начало, конец) (и отсечение секций payments), "starts" — lower(...) LIKE
+        'префикс%' (индексы text_pattern_ops), "contains" — ILIKE '%...%',
+        который обслуживает триграммный индекс pg_trgm.
+        """
+        if op not in FILTER_OPS[ftype]:
+            raise ValueError("оператор не подходит для поля")
+        values = [raw]
+        if op in ("in", "between"):
+            values = [v.strip() for v in raw.split(";") if v.strip()]
+            if op == "between" and len(values) != 2:
+                raise ValueError("для between нужны два значения через ';'")
+
+        if ftype == "date":
+            ranges = [self.parse_date_range(v) for v in values]
+            if op == ">=":
+                return f"{expr} >= %s::date", [ranges[0][0]]
+            if op == "<=":
+                return f"{expr} < %s::date", [ranges[0][1]]
+            if op == "between":
+                return f"{expr} >= %s::date AND {expr} < %s::date", [ranges[0][0], ranges[1][1]]
+            # "=" и "in": каждый день, месяц или год — свой интервал
+            sql = " OR ".join([f"({expr} >= %s::date AND {expr} < %s::date)"] * len(ranges))
+            return (f"({sql})" if len(ranges) > 1 else sql), [d for r in ranges for d in r]
+
+        if ftype in ("int", "num"):
+            try:
+                nums = [int(v) if ftype == "int" else Decimal(v.replace(" ", "").replace(",", ".")) for v in values]
+            except (ValueError, InvalidOperation):
+                raise ValueError("ожидается число")
+            if any(isinstance(n, Decimal) and not n.is_finite() for n in nums):
+                raise ValueError("ожидается число")
+            if op == "between":
+                return f"{expr} BETWEEN %s AND %s", nums
+            if op == "in":
+                return f"{expr} = ANY(%s)", [nums]
+            return f"{expr} {op} %s", nums
+
+        # text
+        if op == "=":
+            return f"{expr} = %s", [raw]
+        if op == "in":
+            return f"{expr} = ANY(%s)", [values]
+        if op == "starts":
+            return f"lower({expr}) LIKE %s", [self.like_escape(raw.lower()) + "%"]
+        if op == "contains":
+            return f"{expr} ILIKE %s", ["%" + self.like_escape(raw) + "%"]
+        # words: все слова в любой форме; для темы договора — по GIN-индексу вместе с примечанием
+        vector = FTS_FIELD_EXPRS.get(expr, f"to_tsvector('russian', COALESCE({expr}, ''))")
+        return f"{vector} @@ websearch_to_tsquery('russian', %s)", [raw]
+
+    def _build_where_and_order(self, report_key, conditions, sort_field_label, sort_dir):
         """
-        f1/f2: dict with keys: enabled(bool), field_label(str), op(str), value(str)
+        conditions: [{"group": номер, "field_label", "op", "value"}]; условия одной
+        группы объединяются через AND, группы между собой — через OR; условие
+        с пустым значением не применяется.
         sort_field_label: Russian label from REPORT_DEFS[...]["fields"]
         sort_dir: "ASC"/"DESC"
+        Возвращает (where_sql, order, params), order = (выражение, тип, по убыванию);
+        при ошибке в условии — (None, None, None).
         """
-        rep = self.REPORT_DEFS[report_key]
+        rep = REPORT_DEFS[report_key]
         fields = rep["fields"]
 
-        where_parts = []
-        params = []
-
-        def add_filter(f):
-            if not f.get("enabled"):
-                return
-            label = f.get("field_label")
-            op = f.get("op")
-            raw = (f.get("value") or "").strip()
+        groups = {}  # номер группы -> ([SQL условий], [параметры])
+        for cond in conditions:
+            label = cond.get("field_label")
+            op = cond.get("op")
+            raw = (cond.get("value") or "").strip()
             if not label or label not in fields or raw == "":
-                return
-
+                continue
             expr, ftype = fields[label]
-
-            # нормализуем оператор
-            allowed_ops = {"=", ">=", "<=", "contains", "starts"}
-            if op not in allowed_ops:
-                return
-
-            if ftype in ("int", "num"):
-                try:
-                    val = Decimal(raw) if ftype == "num" else int(raw)
-                except Exception:
-                    messagebox.showerror("Ошибка", f"Неверное значение для фильтра '{label}'")
-                    raise
-                if op in ("contains", "starts"):
-                    messagebox.showerror("Ошибка", f"Оператор '{op}' не подходит для поля '{label}'")
-                    raise
-                where_parts.append(f"{expr} {op} %s")
-                params.append(val)
-                return
-
-            if ftype == "date":
-                try:
-                    if "." in raw:
-                        val = datetime.strptime(raw, "%d.%m.%Y").date()
-                    else:
-                        val = datetime.strptime(raw, "%Y-%m-%d").date()
-                except Exception:
-                    messagebox.showerror("Ошибка", f"Неверная дата для фильтра '{label}' (ожидается ДД.ММ.ГГГГ или ГГГГ-ММ-ДД)")
-                    raise
-                if op in ("contains", "starts"):
-                    messagebox.showerror("Ошибка", f"Оператор '{op}' не подходит для поля '{label}'")
-                    raise
-                where_parts.append(f"{expr} {op} %s")
-                params.append(val)
-                return
-
-            # text
-            if op == "=":
-                where_parts.append(f"{expr} = %s")
-                params.append(raw)
-            elif op == "contains":
-                where_parts.append(f"{expr} ILIKE %s")
-                params.append(f"%{raw}%")
-            elif op == "starts":
-                where_parts.append(f"{expr} ILIKE %s")
-                params.append(f"{raw}%")
-            else:
-                messagebox.showerror("Ошибка", f"Оператор '{op}' не подходит для поля '{label}'")
-                raise
-
-        try:
-            add_filter(f1)
-            add_filter(f2)
-        except Exception:
-            # ошибки уже показали messagebox
-            return None, None, None
-
-        where_sql = ""
-        if where_parts:
-            where_sql = "WHERE " + " AND ".join(where_parts)
+            try:
+                sql, cond_params = self._compile_condition(expr, ftype, op, raw)
+            except ValueError as e:
+                messagebox.showerror("Ошибка", f"Условие '{label} {op} {raw}': {e}")
+                return None, None, None
+            parts, group_params = groups.setdefault(cond.get("group", 1), ([], []))
+            parts.append(sql)
+            group_params.extend(cond_params)
+
+        where_sql, params = "", []
+        alternatives = []
+        for number in sorted(groups):
+            parts, group_params = groups[number]
+            alternatives.append(" AND ".join(parts))
+            params.extend(group_params)
+        if len(alternatives) == 1:
+            where_sql = "WHERE " + alternatives[0]
+        elif alternatives:
+            # в общих скобках: run_report добавляет к WHERE условие страницы через AND
+            where_sql = "WHERE (" + " OR ".join(f"({a})" for a in alternatives) + ")"
 
         # сортировка только из белого списка
         if sort_field_label and sort_field_label in fields:
-            order_expr = fields[sort_field_label][0]
+            order_expr, order_type = fields[sort_field_label]
             order_dir = "DESC" if (sort_dir == "DESC") else "ASC"
         else:
             order_expr, order_dir = rep["default_sort"]
+            order_type = next((t for e, t in fields.values() if e == order_expr), "text")
 
-        order_sql = f"ORDER BY {order_expr} {order_dir}"
+        return where_sql, (order_expr, order_type, order_dir == "DESC"), params
 
-        return where_sql, order_sql, params
+    def load_report_presets(self):
+        # {отчёт: {название набора: {"conditions", "sort_field", "sort_dir", "archive"}}}
+        if not REPORT_PRESETS_PATH:
+            return {}
+        try:
+            with open(REPORT_PRESETS_PATH, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_report_presets(self, presets):
+        with open(REPORT_PRESETS_PATH, "w", encoding="utf-8") as f:
+            json.dump(presets, f, ensure_ascii=False, indent=2)
 
     def ask_report_params(self, report_key):
         """
-        Возвращает (where_sql, order_sql, params) или (None, None, None) если отмена.
+        Возвращает (where_sql, order, params, include_archive)
+        или (None, None, None, False) если отмена.
         """
-        rep = self.REPORT_DEFS[report_key]
+        rep = REPORT_DEFS[report_key]
         fields_labels = list(rep["fields"].keys())
 
         win = ctk.CTkToplevel(self)
         win.title("Параметры отчёта")
-        win.geometry("720x520")
+        win.geometry("860x680")
         win.grab_set()  # модальное
         win.focus_force()
 
         ctk.CTkLabel(win, text=rep["title"], font=("Arial", 18, "bold")).pack(pady=(15, 10))
 
-        # --- ФИЛЬТР 1 ---
-        box1 = ctk.CTkFrame(win)
-        box1.pack(fill="x", padx=15, pady=(10, 6))
-        ctk.CTkLabel(box1, text="Фильтр 1", font=("Arial", 14, "bold")).grid(row=0, column=0, sticky="w", padx=10, pady=8)
-
-        f1_enabled = tk.BooleanVar(value=False)
-        c1 = ctk.CTkCheckBox(box1, text="включить", variable=f1_enabled)
-        c1.grid(row=0, column=1, sticky="w", padx=10)
-
-        f1_field = ctk.CTkComboBox(box1, values=fields_labels, width=240)
-        f1_field.set(fields_labels[0] if fields_labels else "")
-        f1_field.grid(row=1, column=0, padx=10, pady=6, sticky="w")
-
-        f1_op = ctk.CTkComboBox(box1, values=["=", ">=", "<=", "contains", "starts"], width=130)
-        f1_op.set("contains")
-        f1_op.grid(row=1, column=1, padx=10, pady=6, sticky="w")
-
-        f1_val = ctk.CTkEntry(box1, width=260, placeholder_text="значение")
-        f1_val.grid(row=1, column=2, padx=10, pady=6, sticky="w")
-
-        # --- ФИЛЬТР 2 ---
-        box2 = ctk.CTkFrame(win)
-        box2.pack(fill="x", padx=15, pady=(6, 10))
-        ctk.CTkLabel(box2, text="Фильтр 2", font=("Arial", 14, "bold")).grid(row=0, column=0, sticky="w", padx=10, pady=8)
-
-        f2_enabled = tk.BooleanVar(value=False)
-        c2 = ctk.CTkCheckBox(box2, text="включить", variable=f2_enabled)
-        c2.grid(row=0, column=1, sticky="w", padx=10)
-
-        f2_field = ctk.CTkComboBox(box2, values=fields_labels, width=240)
-        f2_field.set(fields_labels[0] if fields_labels else "")
-        f2_field.grid(row=1, column=0, padx=10, pady=6, sticky="w")
-
-        f2_op = ctk.CTkComboBox(box2, values=["=", ">=", "<=", "contains", "starts"], width=130)
-        f2_op.set("contains")
-        f2_op.grid(row=1, column=1, padx=10, pady=6, sticky="w")
-
-        f2_val = ctk.CTkEntry(box2, width=260, placeholder_text="значение")
-        f2_val.grid(row=1, column=2, padx=10, pady=6, sticky="w")
+        # --- УСЛОВИЯ ---
+        ctk.CTkLabel(win, text="Условия", font=("Arial", 14, "bold")).pack(anchor="w", padx=25)
+        ctk.CTkLabel(
+            win, anchor="w", justify="left", font=("Arial", 12),
+            text="Условия одной группы выполняются вместе (И), группы — любая из них (ИЛИ). "
+                 "in — значения через ';', between — 'от; до'.\n"
+                 "Даты: ДД.ММ.ГГГГ, ММ.ГГГГ (месяц) или ГГГГ (год). Условие с пустым значением не применяется."
+        ).pack(fill="x", padx=25)
+        cond_box = ctk.CTkScrollableFrame(win, height=200)
+        cond_box.pack(fill="x", padx=15, pady=(6, 4))
+        cond_rows = []
+
+        def set_ops(op_box, label):
+            ops = list(FILTER_OPS[rep["fields"][label][1]]) if label in rep["fields"] else []
+            op_box.configure(values=ops)
+            if ops and op_box.get() not in ops:
+                op_box.set(ops[0])
+
+        def add_condition(cond=None):
+            cond = cond or {}
+            row = ctk.CTkFrame(cond_box, fg_color="transparent")
+            row.pack(fill="x", pady=2)
+            entry = {"frame": row}
+            group = ctk.CTkComboBox(row, values=[str(i) for i in range(1, FILTER_GROUPS + 1)], width=70)
+            group.set(str(cond.get("group", 1)))
+            op = ctk.CTkComboBox(row, values=[], width=120)
+            field = ctk.CTkComboBox(row, values=fields_labels, width=240, command=lambda lbl: set_ops(op, lbl))
+            field.set(cond.get("field_label") or (fields_labels[0] if fields_labels else ""))
+            set_ops(op, field.get())
+            if cond.get("op"):
+                op.set(cond["op"])
+            value = ctk.CTkEntry(row, width=280, placeholder_text="значение")
+            if cond.get("value"):
+                value.insert(0, cond["value"])
+            for w in (group, field, op):
+                w.pack(side="left", padx=4)
+            value.pack(side="left", padx=4, fill="x", expand=True)
+            ctk.CTkButton(row, text="✕", width=30, fg_color="#555",
+                          command=lambda: remove_condition(entry)).pack(side="left", padx=4)
+            entry.update(group=group, field=field, op=op, value=value)
+            cond_rows.append(entry)
+
+        def remove_condition(entry):
+            cond_rows.remove(entry)
+            entry["frame"].destroy()
+
+        def current_conditions():
+            return [{"group": int(e["group"].get()) if e["group"].get().isdigit() else 1,
+                     "field_label": e["field"].get(), "op": e["op"].get(), "value": e["value"].get()}
+                    for e in cond_rows]
+
+        ctk.CTkButton(win, text="+ Условие", width=120, command=add_condition).pack(anchor="w", padx=25)
+        add_condition()
 
         # --- СОРТИРОВКА ---
         sort_box = ctk.CTkFrame(win)
@@ -1222,19 +3228,83 @@ class DatabaseApp(ctk.CTk):
         sort_dir.set(default_dir)
         sort_dir.grid(row=1, column=1, padx=10, pady=8, sticky="w")
 
+        # архив закрытых договоров — только по явному запросу
+        archive_var = tk.BooleanVar(value=False)
+        if rep.get("archive"):
+            ctk.CTkCheckBox(win, text="Включая архив", variable=archive_var).pack(anchor="w", padx=25, pady=(0, 5))
+
+        # --- СОХРАНЁННЫЕ НАБОРЫ УСЛОВИЙ ---
+        if REPORT_PRESETS_PATH:
+            presets = self.load_report_presets()
+            report_presets = presets.setdefault(report_key, {})
+            preset_box = ctk.CTkFrame(win)
+            preset_box.pack(fill="x", padx=15, pady=6)
+            ctk.CTkLabel(preset_box, text="Набор условий:", font=("Arial", 14)).pack(side="left", padx=10, pady=8)
+            preset_name = ctk.CTkComboBox(preset_box, values=sorted(report_presets), width=260)
+            preset_name.set("")
+            preset_name.pack(side="left", padx=5)
+
+            def apply_preset():
+                preset = report_presets.get(preset_name.get())
+                if not preset:
+                    return
+                for e in list(cond_rows):
+                    remove_condition(e)
+                for cond in preset["conditions"]:
+                    add_condition(cond)
+                if not cond_rows:
+                    add_condition()
+                sort_field.set(preset.get("sort_field") or sort_field.get())
+                sort_dir.set(preset.get("sort_dir") or sort_dir.get())
+                archive_var.set(bool(preset.get("archive")) and bool(rep.get("archive")))
+
+            def write_presets():
+                try:
+                    self.save_report_presets(presets)
+                except OSError as e:
+                    messagebox.showerror("Ошибка", f"Не удалось сохранить наборы условий:\n{e}", parent=win)
+                preset_name.configure(values=sorted(report_presets))
+
+            def save_preset():
+                name = ctk.CTkInputDialog(text="Название набора условий:", title="Сохранить набор").get_input()
+                win.grab_set()
+                name = (name or "").strip()
+                if not name:
+                    return
+                report_presets[name] = {
+                    "conditions": [c for c in current_conditions() if c["value"].strip()],
+                    "sort_field": sort_field.get(),
+                    "sort_dir": sort_dir.get(),
+                    "archive": bool(archive_var.get()),
+                }
+                write_presets()
+                preset_name.set(name)
+
+            def delete_preset():
+                name = preset_name.get()
+                if name in report_presets and messagebox.askyesno("Удаление", f"Удалить набор '{name}'?", parent=win):
+                    del report_presets[name]
+                    write_presets()
+                    preset_name.set("")
+
+            ctk.CTkButton(preset_box, text="Применить", width=100, command=apply_preset).pack(side="left", padx=5)
+            ctk.CTkButton(preset_box, text="Сохранить как…", width=130, command=save_preset).pack(side="left", padx=5)
+            ctk.CTkButton(preset_box, text="Удалить", width=90, fg_color="#555",
+                          command=delete_preset).pack(side="left", padx=5)
+
         # --- КНОПКИ ---
-        result = {"ok": False, "where": None, "order": None, "params": None}
+        result = {"ok": False, "where": None, "order": None, "params": None, "archive": False}
 
         def on_ok():
-            f1 = {"enabled": bool(f1_enabled.get()), "field_label": f1_field.get(), "op": f1_op.get(), "value": f1_val.get()}
-            f2 = {"enabled": bool(f2_enabled.get()), "field_label": f2_field.get(), "op": f2_op.get(), "value": f2_val.get()}
-            where_sql, order_sql, params = self._build_where_and_order(report_key, f1, f2, sort_field.get(), sort_dir.get())
+            where_sql, order, params = self._build_where_and_order(
+                report_key, current_conditions(), sort_field.get(), sort_dir.get())
             if where_sql is None:
                 return
             result["ok"] = True
             result["where"] = where_sql
-            result["order"] = order_sql
+            result["order"] = order
             result["params"] = params
+            result["archive"] = bool(archive_var.get())
             win.destroy()
 
         def on_cancel():
@@ -1249,12 +3319,20 @@ class DatabaseApp(ctk.CTk):
         self.wait_window(win)
 
         if not result["ok"]:
-            return None, None, None
-        return result["where"], result["order"], result["params"]
+            return None, None, None, False
+        return result["where"], result["order"], result["params"], result["archive"]
 
     
     # Отчёты
-    def show_report(self, title, rows):
+    def show_report(self, title, rows, totals=None, tables=(), reload=None, more=None):
+        """
+        totals: строка итогов под таблицей (см. format_totals).
+        tables/reload: из каких таблиц собран отчёт и как его перезапросить
+        (reload() -> (rows, totals)) — тогда окно само обновляется
+        по живой ленте изменений.
+        more: следующая страница строк (more() -> (rows, есть ли ещё)) —
+        тогда под таблицей кнопка "Загрузить ещё".
+        """
         win = ctk.CTkToplevel(self)
         win.title(title)
         win.geometry("1200x700")
@@ -1262,12 +3340,15 @@ class DatabaseApp(ctk.CTk):
         tree = ttk.Treeview(win, style="Treeview")
         tree.pack(fill="both", expand=True, padx=10, pady=10)
 
+        totals_lbl = ctk.CTkLabel(win, text=totals or "", anchor="w", font=("Arial", 13))
+        totals_lbl.pack(fill="x", padx=10, pady=(0, 10))
+
         if not rows:
             ctk.CTkLabel(win, text="Нет данных").pack()
             return
 
-        # rows = list[dict]
-        cols = list(rows[0].keys())
+        # rows = list[dict]; _keyN — служебные колонки постраничного чтения
+        cols = [c for c in rows[0].keys() if not str(c).startswith("_key")]
         tree["columns"] = cols
         tree["show"] = "headings"
 
@@ -1275,102 +3356,424 @@ class DatabaseApp(ctk.CTk):
             tree.heading(c, text=str(c).replace("_", " "))
             tree.column(c, width=170)
 
-        for r in rows:
-            tree.insert("", "end", values=[r.get(c) for c in cols])
-
-
+        pager = None
+        if more:
+            pager = ctk.CTkFrame(win, fg_color="transparent")
+            pager.pack(fill="x", padx=10, pady=(0, 10))
+            loaded_lbl = ctk.CTkLabel(pager, text="", font=("Arial", 13))
 
-    def report_contract_details(self):
-        where_sql, order_sql, params = self.ask_report_params("contract_details")
+            def load_more():
+                if not self.require_online():
+                    return
+                try:
+                    new_rows, has_more = more()
+                except Exception as e:
+                    try:
+                        self.conn.rollback()
+                    except:
+                        pass
+                    messagebox.showerror("Ошибка отчёта", str(e), parent=win)
+                    return
+                for r in new_rows:
+                    tree.insert("", "end", values=[r.get(c) for c in cols])
+                loaded_lbl.configure(text=f"Загружено строк: {len(tree.get_children())}")
+                if not has_more:
+                    more_btn.configure(state="disabled", text="Все строки загружены")
+
+            more_btn = ctk.CTkButton(pager, text="Загрузить ещё", width=160, command=load_more)
+            more_btn.pack(side="left")
+            loaded_lbl.pack(side="left", padx=10)
+
+        def fill(rows, totals=None):
+            for i in tree.get_children():
+                tree.delete(i)
+            for r in rows:
+                tree.insert("", "end", values=[r.get(c) for c in cols])
+            if totals is not None:
+                totals_lbl.configure(text=totals)
+            if pager is not None:
+                loaded_lbl.configure(text=f"Загружено строк: {len(rows)}")
+
+        fill(rows)
+
+        if reload and tables:
+            entry = {"win": win, "tables": set(tables), "reload": reload, "fill": fill, "pending": False}
+            self.open_reports.append(entry)
+
+            def on_destroy(event):
+                if event.widget is win and entry in self.open_reports:
+                    self.open_reports.remove(entry)
+
+            win.bind("<Destroy>", on_destroy, add="+")
+
+    def fetch_report_rows(self, q, params):
+        cur = self.reader()[1]
+        self.stmts.execute(cur, q, params)
+        return cur.fetchall()
+
+    def totals_query(self, source, num_exprs, where_sql=""):
+        # COUNT + SUM/MIN/MAX по числовым колонкам одним проходом на сервере
+        parts = ["COUNT(*) AS cnt"]
+        for i, expr in enumerate(num_exprs):
+            parts += [f"SUM({expr}) AS sum{i}", f"MIN({expr}) AS min{i}", f"MAX({expr}) AS max{i}"]
+        return f"SELECT {', '.join(parts)} FROM {source} {where_sql}"
+
+    def format_totals(self, totals, labels):
+        def num(v):
+            return "—" if v is None else f"{Decimal(v):,.2f}".replace(",", " ")
+        parts = [f"Записей: {totals['cnt']:,}".replace(",", " ")]
+        for i, label in enumerate(labels):
+            parts.append(
+                f"{label}: Σ {num(totals[f'sum{i}'])} (мин {num(totals[f'min{i}'])}, макс {num(totals[f'max{i}'])})"
+            )
+        return "   |   ".join(parts)
+
+
+
+    def run_report(self, report_key):
+        if not self.require_online():
+            return
+        where_sql, order, params, include_archive = self.ask_report_params(report_key)
         if where_sql is None:
             return  # отмена
 
-        q = f"""
-            SELECT 
-                c.contract_code AS "Код договора",
-                c.topic AS "Тема",
-                cs.stage_number AS "№ этапа",
-                cs.stage_amount AS "Сумма этапа",
-                COALESCE(pay.total_paid, 0) AS "Оплачено по договору(итого)",
-                (c.total_amount - COALESCE(pay.total_paid, 0)) AS "Дебиторская задолженность(итого)"
-            FROM contracts c
-            JOIN contract_stages cs 
-                ON c.contract_code = cs.contract_code
-            LEFT JOIN (
-                SELECT contract_code, SUM(payment_amount) AS total_paid
-                FROM payments
-                GROUP BY contract_code
-            ) pay ON c.contract_code = pay.contract_code
-            {where_sql}
-            {order_sql};
-        """
+        rep = REPORT_DEFS[report_key]
+        # {contracts} и т.п. в тексте отчёта: рабочая таблица или объединение с архивом
+        sources = {t: f"{t}_all" if include_archive else t for t in ARCHIVED_TABLES}
+        base = rep["sql"].format(where=where_sql, keys="", **sources)
+        # итоги считает сервер по тому же WHERE, а не клиент по загруженным строкам
+        totals_q = self.totals_query(f"({base}) r", [f'"{c}"' for c in rep["totals"]])
+
+        def prepare():
+            if rep.get("before"):
+                self.cursor.execute(rep["before"])
+                self.conn.commit()
+                self.note_write()
+            return self.estimate_rows(base, params)
+
         try:
-            self.cursor.execute(q, params)
-            rows = self.cursor.fetchall()
-            self.show_report("Сведения по договорам", rows)
+            estimate = self._run_cancellable("report", rep["title"], prepare)
+        except OperationCancelled:
+            return
         except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
             messagebox.showerror("Ошибка отчёта", str(e))
-
-
-    def report_planned(self):
-        where_sql, order_sql, params = self.ask_report_params("planned")
-        if where_sql is None:
+            return
+        if estimate > REPORT_CONFIRM_ROWS and not messagebox.askyesno(
+                "Большой отчёт",
+                f"По оценке планировщика отчёт вернёт около {estimate:,} строк.\n"
+                "Строки будут подгружаться страницами. Продолжить?".replace(",", " ")):
             return
 
-        q = f"""
-            SELECT 
-                c.contract_code AS "Код договора",
-                c.topic AS "Тема",
-                cs.stage_execution_date AS "Плановая дата",
-                cs.stage_amount AS "Сумма этапа"
-            FROM contracts c
-            JOIN contract_stages cs 
-                ON c.contract_code = cs.contract_code
-            {where_sql}
-            {order_sql};
-        """
+        # постраничное чтение по ключу: (выражение IS NULL, COALESCE(выражение), уникальный ключ)
+        expr, ftype, desc = order
+        key_exprs = [f"({expr} IS NULL)", f"COALESCE({expr}, {KEYSET_NULL_DEFAULTS[ftype]})", *rep["key"]]
+        keys_sql = "".join(f"{e} AS _key{i}, " for i, e in enumerate(key_exprs))
+        direction = "DESC" if desc else "ASC"
+        order_sql = "ORDER BY " + ", ".join(f"_key{i} {direction}" for i in range(len(key_exprs)))
+        after_sql = "({}) {} ({})".format(", ".join(key_exprs), "<" if desc else ">",
+                                          ", ".join(["%s"] * len(key_exprs)))
+        state = {"last": None, "loaded": 0}
+
+        def page(after, limit):
+            where, page_params = where_sql, list(params)
+            if after is not None:
+                where = f"{where_sql} AND {after_sql}" if where_sql else f"WHERE {after_sql}"
+                page_params += list(after)
+            q = rep["sql"].format(where=where, keys=keys_sql, **sources) + f"\n{order_sql}\nLIMIT %s"
+            rows = self.fetch_report_rows(q, page_params + [limit])
+            if rows:
+                state["last"] = tuple(rows[-1][f"_key{i}"] for i in range(len(key_exprs)))
+            return rows
+
+        def load(prepare=True):
+            if prepare and rep.get("before"):
+                self.cursor.execute(rep["before"])
+                self.conn.commit()
+                self.note_write()
+            # при обновлении перечитываем столько строк, сколько уже показано
+            rows = page(None, max(REPORT_PAGE_SIZE, state["loaded"]))
+            state["loaded"] = len(rows)
+            totals = self.fetch_report_rows(totals_q, params)[0]
+            return rows, self.format_totals(totals, rep["totals"])
+
+        def more():
+            rows = page(state["last"], REPORT_PAGE_SIZE)
+            state["loaded"] += len(rows)
+            return rows, len(rows) == REPORT_PAGE_SIZE
+
         try:
-            self.cursor.execute(q, params)
-            rows = self.cursor.fetchall()
-            self.show_report("Плановый график оплат по договорам", rows)
+            # "before" уже выполнен перед оценкой
+            rows, totals = self._run_cancellable("report", rep["title"], lambda: load(prepare=False))
+            title = rep["title"] + (" (включая архив)" if include_archive else "")
+            self.show_report(title, rows, totals=totals, tables=rep["tables"], reload=load,
+                             more=more if len(rows) >= REPORT_PAGE_SIZE else None)
+        except OperationCancelled:
+            pass
         except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
             messagebox.showerror("Ошибка отчёта", str(e))
 
+    def estimate_rows(self, q, params):
+        # оценка планировщика без выполнения запроса
+        cur = self.reader()[1]
+        cur.execute(f"EXPLAIN (FORMAT JSON) {q}", params)
+        plan = cur.fetchone()["QUERY PLAN"]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def report_contract_details(self):
+        self.run_report("contract_details")
+
+    def report_planned(self):
+        self.run_report("planned")
 
     def report_actual(self):
-        where_sql, order_sql, params = self.ask_report_params("actual")
-        if where_sql is None:
-            return
+        self.run_report("actual")
+
+    def report_aging(self):
+        self.run_report("aging")
+
+    CASHFLOW_SQL = """
+        WITH buckets AS (
+            SELECT g::date AS period
+            FROM generate_series(%s::date, %s::date, %s::interval) g
+        ),
+        plan AS (
+            SELECT date_trunc(%s, cs.stage_execution_date)::date AS period, SUM(cs.stage_amount) AS planned
+            FROM {contract_stages} cs
+            WHERE cs.stage_execution_date >= %s::date AND cs.stage_execution_date < %s::date
+            GROUP BY 1
+        ),
+        fact AS (
+            SELECT date_trunc(%s, p.payment_date)::date AS period, SUM(p.payment_amount) AS actual
+            FROM {payments} p
+            WHERE p.payment_date >= %s::date AND p.payment_date < %s::date
+            GROUP BY 1
+        )
+        SELECT
+            b.period AS "Период",
+            COALESCE(pl.planned, 0) AS "План",
+            COALESCE(f.actual, 0) AS "Факт",
+            COALESCE(f.actual, 0) - COALESCE(pl.planned, 0) AS "Отклонение",
+            %s::numeric + SUM(COALESCE(pl.planned, 0)) OVER w AS "План нараст.",
+            %s::numeric + SUM(COALESCE(f.actual, 0)) OVER w AS "Факт нараст.",
+            %s::numeric + SUM(COALESCE(f.actual, 0) - COALESCE(pl.planned, 0)) OVER w AS "Отклонение нараст."
+        FROM buckets b
+        LEFT JOIN plan pl ON pl.period = b.period
+        LEFT JOIN fact f ON f.period = b.period
+        WINDOW w AS (ORDER BY b.period)
+        ORDER BY b.period
+    """
+
+    def cashflow_periods(self, trunc, d1, d2):
+        """Начала периодов с d1 по d2 (как date_trunc) и начало следующего за последним."""
+        if trunc == "month":
+            p = d1.replace(day=1)
+
+            def step(d):
+                return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            p = d1 - timedelta(days=d1.weekday())  # неделя с понедельника
 
-        q = f"""
-            SELECT 
-                c.contract_code AS "Код договора",
-                c.topic AS "Тема",
-                p.payment_date AS "Дата платежа",
-                p.payment_amount AS "Сумма платежа",
-                pt.payment_type_name AS "Вид оплаты",
-                p.payment_document_number AS "Номер документа"
-            FROM contracts c
-            JOIN payments p ON c.contract_code = p.contract_code
-            JOIN payment_types pt ON p.payment_type_code = pt.payment_type_code
-            {where_sql}
-            {order_sql};
+            def step(d):
+                return d + timedelta(days=7)
+        periods = []
+        while p <= d2:
+            periods.append(p)
+            p = step(p)
+        return periods, p
+
+    def cashflow_rows(self, unit, d1, d2, include_archive):
+        """
+        Строки план/факт по периодам. Закрытые периоды (до текущего) берутся
+        из кэша подряд с начала диапазона; сервер считает только остаток,
+        а накопленные суммы продолжает от закэшированной части.
         """
+        trunc, step = CASHFLOW_UNITS[unit]
+        periods, end = self.cashflow_periods(trunc, d1, d2)
+        current = self.cashflow_periods(trunc, date.today(), date.today())[0][0]
+
+        rows = []
+        cum_plan = cum_fact = Decimal(0)
+        for p in periods:
+            cached = self.cashflow_cache.get((trunc, include_archive, p))
+            if p >= current or cached is None:
+                break
+            planned, actual = cached
+            cum_plan += planned
+            cum_fact += actual
+            rows.append({
+                "Период": p, "План": planned, "Факт": actual, "Отклонение": actual - planned,
+                "План нараст.": cum_plan, "Факт нараст.": cum_fact, "Отклонение нараст.": cum_fact - cum_plan,
+            })
+
+        if len(rows) < len(periods):
+            first = periods[len(rows)]
+            sources = {t: f"{t}_all" if include_archive else t for t in ARCHIVED_TABLES}
+            q = self.CASHFLOW_SQL.format(**sources)
+            params = [first, periods[-1], step,
+                      trunc, first, end,
+                      trunc, first, end,
+                      cum_plan, cum_fact, cum_fact - cum_plan]
+            for r in self.fetch_report_rows(q, params):
+                r = dict(r)
+                if r["Период"] < current:
+                    self.cashflow_cache[(trunc, include_archive, r["Период"])] = (r["План"], r["Факт"])
+                rows.append(r)
+        return rows
+
+    def ask_cashflow_params(self):
+        """(шаг, с даты, по дату, с архивом) или None, если отмена."""
+        win = ctk.CTkToplevel(self)
+        win.title("Параметры отчёта")
+        win.geometry("480x330")
+        win.grab_set()  # модальное
+        win.focus_force()
+
+        ctk.CTkLabel(win, text="Денежный поток: план и факт", font=("Arial", 18, "bold")).pack(pady=(15, 10))
+
+        box = ctk.CTkFrame(win)
+        box.pack(fill="x", padx=15, pady=6)
+        today = date.today()
+        ctk.CTkLabel(box, text="Период").grid(row=0, column=0, sticky="w", padx=10, pady=6)
+        unit = ctk.CTkComboBox(box, values=list(CASHFLOW_UNITS), width=150)
+        unit.set("Месяц")
+        unit.grid(row=0, column=1, sticky="w", padx=10, pady=6)
+        ctk.CTkLabel(box, text="С даты").grid(row=1, column=0, sticky="w", padx=10, pady=6)
+        d1_entry = ctk.CTkEntry(box, width=150)
+        d1_entry.insert(0, today.replace(month=1, day=1).strftime("%d.%m.%Y"))
+        d1_entry.grid(row=1, column=1, sticky="w", padx=10, pady=6)
+        ctk.CTkLabel(box, text="По дату").grid(row=2, column=0, sticky="w", padx=10, pady=6)
+        d2_entry = ctk.CTkEntry(box, width=150)
+        d2_entry.insert(0, today.replace(month=12, day=31).strftime("%d.%m.%Y"))
+        d2_entry.grid(row=2, column=1, sticky="w", padx=10, pady=6)
+
+        archive_var = tk.BooleanVar(value=False)
+        ctk.CTkCheckBox(win, text="Включая архив", variable=archive_var).pack(anchor="w", padx=25, pady=5)
+
+        result = {}
+
+        def on_ok():
+            try:
+                d1, d2 = [datetime.strptime(e.get().strip(), "%d.%m.%Y" if "." in e.get() else "%Y-%m-%d").date()
+                          for e in (d1_entry, d2_entry)]
+            except ValueError:
+                messagebox.showerror("Ошибка", "Неверная дата (ожидается ДД.ММ.ГГГГ или ГГГГ-ММ-ДД)", parent=win)
+                return
+            if d1 > d2 or unit.get() not in CASHFLOW_UNITS:
+                messagebox.showerror("Ошибка", "Проверьте период отчёта", parent=win)
+                return
+            result["params"] = (unit.get(), d1, d2, bool(archive_var.get()))
+            win.destroy()
+
+        btns = ctk.CTkFrame(win)
+        btns.pack(fill="x", padx=15, pady=(15, 10))
+        ctk.CTkButton(btns, text="Сформировать", fg_color="green", command=on_ok).pack(side="left", padx=10, pady=10)
+        ctk.CTkButton(btns, text="Отмена", fg_color="#555", command=win.destroy).pack(side="left", padx=10, pady=10)
+
+        self.wait_window(win)
+        return result.get("params")
+
+    def report_cashflow(self):
+        if not self.require_online():
+            return
+        params = self.ask_cashflow_params()
+        if params is None:
+            return
+        unit, d1, d2, include_archive = params
+        labels = ("План", "Факт", "Отклонение")
+
+        def load():
+            rows = self.cashflow_rows(unit, d1, d2, include_archive)
+            totals = {"cnt": len(rows)}
+            for i, label in enumerate(labels):
+                values = [r[label] for r in rows]
+                totals[f"sum{i}"] = sum(values)
+                totals[f"min{i}"] = min(values, default=None)
+                totals[f"max{i}"] = max(values, default=None)
+            return rows, self.format_totals(totals, labels)
+
+        title = f"Денежный поток план/факт: {d1:%d.%m.%Y} — {d2:%d.%m.%Y}"
         try:
-            self.cursor.execute(q, params)
-            rows = self.cursor.fetchall()
-            self.show_report("Фактические поступления по договорам", rows)
+            rows, totals = self._run_cancellable("report", title, load)
+            self.show_report(title + (" (включая архив)" if include_archive else ""), rows,
+                             totals=totals, tables=("contract_stages", "payments"), reload=load)
+        except OperationCancelled:
+            pass
         except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
             messagebox.showerror("Ошибка отчёта", str(e))
 
+    def report_analytics(self):
+        if not self.require_online():
+            return
+        if not analytics.AVAILABLE:
+            messagebox.showerror("Аналитика", "Для аналитики нужен пакет numpy:\npip install numpy")
+            return
+
+        def load():
+            # имена заказчиков — тем же курсором в рабочем потоке, без справочника в reference_cache
+            rows = analytics.build_report(self.reader()[1])
+            return rows, None
 
+        try:
+            rows, _ = self._run_cancellable("report", "Аналитика оплат", load)
+            self.show_report("Аналитика оплат", rows,
+                             tables=("payments", "contracts", "contract_stages"), reload=load)
+        except OperationCancelled:
+            pass
+        except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            messagebox.showerror("Ошибка отчёта", str(e))
+
+    def rebuild_receivables(self):
+        if not self.require_online():
+            return
+        if not messagebox.askyesno("Дебиторка", "Пересчитать снимок задолженности по всем договорам?"):
+            return
+        try:
+            n = self._run_cancellable("service", "Пересчёт дебиторки",
+                                      lambda: self.call_service("SELECT refresh_receivables_snapshot(TRUE) AS n"))
+            messagebox.showinfo("Дебиторка", f"Снимок пересчитан, этапов: {n}")
+        except OperationCancelled:
+            pass
+        except Exception as e:
+            try:
+                self.conn.rollback()
+            except:
+                pass
+            messagebox.showerror("Ошибка", str(e))
 
 
     def invalidate_cache_for_table(self, table):
+        # вызывается после каждой своей записи — заодно запоминаем её позицию для reader
+        self.note_write()
         # Remove any reference_cache keys related to table
         keys_to_remove = [k for k in self.reference_cache.keys() if k.startswith(table + "_") or ("contracts" if table=="contract_stages" else "")]
         for k in keys_to_remove:
             self.reference_cache.pop(k, None)
+        for k in [k for k in self.typeahead_cache if k[0] == table]:
+            del self.typeahead_cache[k]
+        self.fk_known.pop(table, None)
+        self.fk_names.pop(table, None)
+        if table in ("contract_stages", "payments"):
+            self.cashflow_cache.clear()
+        self.drop_cached_tables({table})
+        self.drop_named_tables({table})
 
 if __name__ == "__main__":
     app = DatabaseApp()
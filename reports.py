@@ -0,0 +1,138 @@
+"""
+Определения отчётов: поля для условий и сортировки, текст запроса
+и итоги. В тексте запроса {keys} — служебные колонки постраничного чтения,
+{where} — условия, {contracts}/{contract_stages}/{payments} — рабочие таблицы
+или объединения с архивом (*_all).
+"""
+
+REPORT_DEFS = {
+    "contract_details": {
+        "title": "Сведения по договорам",
+        "fields": {
+            # label: (sql_expression, type)
+            "Код договора": ("c.contract_code", "int"),
+            "Тема": ("c.topic", "text"),
+            "№ этапа": ("cs.stage_number", "int"),
+            "Сумма этапа": ("cs.stage_amount", "num"),
+            "Оплачено по этапу": ("COALESCE(a.paid_amount, 0)", "num"),
+            "Долг по этапу": ("(cs.stage_amount - COALESCE(a.paid_amount, 0))", "num"),
+        },
+        "default_sort": ("c.contract_code", "ASC"),
+        # уникальный ключ строки отчёта — добивка сортировки для постраничного чтения
+        "key": ("c.contract_code", "cs.stage_number"),
+        # дораспределяем оплаты договоров, изменившихся с прошлого раза
+        "before": "SELECT refresh_stage_allocations(FALSE)",
+        "sql": """
+            SELECT {keys}
+                c.contract_code AS "Код договора",
+                c.topic AS "Тема",
+                cs.stage_number AS "№ этапа",
+                cs.stage_amount AS "Сумма этапа",
+                COALESCE(a.advance_paid, 0) AS "в т.ч. аванс",
+                COALESCE(a.paid_amount, 0) AS "Оплачено по этапу",
+                (cs.stage_amount - COALESCE(a.paid_amount, 0)) AS "Долг по этапу"
+            FROM {contracts} c
+            JOIN {contract_stages} cs 
+                ON c.contract_code = cs.contract_code
+            LEFT JOIN stage_payment_allocations a
+                ON a.contract_code = cs.contract_code AND a.stage_number = cs.stage_number
+            {where}
+        """,
+        "tables": ("contracts", "contract_stages", "payments"),
+        "archive": True,
+        "totals": ("Сумма этапа", "Оплачено по этапу", "Долг по этапу"),
+    },
+    "planned": {
+        "title": "Плановый график оплат по договорам",
+        "fields": {
+            "Код договора": ("c.contract_code", "int"),
+            "Тема": ("c.topic", "text"),
+            "План. дата": ("cs.stage_execution_date", "date"),
+            "Сумма этапа": ("cs.stage_amount", "num"),
+        },
+        "default_sort": ("cs.stage_execution_date", "ASC"),
+        "key": ("c.contract_code", "cs.stage_number"),
+        "sql": """
+            SELECT {keys}
+                c.contract_code AS "Код договора",
+                c.topic AS "Тема",
+                cs.stage_execution_date AS "Плановая дата",
+                cs.stage_amount AS "Сумма этапа"
+            FROM {contracts} c
+            JOIN {contract_stages} cs 
+                ON c.contract_code = cs.contract_code
+            {where}
+        """,
+        "tables": ("contracts", "contract_stages"),
+        "archive": True,
+        "totals": ("Сумма этапа",),
+    },
+    "actual": {
+        "title": "Фактические поступления по договорам",
+        "fields": {
+            "Код договора": ("c.contract_code", "int"),
+            "Тема": ("c.topic", "text"),
+            "Дата платежа": ("p.payment_date", "date"),
+            "Сумма платежа": ("p.payment_amount", "num"),
+            "Вид оплаты": ("pt.payment_type_name", "text"),
+            "№ документа": ("p.payment_document_number", "text"),
+        },
+        "default_sort": ("p.payment_date", "ASC"),
+        "key": ("p.payment_id",),
+        "sql": """
+            SELECT {keys}
+                c.contract_code AS "Код договора",
+                c.topic AS "Тема",
+                p.payment_date AS "Дата платежа",
+                p.payment_amount AS "Сумма платежа",
+                pt.payment_type_name AS "Вид оплаты",
+                p.payment_document_number AS "Номер документа"
+            FROM {contracts} c
+            JOIN {payments} p ON c.contract_code = p.contract_code
+            JOIN payment_types pt ON p.payment_type_code = pt.payment_type_code
+            {where}
+        """,
+        "tables": ("contracts", "payments", "payment_types"),
+        "archive": True,
+        "totals": ("Сумма платежа",),
+    },
+    "aging": {
+        "title": "Дебиторская задолженность по срокам",
+        "fields": {
+            "Код договора": ('a."Код договора"', "int"),
+            "Заказчик": ('a."Заказчик"', "text"),
+            "Долг всего": ('a."Долг всего"', "num"),
+            "Срок не наступил": ('a."Срок не наступил"', "num"),
+            "0-30 дн.": ('a."0-30 дн."', "num"),
+            "31-90 дн.": ('a."31-90 дн."', "num"),
+            "Более 90 дн.": ('a."Более 90 дн."', "num"),
+        },
+        "default_sort": ('a."Более 90 дн."', "DESC"),
+        "key": ('a."Код договора"',),
+        # перед чтением дочитываем в снимок только затронутые договоры
+        "before": "SELECT refresh_receivables_snapshot(FALSE)",
+        "sql": """
+            SELECT {keys} * FROM (
+                SELECT
+                    s.contract_code AS "Код договора",
+                    o.name AS "Заказчик",
+                    SUM(s.unpaid_amount) AS "Долг всего",
+                    COALESCE(SUM(s.unpaid_amount) FILTER (
+                        WHERE s.due_date IS NULL OR s.due_date > CURRENT_DATE), 0) AS "Срок не наступил",
+                    COALESCE(SUM(s.unpaid_amount) FILTER (
+                        WHERE CURRENT_DATE - s.due_date BETWEEN 0 AND 30), 0) AS "0-30 дн.",
+                    COALESCE(SUM(s.unpaid_amount) FILTER (
+                        WHERE CURRENT_DATE - s.due_date BETWEEN 31 AND 90), 0) AS "31-90 дн.",
+                    COALESCE(SUM(s.unpaid_amount) FILTER (
+                        WHERE CURRENT_DATE - s.due_date > 90), 0) AS "Более 90 дн."
+                FROM receivables_snapshot s
+                JOIN organizations o ON o.organization_code = s.customer_code
+                WHERE s.unpaid_amount > 0
+                GROUP BY s.contract_code, o.name
+            ) a
+            {where}
+        """,
+        "tables": ("contracts", "contract_stages", "payments", "organizations"),
+        "totals": ("Долг всего", "0-30 дн.", "31-90 дн.", "Более 90 дн."),
+    },
+}
@@ -0,0 +1,116 @@
+"""
+Локальный снимок данных в SQLite: справочники и недавно открытые таблицы
+вместе с отметками времени сервера. Позволяет показать данные сразу при
+запуске и просматривать их без связи с БД.
+
+Каждая операция открывает своё соединение, поэтому сохранять снимок можно
+из фонового потока.
+"""
+import json
+import sqlite3
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+
+def _encode(value):
+    # типы из psycopg2, которых нет в JSON
+    if isinstance(value, Decimal):
+        return {"$dec": str(value)}
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Не сохраняется в снимок: {type(value).__name__}")
+
+
+def _decode(obj):
+    if len(obj) == 1:
+        if "$dec" in obj:
+            return Decimal(obj["$dec"])
+        if "$dt" in obj:
+            return datetime.fromisoformat(obj["$dt"])
+        if "$date" in obj:
+            return date.fromisoformat(obj["$date"])
+    return obj
+
+
+def _pack(data):
+    return zlib.compress(json.dumps(data, default=_encode, ensure_ascii=False).encode("utf-8"))
+
+
+def _unpack(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"), object_hook=_decode)
+
+
+class SnapshotStore:
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tables (
+                    name TEXT PRIMARY KEY,
+                    source TEXT,
+                    watermark TEXT,
+                    saved_at TEXT NOT NULL,
+                    rows BLOB NOT NULL
+                )""")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def save_table(self, table, rows, watermark, source=None):
+        blob = _pack(rows)
+        with self.connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tables VALUES (?, ?, ?, ?, ?)",
+                (table, source or table, watermark.isoformat() if watermark else None,
+                 datetime.now().isoformat(timespec="seconds"), blob)
+            )
+
+    def load_table(self, table):
+        """(строки, отметка, источник, когда сохранено) или None, если таблицы в снимке нет."""
+        try:
+            with self.connect() as db:
+                found = db.execute(
+                    "SELECT rows, watermark, source, saved_at FROM tables WHERE name = ?", (table,)
+                ).fetchone()
+            if found is None:
+                return None
+            blob, watermark, source, saved_at = found
+            return (_unpack(blob), datetime.fromisoformat(watermark) if watermark else None,
+                    source, datetime.fromisoformat(saved_at))
+        except (sqlite3.Error, ValueError, zlib.error):
+            # повреждённый снимок не должен мешать запуску
+            return None
+
+    def saved_at(self, table):
+        try:
+            with self.connect() as db:
+                found = db.execute("SELECT saved_at FROM tables WHERE name = ?", (table,)).fetchone()
+            return datetime.fromisoformat(found[0]) if found else None
+        except (sqlite3.Error, ValueError):
+            return None
+
+    def set_meta(self, key, value):
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, _pack(value)))
+
+    def get_meta(self, key, default=None):
+        try:
+            with self.connect() as db:
+                found = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return _unpack(found[0]) if found else default
+        except (sqlite3.Error, ValueError, zlib.error):
+            return default
+
+    def save_references(self, cache):
+        # ключи словаря кодов — числа, в JSON они стали бы строками
+        data = {k: {"map": list(v["map"].items()), "list": v["list"]} for k, v in cache.items()}
+        self.set_meta("references", data)
+
+    def load_references(self):
+        data = self.get_meta("references", {})
+        return {k: {"map": {code: disp for code, disp in v["map"]}, "list": v["list"]}
+                for k, v in data.items()}
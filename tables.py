@@ -0,0 +1,116 @@
+"""
+Таблицы приложения: подписи полей, первичные ключи и справочники для FK.
+Отдельно от main.py, чтобы их могли импортировать утилиты без интерфейса
+(loadtest.py).
+"""
+
+FIELD_NAMES = {
+    "vat_rates": {
+        "vat_code": "Код",
+        "percentage": "Процент НДС",
+        "description": "Описание"
+    },
+    "contract_types": {
+        "contract_type_code": "Код",
+        "type_name": "Тип договора"
+    },
+    "execution_stages": {
+        "stage_code": "Код",
+        "stage_name": "Стадия"
+    },
+    "payment_types": {
+        "payment_type_code": "Код",
+        "payment_type_name": "Вид оплаты"
+    },
+    "organizations": {
+        "organization_code": "Код",
+        "name": "Наименование",
+        "postal_index": "Индекс",
+        "address": "Адрес",
+        "phone": "Телефон",
+        "fax": "Факс",
+        "inn": "ИНН",
+        "correspondent_account": "Корр. счёт",
+        "bank_name": "Банк",
+        "settlement_account": "Расчётный счет",
+        "okonh": "ОКОНХ",
+        "okpo": "ОКПО",
+        "bik": "БИК",
+        "created_date": "Дата создания",
+        "is_active": "Активна",
+        "updated_at": "Обновлено"
+    },
+    "contracts": {
+        "contract_code": "Код",
+        "conclusion_date": "Дата заключения",
+        "customer_code": "Заказчик",
+        "executor_code": "Исполнитель",
+        "contract_type_code": "Тип договора",
+        "execution_stage_code": "Стадия",
+        "vat_code": "НДС",
+        "execution_date": "План. дата",
+        "topic": "Тема",
+        "notes": "Примечание",
+        "total_amount": "Сумма",
+        "created_at": "Создано",
+        "updated_at": "Обновлено"
+    },
+    "contract_stages": {
+        "contract_code": "Код договора",
+        "stage_number": "№ этапа",
+        "stage_execution_date": "Дата этапа",
+        "stage_code": "Стадия",
+        "stage_amount": "Сумма этапа",
+        "advance_amount": "Аванс",
+        "topic": "Тема этапа",
+        "notes": "Примечание",
+        "updated_at": "Обновлено"
+    },
+    "payments": {
+        "payment_id": "Код",
+        "contract_code": "Договор",
+        "payment_date": "Дата платежа",
+        "payment_amount": "Сумма",
+        "payment_type_code": "Вид оплаты",
+        "payment_document_number": "№ документа",
+        "updated_at": "Обновлено"
+    }
+}
+
+# Первичные ключи таблиц (у contract_stages — составной)
+TABLE_PKS = {
+    "vat_rates": ("vat_code",),
+    "contract_types": ("contract_type_code",),
+    "execution_stages": ("stage_code",),
+    "payment_types": ("payment_type_code",),
+    "organizations": ("organization_code",),
+    "contracts": ("contract_code",),
+    "contract_stages": ("contract_code", "stage_number"),
+    "payments": ("payment_id",),
+}
+
+# FK-колонка -> (справочная таблица, отображаемое поле, код)
+REF_MAPPING = {
+    "customer_code": ("organizations", "name", "organization_code"),
+    "executor_code": ("organizations", "name", "organization_code"),
+    "contract_type_code": ("contract_types", "type_name", "contract_type_code"),
+    "execution_stage_code": ("execution_stages", "stage_name", "stage_code"),
+    "vat_code": ("vat_rates", "description", "vat_code"),
+    "payment_type_code": ("payment_types", "payment_type_name", "payment_type_code"),
+    "stage_code": ("execution_stages", "stage_name", "stage_code"),
+    "contract_code": ("contracts", "topic", "contract_code")
+}
+
+# Витрины для показа таблиц: (материализованное представление, обычное
+# представление с теми же колонками, FK-колонка -> колонка с готовым именем).
+# Строки витрины содержат и сами коды, поэтому редактирование работает как
+# с обычной таблицей; изменённые строки дочитываются из представления.
+MATERIALIZED_SOURCES = {
+    "contracts": ("contracts_detailed_mv", "contracts_detailed", {
+        "customer_code": "customer_name",
+        "executor_code": "executor_name",
+        "contract_type_code": "contract_type_name",
+        "execution_stage_code": "execution_stage_name",
+        "vat_code": "vat_description",
+    }),
+}